@@ -1,38 +1,94 @@
 # -*- coding: utf-8 -*-
 
-from appli.model.model import add_product, drop_products
-from appli.model.flat import FlatProduct
+from datetime import timedelta
+from threading import Lock
+
+from peewee import DatabaseError
+
+from appli.config import DefaultConfig
+from appli.model.model import reload_catalog
 from appli.routes.api import api
-from appli.services.external.productapi import fetch_products
-from appli.extensions import db
+from appli.services.catalog import catalog_refresher
+from appli.services.order_writer import order_writer
+from appli.services.payments import payment_workers
+from appli.services.reservations import reservation_releaser
+from appli.extensions import db, configure_database
+from appli.utils.json_provider import set_backend as set_json_backend
 
 
 # For import *
-__all__ = ["create_app"]
+__all__ = ["create_app", "start_services", "stop_services"]
+
+_services_lock = Lock()
+_services_wanted = False
+_services_started = False
 
 
 def create_app(config=None):
-    try:
-        db.connect()
-        with db.manual_commit() as _:
-            db.begin()
-            drop_products()
-            db.commit()
-        with db.manual_commit() as _:
-            db.begin()
-            for p in fetch_products():
-                add_product(
-                    FlatProduct(
-                        id=p["id"],
-                        name=p["name"],
-                        price=p["price"],
-                        image=p["image"],
-                        in_stock=p["in_stock"],
-                        description=p["description"],
-                        weight=p["weight"],
-                    )
-                )
-            db.commit()
-    except:
-        pass
+    """Configure the app. Its catalog and background threads are only started by its
+    first request, so that the CLI commands (init-db, migrate) run without them."""
+    global _services_wanted
+    api.config.from_object(config or DefaultConfig)
+    threshold = api.config["SLOW_QUERY_THRESHOLD_MS"]
+    configure_database(
+        api.config["DATABASE_URI"],
+        api.config["DATABASE_PRAGMAS"],
+        None if threshold is None else threshold / 1000,
+    )
+    set_json_backend(api.config["JSON_BACKEND"])
+    _services_wanted = True
     return api
+
+
+@api.before_request
+def start_services_on_first_request():
+    if _services_wanted and not _services_started:
+        start_services()
+
+
+def start_services():
+    "Load the catalog and start the background threads, once per process."
+    global _services_started
+    if _services_started:
+        return
+    with _services_lock:  # the other first requests wait for the catalog
+        if _services_started:
+            return
+        try:  # serve whatever the database holds until the upstream sync is done
+            with db.connection_context():
+                reload_catalog()
+        except DatabaseError:
+            api.logger.exception("could not load the catalog from the database")
+        catalog_refresher.start(interval=api.config["CATALOG_REFRESH_INTERVAL"])
+        reservation_releaser.start(interval=api.config["RESERVATION_RELEASE_INTERVAL"])
+        if api.config["ASYNC_PAYMENTS"]:
+            start_payment_workers()
+        if api.config["ORDER_WRITE_BATCHING"]:
+            order_writer.window = api.config["ORDER_WRITE_WINDOW"]
+            order_writer.max_batch = api.config["ORDER_WRITE_MAX_BATCH"]
+            order_writer.start()
+        _services_started = True
+
+
+def stop_services(timeout: float | None = None):
+    "Stop the background threads started by start_services(), waiting for them."
+    global _services_started
+    with _services_lock:
+        catalog_refresher.stop(timeout)
+        reservation_releaser.stop(timeout)
+        payment_workers.stop(timeout)
+        order_writer.stop(timeout)
+        _services_started = False
+
+
+def start_payment_workers():
+    "Start the background payment workers once per process."
+    if payment_workers.running:
+        return
+    payment_workers.workers = api.config["PAYMENT_WORKERS"]
+    payment_workers.poll_interval = api.config["PAYMENT_POLL_INTERVAL"]
+    payment_workers.max_attempts = api.config["PAYMENT_JOB_MAX_ATTEMPTS"]
+    payment_workers.retry_backoff = api.config["PAYMENT_JOB_RETRY_BACKOFF"]
+    payment_workers.start(
+        stale_after=timedelta(seconds=api.config["PAYMENT_JOB_TIMEOUT"])
+    )
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from os import path
+from os import environ, path
 
 
 class BaseConfig(object):
@@ -17,7 +17,91 @@ class DefaultConfig(BaseConfig):
 
     # SQLITE for production
     DATABASE_URI = "badatase.db"
+    # WAL lets readers go on while an order is being written
+    DATABASE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "cache_size": -64 * 1024,  # in KiB when negative
+        "mmap_size": 256 * 1024 * 1024,
+        "busy_timeout": 5000,  # ms to wait for the write lock
+    }
+    # Log the queries slower than this (ms), None to log nothing
+    SLOW_QUERY_THRESHOLD_MS = 100
+    # Add X-Query-Count and X-Query-Time-Ms headers to the responses (always on in debug mode)
+    QUERY_STATS_HEADERS = False
+
+    # Seconds between two syncs of the catalog with the products API, 0 to sync at startup only
+    CATALOG_REFRESH_INTERVAL = 0
+
+    # Paginated product listing (GET /?limit=...)
+    PRODUCTS_PAGE_SIZE = 50
+    PRODUCTS_MAX_PAGE_SIZE = 500
+
+    # Group commit of POST /order: a single thread writes the orders arriving within
+    # ORDER_WRITE_WINDOW seconds of each other in one transaction
+    ORDER_WRITE_BATCHING = False
+    ORDER_WRITE_WINDOW = 0.002
+    ORDER_WRITE_MAX_BATCH = 100
+
+    # Most orders accepted by one POST /orders
+    ORDERS_BATCH_MAX_SIZE = 10000
+
+    # Serialized orders kept in memory for GET /order/<id>
+    ORDER_CACHE_SIZE = 10000
+
+    # GET /order/<id>/events: seconds between two heartbeats, and longest a stream stays open
+    ORDER_EVENTS_HEARTBEAT = 15
+    ORDER_EVENTS_TIMEOUT = 5 * 60
+
+    # Encoder of the JSON responses: "auto" (orjson if installed), "orjson" or "json"
+    JSON_BACKEND = "auto"
+
+    # Seconds a response is replayed to the requests with the same Idempotency-Key
+    IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+    # Seconds a key stays reserved while its first request is processed: a request
+    # interrupted by a crash can be retried with the same key after that
+    IDEMPOTENCY_KEY_LEASE = 60
+
+    # Stock of the products added by a catalog sync, and to which every sync tops up those
+    # in stock upstream (the products API only says whether they are), then seconds the stock of an unpaid order stays reserved and
+    # between two releases of the expired reservations (0 to never release them)
+    PRODUCT_INITIAL_STOCK = 100
+    ORDER_RESERVATION_TTL = 30 * 60
+    RESERVATION_RELEASE_INTERVAL = 60
 
     # Flask-cache
     CACHE_TYPE = "simple"
     CACHE_DEFAULT_TIMEOUT = 60
+
+    # Payments: charge in background workers and answer 202 Accepted right away
+    ASYNC_PAYMENTS = False
+    PAYMENT_WORKERS = 4
+    PAYMENT_POLL_INTERVAL = 1.0
+    PAYMENT_JOB_TIMEOUT = 300
+    # charges refused by an unavailable gateway are tried again, waiting longer each time
+    PAYMENT_JOB_MAX_ATTEMPTS = 5
+    PAYMENT_JOB_RETRY_BACKOFF = 2.0
+
+    # External APIs (the URLs can be pointed at local stand-ins through the environment)
+    PRODUCTS_API_URL = environ.get(
+        "PRODUCTS_API_URL", "https://dimensweb.uqac.ca/~jgnault/shops/products/"
+    )
+    CHARGING_API_URL = environ.get(
+        "CHARGING_API_URL", "https://dimensweb.uqac.ca/~jgnault/shops/pay/"
+    )
+    HTTP_CONNECT_TIMEOUT = 3.0
+    HTTP_READ_TIMEOUT = 10.0
+    HTTP_MAX_CONNECTIONS_PER_HOST = 10
+    HTTP_GZIP = True
+
+    # Payment gateway: timeouts of a charge, attempts (retried only when the gateway
+    # could not be reached or answered 502/503) with a jittered backoff, share of the
+    # charges that may be retried, and circuit breaker opened after consecutive
+    # failures, failing the charges fast for some seconds
+    CHARGING_CONNECT_TIMEOUT = 2.0
+    CHARGING_READ_TIMEOUT = 8.0
+    CHARGING_MAX_ATTEMPTS = 3
+    CHARGING_RETRY_BACKOFF = 0.2
+    CHARGING_RETRY_BUDGET = 0.2
+    CHARGING_BREAKER_THRESHOLD = 5
+    CHARGING_BREAKER_RESET_TIMEOUT = 30.0
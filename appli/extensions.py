@@ -1,5 +1,80 @@
 # -*- coding: utf-8 -*-
+from dataclasses import dataclass
+from logging import getLogger
+from threading import current_thread, local
+from time import perf_counter
+
+from flask import has_request_context, request
 from peewee import SqliteDatabase
 from .config import DefaultConfig
 
-db = SqliteDatabase(DefaultConfig.DATABASE_URI)
+logger = getLogger(__name__)
+
+
+@dataclass
+class QueryStats:
+    "Queries run by a thread since its stats were last reset."
+    count: int = 0
+    seconds: float = 0.0
+
+
+class InstrumentedSqliteDatabase(SqliteDatabase):
+    "SqliteDatabase counting the queries of each thread and logging the slow ones."
+
+    # seconds, None to log nothing
+    slow_query_threshold: float | None = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats = local()
+
+    @property
+    def stats(self) -> QueryStats:
+        stats = getattr(self._stats, "value", None)
+        if stats is None:
+            stats = self._stats.value = QueryStats()
+        return stats
+
+    def reset_stats(self) -> QueryStats:
+        self._stats.value = QueryStats()
+        return self._stats.value
+
+    def execute_sql(self, sql, params=None, commit=None):
+        start = perf_counter()
+        try:
+            return super().execute_sql(sql, params, commit)
+        finally:
+            elapsed = perf_counter() - start
+            stats = self.stats
+            stats.count += 1
+            stats.seconds += elapsed
+            if self.slow_query_threshold is not None and elapsed > self.slow_query_threshold:
+                logger.warning(
+                    "slow query (%.1f ms) in %s: %s %r",
+                    elapsed * 1000,
+                    request.endpoint if has_request_context() else current_thread().name,
+                    sql,
+                    params,
+                )
+
+
+db = InstrumentedSqliteDatabase(
+    DefaultConfig.DATABASE_URI, pragmas=DefaultConfig.DATABASE_PRAGMAS
+)
+
+
+def configure_database(uri: str, pragmas: dict, slow_query_threshold: float | None = None):
+    """Point the database at another file or change its pragmas.
+
+    Open connections are closed only if something changed, so calling it again with
+    the same settings doesn't disturb the threads using the database.
+
+    Args:
+        uri (str): Path of the SQLite database.
+        pragmas (dict): Pragmas run on every new connection.
+        slow_query_threshold (float | None, optional): Log the queries slower than this
+            many seconds.
+    """
+    db.slow_query_threshold = slow_query_threshold
+    if db.database != uri or dict(db._pragmas) != pragmas:
+        db.init(uri, pragmas=pragmas)
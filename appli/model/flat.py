@@ -1,8 +1,12 @@
-"Flat versions of Model classes with their database link removed and foreign keys resolved."
+"""Flat versions of Model classes with their database link removed and foreign keys resolved.
+
+They are slotted and frozen: light to hold by the thousand, and safe to share between
+threads (the catalog hands out the same products to every request).
+"""
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatProduct:
     "Flat version of Product (with no link to the database)."
     name: str
@@ -14,7 +18,7 @@ class FlatProduct:
     weight: int | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatShippingInformation:
     "Flat version of ShippingInformation (with no link to the database)."
     country: str
@@ -25,16 +29,15 @@ class FlatShippingInformation:
     id: int | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatProductOrderQuantity:
     "Flat version of ProductOrderQuantity (with no link to the database)."
-    # oid: FlatOrder
     product: FlatProduct
     quantity: int
     id: int | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatCreditCardDetails:
     "Flat version of CreditCardDetails (with no link to the database)."
     name: str
@@ -45,7 +48,7 @@ class FlatCreditCardDetails:
     id: int | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatTransaction:
     "Flat version of Transaction (with no link to the database)."
     success: bool
@@ -53,13 +56,15 @@ class FlatTransaction:
     id: str | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class FlatOrder:
     "Flat version of Order (with no link to the database)."
-    products: FlatProductOrderQuantity
+    products: list[FlatProductOrderQuantity]
     id: int | None = None
     email: str | None = None
     credit_card: FlatCreditCardDetails | None = None
     shipping_information: FlatShippingInformation | None = None
     transaction: FlatTransaction | None = None
     paid: bool = False
+    payment_status: str | None = None
+    payment_error: str | None = None
@@ -0,0 +1,250 @@
+"""
+Versioned migrations of the database schema, applied in place without losing data.
+
+The version of a database is kept in PRAGMA user_version. Every step also checks
+the schema before changing it, so that it can run on databases created by any
+earlier version of the application.
+"""
+from datetime import datetime
+from logging import getLogger
+from typing import Callable
+
+from peewee import (
+    CharField,
+    DateTimeField,
+    ForeignKeyField,
+    IntegerField,
+    Query,
+    TextField,
+)
+from playhouse.migrate import SqliteMigrator, migrate as run_operations
+
+from appli.config import DefaultConfig
+from appli.extensions import db
+from appli.model.model import (
+    MODELS,
+    IdempotencyKey,
+    Order,
+    PaymentJob,
+    Product,
+    ProductOrderQuantity,
+    order_query,
+    product_query,
+)
+
+logger = getLogger(__name__)
+
+
+def _columns(table: str) -> set[str]:
+    return {column.name for column in db.get_columns(table)}
+
+
+def create_missing_tables(migrator: SqliteMigrator):
+    "Tables of the models added since the database was created."
+    db.create_tables([m for m in MODELS if not m.table_exists()])
+
+
+def link_order_lines(migrator: SqliteMigrator):
+    """Orders with several products: the lines point to their order, instead of each
+    order pointing to its single line."""
+    if "oid_id" in _columns(ProductOrderQuantity._meta.table_name):
+        return
+    run_operations(
+        migrator.add_column(
+            ProductOrderQuantity._meta.table_name,
+            "oid_id",
+            ForeignKeyField(Order, null=True, field=Order.id),
+        )
+    )
+    db.execute_sql(
+        'UPDATE "productorderquantity" SET "oid_id" = '
+        '(SELECT "id" FROM "order" WHERE "order"."product_id" = "productorderquantity"."id")'
+    )
+    operations = [
+        # the column has a foreign key and an index, rebuild the table to drop it
+        migrator.drop_column(Order._meta.table_name, "product_id", legacy=True)
+    ]
+    if not ProductOrderQuantity.select().where(ProductOrderQuantity.oid.is_null()).exists():
+        operations.append(
+            migrator.add_not_null(ProductOrderQuantity._meta.table_name, "oid_id")
+        )
+    else:
+        logger.warning("some order lines belong to no order, oid_id stays nullable")
+    run_operations(*operations)
+
+
+def add_stock_and_reservations(migrator: SqliteMigrator):
+    "Integer stock of the products and reservation of the stock of unpaid orders."
+    operations = []
+    if "stock" not in _columns(Product._meta.table_name):
+        operations.append(
+            migrator.add_column(
+                Product._meta.table_name,
+                "stock",
+                IntegerField(default=DefaultConfig.PRODUCT_INITIAL_STOCK),
+            )
+        )
+    if "reserved_until" not in _columns(Order._meta.table_name):
+        # existing orders hold nothing, their stock is reserved again when paid
+        operations.append(
+            migrator.add_column(
+                Order._meta.table_name, "reserved_until", DateTimeField(null=True)
+            )
+        )
+    run_operations(*operations)
+
+
+def add_payment_status(migrator: SqliteMigrator):
+    "Problem with the last payment attempt of each order, for clients and reconciliation."
+    columns = _columns(Order._meta.table_name)
+    run_operations(
+        *(
+            migrator.add_column(Order._meta.table_name, name, field)
+            for name, field in (
+                ("payment_status", CharField(null=True)),
+                ("payment_error", TextField(null=True)),
+            )
+            if name not in columns
+        )
+    )
+
+
+def add_payment_retries(migrator: SqliteMigrator):
+    "Payment jobs put back in the queue wait before being claimed again."
+    if "run_after" not in _columns(PaymentJob._meta.table_name):
+        run_operations(
+            migrator.add_column(
+                PaymentJob._meta.table_name, "run_after", DateTimeField(null=True)
+            )
+        )
+
+
+def add_order_versions(migrator: SqliteMigrator):
+    "Version of each order, stored with it so that every process validates its ETag."
+    if "version" not in _columns(Order._meta.table_name):
+        run_operations(
+            migrator.add_column(
+                Order._meta.table_name, "version", IntegerField(default=0)
+            )
+        )
+
+
+def add_idempotency_leases(migrator: SqliteMigrator):
+    "Keys reserved for a short lease while processed, and the body they were used with."
+    columns = _columns(IdempotencyKey._meta.table_name)
+    run_operations(
+        *(
+            migrator.add_column(IdempotencyKey._meta.table_name, name, field)
+            for name, field in (
+                ("body_hash", CharField(max_length=64, null=True)),
+                ("claimed_at", DateTimeField(null=True)),
+            )
+            if name not in columns
+        )
+    )
+
+
+def create_indexes(migrator: SqliteMigrator):
+    "Indexes of the foreign keys and of the lookup columns of the hot queries."
+    for model in MODELS:
+        model._schema.create_indexes(safe=True)
+
+
+Migration = tuple[int, str, Callable[[SqliteMigrator], None]]
+
+MIGRATIONS: list[Migration] = [
+    (1, "create missing tables", create_missing_tables),
+    (2, "link order lines to their order", link_order_lines),
+    (3, "add product stock and order reservations", add_stock_and_reservations),
+    (4, "create foreign key and lookup indexes", create_indexes),
+    (5, "add the payment status of the orders", add_payment_status),
+    (6, "retry the payment jobs later", add_payment_retries),
+    (7, "store the version of the orders", add_order_versions),
+    (8, "lease the idempotency keys being processed", add_idempotency_leases),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version() -> int:
+    return db.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def stamp(version: int = LATEST_VERSION):
+    "Record the schema version, for databases just created with the current models."
+    db.execute_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate() -> list[Migration]:
+    """Apply the migrations newer than the schema version of the database, each in its
+    own transaction.
+
+    Returns:
+        list[Migration]: The migrations applied.
+    """
+    migrator = SqliteMigrator(db)
+    current = schema_version()
+    applied = []
+    for migration in MIGRATIONS:
+        version, description, step = migration
+        if version <= current:
+            continue
+        logger.info("migrating the database to version %d: %s", version, description)
+        with db.atomic():
+            step(migrator)
+            stamp(version)
+        applied.append(migration)
+    return applied
+
+
+def hot_queries() -> dict[str, Query]:
+    "The queries run on every request or by the background workers, with sample parameters."
+    now = datetime.now()
+    return {
+        "get order": order_query(1),
+        "order lines": ProductOrderQuantity.select().where(ProductOrderQuantity.oid == 1),
+        "product orders": ProductOrderQuantity.select().where(
+            ProductOrderQuantity.pid == 1
+        ),
+        "orders shipped there": Order.select().where(Order.shipping_information == 1),
+        "order of a card": Order.select().where(Order.credit_card == 1),
+        "order of a transaction": Order.select().where(Order.transaction == "x"),
+        "expired reservations": Order.select(Order.id).where(
+            (Order.paid == False) & (Order.reserved_until < now)  # noqa: E712
+        ),
+        "pending payment": PaymentJob.select().where(
+            (PaymentJob.order == 1)
+            & PaymentJob.status.in_([PaymentJob.PENDING, PaymentJob.RUNNING])
+        ),
+        "next payment job": PaymentJob.select()
+        .where(
+            (PaymentJob.status == PaymentJob.PENDING)
+            & (PaymentJob.run_after.is_null() | (PaymentJob.run_after <= now))
+        )
+        .order_by(PaymentJob.id)
+        .limit(1),
+        "stale payment jobs": PaymentJob.select().where(
+            (PaymentJob.status == PaymentJob.RUNNING) & (PaymentJob.claimed_at < now)
+        ),
+        "expired idempotency keys": IdempotencyKey.select().where(
+            IdempotencyKey.expires_at <= now
+        ),
+        "products in stock": product_query(in_stock=True),
+    }
+
+
+def check_query_plans() -> dict[str, list[str]]:
+    """Run EXPLAIN QUERY PLAN on the hot queries and find those scanning a whole table.
+
+    Returns:
+        dict[str, list[str]]: Steps of the plans scanning a table, by query name; empty
+            if every query uses an index.
+    """
+    problems = {}
+    for name, query in hot_queries().items():
+        sql, params = query.sql()
+        plan = [row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)]
+        scans = [step for step in plan if step.startswith("SCAN ") and " USING " not in step]
+        if scans:
+            problems[name] = scans
+    return problems
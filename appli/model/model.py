@@ -1,18 +1,34 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
 from random import randint
+from threading import Lock
+from typing import Iterable, Iterator
 from peewee import (
+    BlobField,
+    Case,
     CharField,
     BooleanField,
+    DateTimeField,
     TextField,
     DecimalField,
     IntegerField,
     Model,
     Check,
     ForeignKeyField,
+    JOIN,
+    Query,
+    fn,
 )
 
-from appli.services.external.chargingapi import charge
+from appli.config import DefaultConfig
+from appli.services.external.chargingapi import PaymentOutcomeUnknown, charge
 from appli.extensions import db
-from appli.utils.json import serialize_order
+from appli.utils.json import serialize_product
+from appli.utils.json_provider import dumps_bytes
+from appli.utils.pricing import price_order, to_amount
+from appli.utils.pubsub import Channel
 from .flat import (
     FlatProduct,
     FlatShippingInformation,
@@ -32,9 +48,19 @@ class Product(Model):
     )
     weight = IntegerField(null=True, constraints=[Check("weight > 0")])
     image = CharField()
+    # units left to order, counting those reserved by unpaid orders as gone
+    stock = IntegerField(
+        default=DefaultConfig.PRODUCT_INITIAL_STOCK, constraints=[Check("stock >= 0")]
+    )
 
     class Meta:
         database = db
+        # filters of the paginated product listing, all walked in ID order
+        indexes = (
+            (("in_stock", "id"), False),
+            (("price", "id"), False),
+            (("weight", "id"), False),
+        )
 
     def flatten(self) -> FlatProduct:
         """Convert this object to a flat dataclass, cutting every link with the database."""
@@ -42,9 +68,9 @@ class Product(Model):
             id=self.get_id(),
             name=str(self.name),
             in_stock=bool(self.in_stock),
-            description=str(self.description),
+            description=_optional_str(self.description),
             price=float(self.price),
-            weight=self.weight and int(self.weight),
+            weight=_optional_int(self.weight),
             image=str(self.image),
         )
 
@@ -71,23 +97,6 @@ class ShippingInformation(Model):
         )
 
 
-class ProductOrderQuantity(Model):
-    "Links a product to its quantity for an order."
-    # TODO: uncomment line below and move class definition to have multiple products per order (next version)
-    # oid = ForeignKeyField(Order, backref='products')
-    pid = ForeignKeyField(Product, backref="order_quantities")
-    quantity = IntegerField(constraints=[Check("quantity > 0")])
-
-    class Meta:
-        database = db
-
-    def flatten(self) -> FlatProductOrderQuantity:
-        """Convert this object to a flat dataclass, cutting every link with the database."""
-        return FlatProductOrderQuantity(
-            id=self.get_id(), product=self.pid.flatten(), quantity=int(self.quantity)
-        )
-
-
 class CreditCardDetails(Model):
     name = CharField()
     number = DecimalField(max_digits=16, decimal_places=0)
@@ -132,7 +141,13 @@ class Transaction(Model):
 
 
 class Order(Model):
-    product = ForeignKeyField(ProductOrderQuantity)
+    # statuses of the payment while it has no transaction
+    PAYMENT_PENDING = "pending"
+    PAYMENT_RETRYING = "retrying"
+    PAYMENT_FAILED = "failed"
+    # charge sent without knowing whether it went through, to reconcile with the gateway
+    PAYMENT_UNKNOWN = "unknown"
+
     email = CharField(null=True)
     credit_card = ForeignKeyField(CreditCardDetails, null=True)
     shipping_information = ForeignKeyField(
@@ -140,6 +155,14 @@ class Order(Model):
     )
     transaction = ForeignKeyField(Transaction, null=True)
     paid = BooleanField(default=False)
+    # stock of the products held for the order until then, None once released
+    reserved_until = DateTimeField(null=True, index=True)
+    # problem with the last payment attempt, None if there was none
+    payment_status = CharField(null=True)
+    payment_error = TextField(null=True)
+    # bumped by every write changing the representation of the order, in the same
+    # transaction: the ETag and the cached responses of every process are keyed on it
+    version = IntegerField(default=0)
 
     class Meta:
         database = db
@@ -148,22 +171,178 @@ class Order(Model):
         """Convert this object to a flat dataclass, cutting every link with the database."""
         return FlatOrder(
             id=self.get_id(),
-            products=self.product.flatten(),
+            products=[line.flatten() for line in self.products],
             email=self.email and str(self.email),
             credit_card=self.credit_card and self.credit_card.flatten(),
             shipping_information=self.shipping_information
             and self.shipping_information.flatten(),
             transaction=self.transaction and self.transaction.flatten(),
             paid=bool(self.paid),
+            payment_status=self.payment_status,
+            payment_error=self.payment_error,
         )
 
 
+class ProductOrderQuantity(Model):
+    "Links a product to its quantity for an order."
+    oid = ForeignKeyField(Order, backref="products")
+    pid = ForeignKeyField(Product, backref="order_quantities")
+    quantity = IntegerField(constraints=[Check("quantity > 0")])
+
+    class Meta:
+        database = db
+
+    def flatten(self) -> FlatProductOrderQuantity:
+        """Convert this object to a flat dataclass, cutting every link with the database."""
+        return FlatProductOrderQuantity(
+            id=self.get_id(), product=self.pid.flatten(), quantity=int(self.quantity)
+        )
+
+
+@dataclass(frozen=True)
+class Catalog:
+    "Immutable snapshot of the product table, swapped as a whole on every reload."
+    version: int = 0
+    products: dict[int, FlatProduct] = field(default_factory=dict)
+    body: bytes = b'{"products": []}'
+
+
+class CatalogCache:
+    "In-process product catalog, so that reading products never hits the database."
+
+    def __init__(self):
+        self._catalog = Catalog()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def current(self) -> Catalog:
+        "Catalog currently served (a single reference read, always consistent)."
+        return self._catalog
+
+    def reload(self) -> Catalog:
+        """Rebuild the catalog from the database and swap it in.
+
+        Returns:
+            Catalog: The new catalog.
+        """
+        with self._lock:  # a slow reload must not swap in an older snapshot
+            products = {
+                row[0]: _product_from_row(row)
+                for row in _raw_rows(Product.select(*_LISTED_FIELDS))
+            }
+            body = dumps_bytes(
+                {"products": [serialize_product(p) for p in products.values()]}
+            )
+            self._catalog = Catalog(
+                version=self._catalog.version + 1, products=products, body=body
+            )
+            return self._catalog
+
+    def get(self, product_id: int) -> FlatProduct | None:
+        product = self._catalog.products.get(product_id)
+        if product is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return product
+
+
+catalog = CatalogCache()
+
+
+def reload_catalog() -> Catalog:
+    "Refresh the in-process catalog, to be called every time the products table changes."
+    return catalog.reload()
+
+
 def get_product(product_id: int) -> FlatProduct:
-    return Product.get_by_id(product_id).flatten()
+    product = catalog.get(product_id)
+    if product is None:
+        raise Product.DoesNotExist(f"no product with id {product_id}")
+    return product
+
+
+def get_products_body() -> bytes:
+    "Product list, already serialized as the body of a JSON response."
+    return catalog.current.body
+
+
+def _optional_str(value) -> str | None:
+    return None if value is None else str(value)
+
+
+def _optional_int(value) -> int | None:
+    return None if value is None else int(value)
+
 
+PRODUCT_FIELDS = ("id", "name", "in_stock", "description", "price", "weight", "image")
+# the same for every path reading products, so that they all give the same JSON
+_PRODUCT_CONVERTERS = {
+    "id": int,
+    "name": str,
+    "in_stock": bool,
+    "description": _optional_str,
+    "price": float,
+    "weight": _optional_int,
+    "image": str,
+}
 
-def get_products() -> list[dict]:
-    return list(map(lambda p: p.flatten(), Product.select()))
+
+def product_query(
+    after: int | None = None,
+    limit: int = 50,
+    fields: tuple[str, ...] = PRODUCT_FIELDS,
+    in_stock: bool | None = None,
+    min_price: float | None = None,
+    max_price: float | None = None,
+    min_weight: int | None = None,
+    max_weight: int | None = None,
+) -> Query:
+    "Query of query_products, filtering and projecting in SQL."
+    columns = [_AVAILABLE if f == "in_stock" else getattr(Product, f) for f in fields]
+    query = Product.select(*columns).order_by(Product.id).limit(limit)
+    if after is not None:
+        query = query.where(Product.id > after)
+    if in_stock is not None:
+        query = query.where(_AVAILABLE if in_stock else ~_AVAILABLE)
+    if min_price is not None:
+        query = query.where(Product.price >= min_price)
+    if max_price is not None:
+        query = query.where(Product.price <= max_price)
+    if min_weight is not None:
+        query = query.where(Product.weight >= min_weight)
+    if max_weight is not None:
+        query = query.where(Product.weight <= max_weight)
+    return query
+
+
+def query_products(
+    after: int | None = None,
+    limit: int = 50,
+    fields: tuple[str, ...] = PRODUCT_FIELDS,
+    **filters,
+) -> list[dict]:
+    """Page through the products in ID order, filtering and projecting in SQL.
+
+    Args:
+        after (int | None, optional): Return products with an ID greater than this one.
+        limit (int, optional): Maximum number of products. Defaults to 50.
+        fields (tuple[str, ...], optional): Columns to return, among PRODUCT_FIELDS.
+        in_stock (bool | None, optional): Keep only products (not) in stock.
+        min_price, max_price (float | None, optional): Inclusive price range.
+        min_weight, max_weight (int | None, optional): Inclusive weight range.
+
+    Returns:
+        list[dict]: The products, with only the requested fields.
+    """
+    query = product_query(after, limit, fields, **filters)
+    converters = [_PRODUCT_CONVERTERS[f] for f in fields]
+    return [
+        {f: convert(v) for f, convert, v in zip(fields, converters, row)}
+        for row in query.tuples()
+    ]
 
 
 def add_product(product: FlatProduct):
@@ -177,30 +356,676 @@ def add_product(product: FlatProduct):
     ).save(force_insert=True)
 
 
-def drop_products():
-    Product.delete().execute()
+@dataclass
+class CatalogSyncReport:
+    "Number of products touched by a catalog sync."
+    inserted: int = 0
+    updated: int = 0
+    removed: int = 0
+    # gone upstream but still in orders: kept, out of stock
+    retired: int = 0
+    # in stock upstream, stock topped up to the initial stock
+    restocked: int = 0
+
+
+_PRODUCT_FIELDS = [
+    Product.id,
+    Product.name,
+    Product.in_stock,
+    Product.description,
+    Product.price,
+    Product.weight,
+    Product.image,
+]
+
+# in stock upstream and with units left to order, what the listings call in stock
+_AVAILABLE = (Product.in_stock == True) & (Product.stock > 0)  # noqa: E712
+# _PRODUCT_FIELDS as the listings show them
+_LISTED_FIELDS = [*_PRODUCT_FIELDS[:2], _AVAILABLE, *_PRODUCT_FIELDS[3:]]
+
+
+def _raw_rows(query: Query):
+    """Run a query and return the cursor, its rows left as sqlite3 gives them.
+
+    Hydrating a flat dataclass converts every column anyway: going through Model
+    objects or through the field converters of .tuples() would only allocate more.
+    """
+    return db.execute(query)
+
+
+def _product_from_row(row: tuple) -> FlatProduct:
+    "Flat product from the columns of _PRODUCT_FIELDS, same as Product.flatten()."
+    id, name, in_stock, description, price, weight, image = row
+    return FlatProduct(
+        id=id,
+        name=str(name),
+        in_stock=bool(in_stock),
+        description=_optional_str(description),
+        price=float(price),
+        weight=_optional_int(weight),
+        image=str(image),
+    )
+
+
+def _product_row(
+    id: int, name, in_stock, description, price, weight, image
+) -> tuple:
+    "Normalize product columns so that upstream and stored products compare equal."
+    return (
+        id,
+        str(name),
+        bool(in_stock),
+        _optional_str(description),
+        float(price),
+        _optional_int(weight),
+        str(image),
+    )
+
+
+def sync_products(
+    products: list[FlatProduct],
+    batch_size: int = 100,
+    initial_stock: int = DefaultConfig.PRODUCT_INITIAL_STOCK,
+) -> CatalogSyncReport:
+    """Make the products table match the upstream catalog, writing only what changed.
+
+    Products are keyed by their upstream ID, so the IDs referenced by orders stay valid.
+    A product gone upstream is deleted only if no order has it, else it is kept and
+    marked out of stock. The orders of a product whose price or weight changed get a
+    new version, their prices having changed too.
+
+    The products API only says whether a product is in stock: the stock of those in
+    stock upstream is topped up to the initial stock, so that selling them out here
+    doesn't keep them out of stock for good.
+
+    Args:
+        products (list[FlatProduct]): Upstream catalog.
+        batch_size (int, optional): Rows per INSERT statement. Defaults to 100.
+        initial_stock (int, optional): Stock of the products in stock upstream.
+
+    Returns:
+        CatalogSyncReport: How many products were inserted, updated, removed, retired
+            and restocked.
+    """
+    existing = {}
+    stock = {}
+    rows = Product.select(*_PRODUCT_FIELDS, Product.stock).tuples().iterator()
+    for *row, units in rows:
+        existing[row[0]] = _product_row(*row)
+        stock[row[0]] = units
+    wanted = {
+        p.id: _product_row(
+            p.id, p.name, p.in_stock, p.description, p.price, p.weight, p.image
+        )
+        for p in products
+    }
+    report = CatalogSyncReport()
+    changed = []
+    repriced = []
+    for pid, row in wanted.items():
+        current = existing.get(pid)
+        if current is None:
+            report.inserted += 1
+            changed.append(row)
+        elif current != row:
+            report.updated += 1
+            changed.append(row)
+            if current[4:6] != row[4:6]:  # price, weight
+                repriced.append(pid)
+    gone = [pid for pid in existing if pid not in wanted]
+    restocked = [
+        pid
+        for pid, row in wanted.items()
+        if row[2] and stock.get(pid, initial_stock) < initial_stock
+    ]
+    report.restocked = len(restocked)
+
+    with db.atomic():
+        ordered = set()
+        for i in range(0, len(gone), batch_size):
+            ordered.update(
+                pid
+                for (pid,) in ProductOrderQuantity.select(ProductOrderQuantity.pid)
+                .where(ProductOrderQuantity.pid.in_(gone[i : i + batch_size]))
+                .distinct()
+                .tuples()
+            )
+        removed = [pid for pid in gone if pid not in ordered]
+        retired = [pid for pid in ordered if existing[pid][2]]  # still in stock
+        report.removed = len(removed)
+        report.retired = len(retired)
+        for i in range(0, len(changed), batch_size):
+            Product.insert_many(
+                [(*row, initial_stock) for row in changed[i : i + batch_size]],
+                fields=[*_PRODUCT_FIELDS, Product.stock],
+            ).on_conflict(
+                conflict_target=[Product.id], preserve=_PRODUCT_FIELDS[1:]
+            ).execute()
+        for i in range(0, len(removed), batch_size):
+            Product.delete().where(
+                Product.id.in_(removed[i : i + batch_size])
+            ).execute()
+        for i in range(0, len(retired), batch_size):
+            Product.update(in_stock=False).where(
+                Product.id.in_(retired[i : i + batch_size])
+            ).execute()
+        for i in range(0, len(restocked), batch_size):
+            Product.update(stock=initial_stock).where(
+                Product.id.in_(restocked[i : i + batch_size])
+            ).execute()
+        versions = []
+        for i in range(0, len(repriced), batch_size):
+            lines = ProductOrderQuantity.select(ProductOrderQuantity.oid).where(
+                ProductOrderQuantity.pid.in_(repriced[i : i + batch_size])
+            )
+            versions.extend(
+                _raw_rows(
+                    Order.update(version=Order.version + 1)
+                    .where(Order.id.in_(lines))
+                    .returning(Order.id, Order.version)
+                )
+            )
+    for order_id, version in versions:
+        order_changed(order_id, version)
+    return report
+
+
+class OutOfInventory(Exception):
+    "A product of a new order is not in stock."
+
+    def __init__(self, product_id: int):
+        super().__init__(f"product {product_id} is not in stock")
+        self.product_id = product_id
+
 
+class UnknownProduct(Product.DoesNotExist):
+    "A product of a new order does not exist."
 
-def add_order(order: FlatOrder) -> FlatOrder:
-    poq = ProductOrderQuantity(
-        pid=Product.get(id=order.products.product.id), quantity=order.products.quantity
+    def __init__(self, product_id: int):
+        super().__init__(f"no product with id {product_id}")
+        self.product_id = product_id
+
+
+def _insert_ids(model: type[Model], rows: list[dict], batch_size: int) -> list[int]:
+    ids = []
+    for i in range(0, len(rows), batch_size):
+        inserted = (
+            model.insert_many(rows[i : i + batch_size])
+            .returning(model.id)
+            .tuples()
+            .execute()
+        )
+        # rowids are given in the order of the VALUES, RETURNING's order is unspecified
+        ids.extend(sorted(row[0] for row in inserted))
+    return ids
+
+
+RESERVATION_TTL = timedelta(seconds=DefaultConfig.ORDER_RESERVATION_TTL)
+
+
+def _reserve(quantities: dict[int, int]) -> dict[int, FlatProduct]:
+    """Take some quantity of each product out of the stock, all or nothing.
+
+    A single conditional UPDATE checks and decrements the stock of every product, so
+    that concurrent orders can't both get the last units. Must run in a transaction,
+    rolled back by the exceptions raised here.
+
+    Args:
+        quantities (dict[int, int]): Quantity of each product, by product ID.
+
+    Raises:
+        UnknownProduct: A product does not exist.
+        OutOfInventory: A product is not in stock, or not in this quantity.
+
+    Returns:
+        dict[int, FlatProduct]: The products, by ID, not in stock if none are left.
+    """
+    amounts = Case(Product.id, list(quantities.items()))
+    rows = _raw_rows(
+        Product.update(stock=Product.stock - amounts)
+        .where(
+            Product.id.in_(list(quantities))
+            & (Product.in_stock == True)  # noqa: E712
+            & (Product.stock >= amounts)
+        )
+        .returning(*_LISTED_FIELDS)
     )
-    poq.save()
-    new_order = Order(product=poq)
-    new_order.save()
-    return new_order.flatten()
+    products = {row[0]: _product_from_row(row) for row in rows}
+    if len(products) < len(quantities):
+        missing = [pid for pid in quantities if pid not in products]
+        existing = {
+            pid
+            for (pid,) in Product.select(Product.id)
+            .where(Product.id.in_(missing))
+            .tuples()
+        }
+        for product_id in missing:
+            if product_id not in existing:
+                raise UnknownProduct(product_id)
+        raise OutOfInventory(missing[0])
+    return products
+
+
+def _sold_out(products: Iterable[FlatProduct]):
+    "Reload the catalog once a reservation took the last units of a product."
+    if not all(p.in_stock for p in products):
+        reload_catalog()
+
+
+def add_order(
+    quantities: dict[int, int],
+    reserved_for: timedelta = RESERVATION_TTL,
+    batch_size: int = 500,
+) -> FlatOrder:
+    """Create an order for some quantity of each product, reserving them in the stock.
+
+    The stock of all the products is checked and reserved with a single statement and
+    all the lines are written with a single insert, in the same transaction, so that
+    the size of the basket doesn't change the number of round-trips.
+
+    Args:
+        quantities (dict[int, int]): Quantity ordered of each product, by product ID.
+        reserved_for (timedelta, optional): How long the stock is held if the order
+            isn't paid.
+        batch_size (int, optional): Lines per INSERT statement. Defaults to 500.
+
+    Raises:
+        UnknownProduct: A product does not exist.
+        OutOfInventory: A product is not in stock, or not in this quantity.
+
+    Returns:
+        FlatOrder: The new order.
+    """
+    with db.atomic("IMMEDIATE"):
+        products = _reserve(quantities)
+        order_id = Order.insert(
+            paid=False, reserved_until=datetime.now() + reserved_for
+        ).execute()
+        line_ids = _insert_ids(
+            ProductOrderQuantity,
+            [
+                {"oid": order_id, "pid": product_id, "quantity": quantity}
+                for product_id, quantity in quantities.items()
+            ],
+            batch_size,
+        )
+    _sold_out(products.values())
+    return FlatOrder(
+        id=order_id,
+        products=[
+            FlatProductOrderQuantity(
+                id=line_id, product=products[product_id], quantity=quantity
+            )
+            for line_id, (product_id, quantity) in zip(line_ids, quantities.items())
+        ],
+    )
+
+
+def add_orders(
+    orders: list[FlatOrder],
+    reserved_for: timedelta = RESERVATION_TTL,
+    batch_size: int = 500,
+) -> list[FlatOrder | None]:
+    """Insert many orders at once, in a single transaction with multi-row inserts.
+
+    The stock is read once and handed out to the orders in their order; those that
+    can't be served entirely are not created.
+
+    Args:
+        orders (list[FlatOrder]): New orders, with their products and quantities.
+        reserved_for (timedelta, optional): How long the stock is held if an order
+            isn't paid.
+        batch_size (int, optional): Rows per statement. Defaults to 500.
+
+    Returns:
+        list[FlatOrder | None]: In the same order, each order with its IDs, or None
+            if there wasn't enough stock for it.
+    """
+    if not orders:
+        return []
+    with db.atomic("IMMEDIATE"):  # nobody else takes stock until the commit
+        product_ids = list({line.product.id for o in orders for line in o.products})
+        stock: dict[int, int] = {}
+        for i in range(0, len(product_ids), batch_size):
+            stock.update(
+                Product.select(Product.id, Product.stock)
+                .where(
+                    Product.id.in_(product_ids[i : i + batch_size])
+                    & (Product.in_stock == True)  # noqa: E712
+                )
+                .tuples()
+            )
+        accepted: list[FlatOrder] = []
+        taken: dict[int, int] = {}
+        for o in orders:
+            needed: dict[int, int] = {}
+            for line in o.products:
+                needed[line.product.id] = needed.get(line.product.id, 0) + line.quantity
+            if all(stock.get(pid, 0) >= quantity for pid, quantity in needed.items()):
+                for pid, quantity in needed.items():
+                    stock[pid] -= quantity
+                    taken[pid] = taken.get(pid, 0) + quantity
+                accepted.append(o)
+        taken_items = list(taken.items())
+        for i in range(0, len(taken_items), batch_size):
+            batch = taken_items[i : i + batch_size]
+            Product.update(stock=Product.stock - Case(Product.id, batch)).where(
+                Product.id.in_([pid for pid, _ in batch])
+            ).execute()
+        reserved_until = datetime.now() + reserved_for
+        order_ids = _insert_ids(
+            Order,
+            [{"paid": False, "reserved_until": reserved_until}] * len(accepted),
+            batch_size,
+        )
+        line_ids = iter(
+            _insert_ids(
+                ProductOrderQuantity,
+                [
+                    {"oid": order_id, "pid": line.product.id, "quantity": line.quantity}
+                    for order_id, o in zip(order_ids, accepted)
+                    for line in o.products
+                ],
+                batch_size,
+            )
+        )
+    created = {
+        id(o): FlatOrder(
+            id=order_id,
+            products=[
+                FlatProductOrderQuantity(
+                    id=next(line_ids), product=line.product, quantity=line.quantity
+                )
+                for line in o.products
+            ],
+        )
+        for o, order_id in zip(accepted, order_ids)
+    }
+    if any(stock[pid] == 0 for pid in taken):
+        reload_catalog()
+    return [created.get(id(o)) for o in orders]
+
+
+def release_expired_reservations(now: datetime | None = None) -> int:
+    """Give back to the stock the products of the unpaid orders whose reservation expired.
+
+    Args:
+        now (datetime | None, optional): Current time, for tests.
+
+    Returns:
+        int: Number of orders released.
+    """
+    expired = (Order.paid == False) & (Order.reserved_until < (now or datetime.now()))  # noqa: E712
+    released = (
+        ProductOrderQuantity.select(fn.SUM(ProductOrderQuantity.quantity))
+        .join(Order)
+        .where(expired & (ProductOrderQuantity.pid == Product.id))
+    )
+    with db.atomic("IMMEDIATE"):
+        Product.update(stock=Product.stock + released).where(
+            Product.id.in_(
+                ProductOrderQuantity.select(ProductOrderQuantity.pid)
+                .join(Order)
+                .where(expired)
+            )
+        ).execute()
+        count = Order.update(reserved_until=None).where(expired).execute()
+    if count:  # products sold out may be back in stock
+        reload_catalog()
+    return count
+
+
+def reserve_order(order_id: int, reserved_for: timedelta = RESERVATION_TTL):
+    """Make sure the stock of an order is held before it is charged.
+
+    The reservation is extended if it still holds, else the products are reserved
+    again, if there is still enough stock.
+
+    Args:
+        order_id (int): Order ID.
+        reserved_for (timedelta, optional): How long the stock is held from now.
+
+    Raises:
+        OutOfInventory: The reservation was released and a product is no longer in
+            stock in this quantity.
+    """
+    reserved_until = datetime.now() + reserved_for
+    if (
+        Order.update(reserved_until=reserved_until)
+        .where((Order.id == order_id) & Order.reserved_until.is_null(False))
+        .execute()
+    ):
+        return
+    with db.atomic("IMMEDIATE"):
+        quantities = dict(
+            ProductOrderQuantity.select(
+                ProductOrderQuantity.pid, ProductOrderQuantity.quantity
+            )
+            .where(ProductOrderQuantity.oid == order_id)
+            .tuples()
+        )
+        try:
+            products = _reserve(quantities)
+        except UnknownProduct as e:  # removed from the catalog since
+            raise OutOfInventory(e.product_id) from e
+        Order.update(reserved_until=reserved_until).where(
+            Order.id == order_id
+        ).execute()
+    _sold_out(products.values())
 
 
 class OrderNotFound(Exception):
     pass
 
 
+class PaymentBeingReconciled(Exception):
+    "A charge of the order has an unknown outcome: charging it again could bill twice."
+
+    def __init__(self, order_id: int):
+        super().__init__(f"the payment of order {order_id} is being reconciled")
+        self.order_id = order_id
+
+
+def order_version(order_id: int) -> int | None:
+    "Current version of an order, None if it does not exist."
+    return Order.select(Order.version).where(Order.id == order_id).scalar()
+
+
+def _update_order(where, **fields) -> int | None:
+    """Update an order and bump its version in the same statement.
+
+    Returns:
+        int | None: The new version, None if no order matched.
+    """
+    row = _raw_rows(
+        Order.update(version=Order.version + 1, **fields)
+        .where(where)
+        .returning(Order.version)
+    ).fetchone()
+    return row and row[0]
+
+
+# new version of each order, published after every committed change to it
+order_events = Channel()
+
+
+def order_changed(order_id: int, version: int):
+    "Tell the subscribers of this process about a committed change to an order."
+    order_events.publish(order_id, version)
+
+
+_ORDER_COLUMNS = (
+    Order.id,
+    Order.email,
+    Order.paid,
+    CreditCardDetails.id,
+    CreditCardDetails.name,
+    CreditCardDetails.number,
+    CreditCardDetails.expiration_year,
+    CreditCardDetails.cvv,
+    CreditCardDetails.expiration_month,
+    ShippingInformation.id,
+    ShippingInformation.country,
+    ShippingInformation.address,
+    ShippingInformation.postal_code,
+    ShippingInformation.city,
+    ShippingInformation.province,
+    Transaction.id,
+    Transaction.success,
+    Transaction.amount_charged,
+    ProductOrderQuantity.id,
+    ProductOrderQuantity.quantity,
+    Product.id,
+    Product.name,
+    Product.in_stock,
+    Product.description,
+    Product.price,
+    Product.weight,
+    Product.image,
+    Order.payment_status,
+    Order.payment_error,
+)
+
+
+def _line_from_row(
+    row: tuple, products: dict[int, FlatProduct]
+) -> FlatProductOrderQuantity:
+    product = products.get(row[20])
+    if product is None:
+        product = products[row[20]] = _product_from_row(row[20:27])
+    return FlatProductOrderQuantity(id=row[18], product=product, quantity=int(row[19]))
+
+
+def _order_from_rows(
+    rows: list[tuple], products: dict[int, FlatProduct] | None = None
+) -> FlatOrder:
+    """Build a flat order from its rows selected with _ORDER_COLUMNS, one per line.
+
+    Args:
+        rows (list[tuple]): Order rows joined with all of their related rows.
+        products (dict[int, FlatProduct] | None, optional): Products already built,
+            by ID, shared by the lines of the same product (they are frozen).
+
+    Returns:
+        FlatOrder: Flat order, same as Order.flatten() would give.
+    """
+    if products is None:
+        products = {}
+    row = rows[0]
+    oid, email, paid = row[0:3]
+    cc_id, cc_name, cc_number, cc_year, cc_cvv, cc_month = row[3:9]
+    si_id, si_country, si_address, si_postal_code, si_city, si_province = row[9:15]
+    tr_id, tr_success, tr_amount = row[15:18]
+    return FlatOrder(
+        id=oid,
+        products=[
+            _line_from_row(row, products) for row in rows if row[18] is not None
+        ],
+        email=email and str(email),
+        credit_card=cc_id
+        and FlatCreditCardDetails(
+            id=cc_id,
+            name=str(cc_name),
+            number=int(cc_number),
+            expiration_year=int(cc_year),
+            cvv=int(cc_cvv),
+            expiration_month=int(cc_month),
+        ),
+        shipping_information=si_id
+        and FlatShippingInformation(
+            id=si_id,
+            country=str(si_country),
+            address=str(si_address),
+            postal_code=str(si_postal_code),
+            city=str(si_city),
+            province=str(si_province),
+        ),
+        transaction=tr_id
+        and FlatTransaction(
+            id=str(tr_id), success=bool(tr_success), amount_charged=float(tr_amount)
+        ),
+        paid=bool(paid),
+        payment_status=row[27],
+        payment_error=row[28],
+    )
+
+
+def _orders_from_rows(rows: Iterable[tuple]) -> Iterator[FlatOrder]:
+    "Flat orders from rows selected with _ORDER_COLUMNS, those of each order adjacent."
+    products: dict[int, FlatProduct] = {}
+    for _, order_rows in groupby(rows, key=itemgetter(0)):
+        yield _order_from_rows(list(order_rows), products)
+
+
+def order_query(order_id: int | None = None) -> Query:
+    """Query of load_order: the order joined with its lines and related rows.
+
+    Args:
+        order_id (int | None, optional): Order ID, None for every order in ID order.
+    """
+    query = (
+        Order.select(*_ORDER_COLUMNS)
+        .join_from(Order, CreditCardDetails, JOIN.LEFT_OUTER)
+        .join_from(Order, ShippingInformation, JOIN.LEFT_OUTER)
+        .join_from(Order, Transaction, JOIN.LEFT_OUTER)
+        .join_from(Order, ProductOrderQuantity, JOIN.LEFT_OUTER)
+        .join_from(ProductOrderQuantity, Product, JOIN.LEFT_OUTER)
+    )
+    if order_id is None:
+        return query.order_by(Order.id, ProductOrderQuantity.id)
+    return query.where(Order.id == order_id).order_by(ProductOrderQuantity.id)
+
+
+def load_order(order_id: int) -> FlatOrder | None:
+    """Fetch an order, its lines and all of its related rows in a single query.
+
+    Args:
+        order_id (int): Order ID.
+
+    Returns:
+        FlatOrder | None: The flat order, or None if it does not exist.
+    """
+    rows = _raw_rows(order_query(order_id)).fetchall()
+    return _order_from_rows(rows) if rows else None
+
+
+def load_orders() -> Iterator[FlatOrder]:
+    "Every order with its lines and related rows, in ID order, from a single query."
+    return _orders_from_rows(_raw_rows(order_query()))
+
+
+def order_price_columns() -> tuple[list, list, list, list, list]:
+    """Columns of every order line needed to price the orders in bulk, in order ID order.
+
+    Returns:
+        tuple[list, list, list, list, list]: Order ID, unit price, quantity, unit weight
+            and shipping province of each line, an order without lines having a single
+            line of price, quantity and weight 0.
+    """
+    no_line = ProductOrderQuantity.id.is_null()
+    query = (
+        Order.select(
+            Order.id,
+            Case(None, [(no_line, 0)], Product.price),
+            Case(None, [(no_line, 0)], ProductOrderQuantity.quantity),
+            Case(None, [(no_line, 0)], Product.weight),
+            ShippingInformation.province,
+        )
+        .join_from(Order, ShippingInformation, JOIN.LEFT_OUTER)
+        .join_from(Order, ProductOrderQuantity, JOIN.LEFT_OUTER)
+        .join_from(ProductOrderQuantity, Product, JOIN.LEFT_OUTER)
+        .order_by(Order.id)
+    )
+    columns = tuple(map(list, zip(*_raw_rows(query))))
+    return columns or ([], [], [], [], [])
+
+
 def get_order(order_id: int) -> FlatOrder:
-    order: Order | None = Order.get_or_none(order_id)
+    order = load_order(order_id)
     if order is None:
         raise OrderNotFound()
 
-    return order.flatten()
+    return order
 
 
 def put_order_shipping_information(
@@ -211,28 +1036,28 @@ def put_order_shipping_information(
         raise OrderNotFound()
 
     si = order.shipping_information
-    if si is None:  # no shipping information yet, create it
-        si = ShippingInformation(
-            country=shipping_information.country,
-            address=shipping_information.address,
-            postal_code=shipping_information.postal_code,
-            city=shipping_information.city,
-            province=shipping_information.province,
+    with db.atomic():
+        if si is None:  # no shipping information yet, create it
+            si = ShippingInformation(
+                country=shipping_information.country,
+                address=shipping_information.address,
+                postal_code=shipping_information.postal_code,
+                city=shipping_information.city,
+                province=shipping_information.province,
+            )
+            si.save()
+        else:  # shipping information exists, update it
+            si.country = shipping_information.country
+            si.address = shipping_information.address
+            si.postal_code = shipping_information.postal_code
+            si.city = shipping_information.city
+            si.province = shipping_information.province
+            si.save()
+        version = _update_order(
+            Order.id == order_id, shipping_information=si, email=email
         )
-        si.save()
-        order.shipping_information = si
-        order.email = email
-        order.save()
-    else:  # shipping information exists, update it
-        si.country = shipping_information.country
-        si.address = shipping_information.address
-        si.postal_code = shipping_information.postal_code
-        si.city = shipping_information.city
-        si.province = shipping_information.province
-        si.save()
-        order.email = email
-        order.save()
 
+    order_changed(order_id, version)
     return get_order(order_id)
 
 
@@ -254,9 +1079,16 @@ def invalid_uuid_generator() -> str:
     return result
 
 
-def put_order_credit_card(
-    order_id: int, credit_card: FlatCreditCardDetails
-) -> FlatOrder:
+def set_order_credit_card(order_id: int, credit_card: FlatCreditCardDetails):
+    """Store the credit card of an order, without charging it.
+
+    Args:
+        order_id (int): Order ID.
+        credit_card (FlatCreditCardDetails): Card to store.
+
+    Raises:
+        OrderNotFound: The order does not exist.
+    """
     order: Order | None = Order.get_or_none(order_id)
     if order is None:
         raise OrderNotFound()
@@ -273,8 +1105,9 @@ def put_order_credit_card(
                 expiration_month=credit_card.expiration_month,
             )
             existing_credit_card.save()
-            order.credit_card = existing_credit_card
-            order.save()
+            version = _update_order(
+                Order.id == order_id, credit_card=existing_credit_card
+            )
         else:  # card exists, update it
             existing_credit_card.name = credit_card.name
             existing_credit_card.number = credit_card.number
@@ -282,18 +1115,47 @@ def put_order_credit_card(
             existing_credit_card.cvv = credit_card.cvv
             existing_credit_card.expiration_month = credit_card.expiration_month
             existing_credit_card.save()
+            version = _update_order(Order.id == order_id)
         db.commit()
+    order_changed(order_id, version)
 
-    flat_order = order.flatten()
-    order_dict = serialize_order(flat_order)
-    charging_results = charge(
-        credit_card.name,
-        credit_card.number,
-        credit_card.expiration_year,
-        str(credit_card.cvv),
-        credit_card.expiration_month,
-        order_dict["order"]["total_price_tax"] + order_dict["order"]["shipping_price"],
-    )
+
+def charge_order(order_id: int) -> FlatOrder:
+    """Charge the credit card stored on an order and record the transaction.
+
+    The stock of the order is reserved again first if its reservation expired.
+
+    Args:
+        order_id (int): Order ID.
+
+    Raises:
+        OrderNotFound: The order does not exist.
+        OutOfInventory: The reservation expired and a product ran out since.
+        PaymentBeingReconciled: An earlier charge has an unknown outcome.
+        PaymentUnavailable: The card was not charged, the charge can be tried again.
+        PaymentOutcomeUnknown: The card may have been charged, the order is marked for
+            reconciliation with the gateway.
+
+    Returns:
+        FlatOrder: The order with its new transaction.
+    """
+    order = get_order(order_id)
+    if order.payment_status == Order.PAYMENT_UNKNOWN:
+        raise PaymentBeingReconciled(order_id)
+    reserve_order(order_id)
+    credit_card = order.credit_card
+    try:
+        charging_results = charge(
+            credit_card.name,
+            credit_card.number,
+            credit_card.expiration_year,
+            str(credit_card.cvv),
+            credit_card.expiration_month,
+            to_amount(price_order(order).total),
+        )
+    except PaymentOutcomeUnknown as e:
+        set_payment_status(order_id, Order.PAYMENT_UNKNOWN, str(e))
+        raise
     transaction_dict = (
         charging_results["transaction"]
         if "transaction" in charging_results
@@ -307,10 +1169,275 @@ def put_order_credit_card(
             amount_charged=transaction_dict["amount_charged"],
         )
         transaction.save(force_insert=True)
-        order.transaction = transaction
-        if transaction.success:
-            order.paid = True
-        order.save()
+        unknown = Order.payment_status == Order.PAYMENT_UNKNOWN
+        version = _update_order(
+            Order.id == order_id,
+            transaction=transaction,
+            paid=bool(transaction.success),
+            # the transaction ends the payment, only a reconciliation stays due
+            payment_status=Case(None, [(unknown, Order.payment_status)], None),
+            payment_error=Case(None, [(unknown, Order.payment_error)], None),
+        )
         db.commit()
+    order_changed(order_id, version)
+
+    return get_order(order_id)
+
+
+def set_payment_status(order_id: int, status: str | None, error: str | None = None):
+    """Record the status of the payment of an order while it has no transaction.
+
+    An unknown outcome is kept whatever comes next, until it is reconciled.
+    """
+    where = Order.id == order_id
+    if status != Order.PAYMENT_UNKNOWN:
+        where &= Order.payment_status.is_null() | (
+            Order.payment_status != Order.PAYMENT_UNKNOWN
+        )
+    version = _update_order(where, payment_status=status, payment_error=error)
+    if version is not None:
+        order_changed(order_id, version)
+
+
+def put_order_credit_card(
+    order_id: int, credit_card: FlatCreditCardDetails
+) -> FlatOrder:
+    set_order_credit_card(order_id, credit_card)
+    return charge_order(order_id)
+
+
+class PaymentJob(Model):
+    "Pending charge of an order, processed in the background when payments are asynchronous."
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    order = ForeignKeyField(Order, backref="payment_jobs")
+    status = CharField(default=PENDING)
+    attempts = IntegerField(default=0)
+    created_at = DateTimeField(default=datetime.now)
+    claimed_at = DateTimeField(null=True)
+    # not to be claimed before then, when waiting to be tried again
+    run_after = DateTimeField(null=True)
+    error = TextField(null=True)
+
+    class Meta:
+        database = db
+        # oldest pending job first
+        indexes = ((("status", "id"), False),)
+
+
+def enqueue_payment(order_id: int) -> int:
+    """Queue the charge of an order, unless one is already waiting or running.
+
+    Args:
+        order_id (int): Order ID.
+
+    Returns:
+        int: ID of the payment job.
+    """
+    with db.atomic("IMMEDIATE"):  # take the write lock before reading
+        job = (
+            PaymentJob.select(PaymentJob.id)
+            .where(
+                (PaymentJob.order == order_id)
+                & PaymentJob.status.in_([PaymentJob.PENDING, PaymentJob.RUNNING])
+            )
+            .first()
+        )
+        if job is None:
+            job = PaymentJob.create(order=order_id)
+    set_payment_status(order_id, Order.PAYMENT_PENDING)
+    return job.id
+
+
+def payment_pending(order_id: int) -> bool:
+    "Whether the charge of an order is waiting in the payment queue or running."
+    return (
+        PaymentJob.select()
+        .where(
+            (PaymentJob.order == order_id)
+            & PaymentJob.status.in_([PaymentJob.PENDING, PaymentJob.RUNNING])
+        )
+        .exists()
+    )
+
+
+def claim_payment_job() -> PaymentJob | None:
+    """Take the oldest pending payment job, so that no other worker gets it.
+
+    Returns:
+        PaymentJob | None: The claimed job, or None if the queue is empty.
+    """
+    while True:
+        job = (
+            PaymentJob.select()
+            .where(
+                (PaymentJob.status == PaymentJob.PENDING)
+                & (
+                    PaymentJob.run_after.is_null()
+                    | (PaymentJob.run_after <= datetime.now())
+                )
+            )
+            .order_by(PaymentJob.id)
+            .first()
+        )
+        if job is None:
+            return None
+        claimed = (
+            PaymentJob.update(
+                status=PaymentJob.RUNNING,
+                attempts=PaymentJob.attempts + 1,
+                claimed_at=datetime.now(),
+            )
+            .where((PaymentJob.id == job.id) & (PaymentJob.status == PaymentJob.PENDING))
+            .execute()
+        )
+        if claimed:  # else another worker was faster, try the next one
+            return job
+
+
+def finish_payment_job(job_id: int, error: str | None = None):
+    PaymentJob.update(
+        status=PaymentJob.DONE if error is None else PaymentJob.FAILED, error=error
+    ).where(PaymentJob.id == job_id).execute()
+
+
+def retry_payment_job(job_id: int, delay: timedelta, error: str):
+    "Put a job back in the queue, to be claimed again once the delay is over."
+    PaymentJob.update(
+        status=PaymentJob.PENDING,
+        claimed_at=None,
+        run_after=datetime.now() + delay,
+        error=error,
+    ).where(PaymentJob.id == job_id).execute()
+
+
+def requeue_stale_payment_jobs(older_than: timedelta) -> int:
+    """Put back in the queue the jobs claimed by a worker that died before finishing them.
+
+    Args:
+        older_than (timedelta): How long a job may run before being considered lost.
+
+    Returns:
+        int: Number of jobs put back in the queue.
+    """
+    return (
+        PaymentJob.update(status=PaymentJob.PENDING, claimed_at=None)
+        .where(
+            (PaymentJob.status == PaymentJob.RUNNING)
+            & (PaymentJob.claimed_at < datetime.now() - older_than)
+        )
+        .execute()
+    )
+
+
+class IdempotencyKey(Model):
+    "Response to a request sent with an Idempotency-Key header, replayed on retries."
+    key = CharField(max_length=255, primary_key=True)
+    method = CharField(max_length=8)
+    path = CharField()
+    # SHA-256 of the body of the first request, None for the keys claimed before it
+    body_hash = CharField(max_length=64, null=True)
+    # None while the first request is still being processed
+    status = IntegerField(null=True)
+    body = BlobField(null=True)
+    location = CharField(null=True)
+    mimetype = CharField(null=True)
+    claimed_at = DateTimeField(null=True)
+    # end of the lease while the request is processed, then of the replays
+    expires_at = DateTimeField(index=True)
+
+    class Meta:
+        database = db
+
+
+def claim_idempotency_key(
+    key: str, method: str, path: str, body_hash: str, lease: timedelta
+) -> tuple[IdempotencyKey, bool]:
+    """Reserve an idempotency key for a request about to be processed.
+
+    The reservation only lasts for the lease, so that the key of a request whose
+    process died can be retried; store_idempotent_response() then keeps the response.
+
+    Args:
+        key (str): Value of the Idempotency-Key header.
+        method (str): HTTP method of the request.
+        path (str): Path of the request.
+        body_hash (str): SHA-256 of the body of the request.
+        lease (timedelta): How long the key stays reserved while being processed.
+
+    Returns:
+        tuple[IdempotencyKey, bool]: The row of the key, and whether it was just
+            reserved for this request (else it is the row of the request that used it
+            first).
+    """
+    now = datetime.now()
+    with db.atomic("IMMEDIATE"):
+        existing = IdempotencyKey.get_or_none(
+            (IdempotencyKey.key == key) & (IdempotencyKey.expires_at > now)
+        )
+        if existing is not None:
+            return existing, False
+        claim = IdempotencyKey(
+            key=key,
+            method=method,
+            path=path,
+            body_hash=body_hash,
+            claimed_at=now,
+            expires_at=now + lease,
+        )
+        IdempotencyKey.replace(**claim.__data__).execute()
+    return claim, True
+
+
+def _claimed(claim: IdempotencyKey):
+    "Condition matching the row of a claim, not of a later one after its lease expired."
+    return (IdempotencyKey.key == claim.key) & (
+        IdempotencyKey.claimed_at == claim.claimed_at
+    )
+
+
+def store_idempotent_response(
+    claim: IdempotencyKey,
+    status: int,
+    body: bytes,
+    location: str | None,
+    mimetype: str | None,
+    ttl: timedelta,
+):
+    "Keep the response to the request that claimed a key, replayed for the ttl."
+    IdempotencyKey.update(
+        status=status,
+        body=body,
+        location=location,
+        mimetype=mimetype,
+        expires_at=datetime.now() + ttl,
+    ).where(_claimed(claim) & IdempotencyKey.status.is_null()).execute()
+
+
+def release_idempotency_key(claim: IdempotencyKey):
+    "Forget a key whose request failed, so that it can be retried."
+    IdempotencyKey.delete().where(_claimed(claim)).execute()
+
+
+def purge_idempotency_keys() -> int:
+    "Delete the expired keys."
+    return (
+        IdempotencyKey.delete()
+        .where(IdempotencyKey.expires_at <= datetime.now())
+        .execute()
+    )
+
 
-    return order.flatten()
+MODELS = [
+    Product,
+    ShippingInformation,
+    CreditCardDetails,
+    Transaction,
+    Order,
+    ProductOrderQuantity,
+    PaymentJob,
+    IdempotencyKey,
+]
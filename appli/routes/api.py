@@ -1,20 +1,56 @@
-from flask import Flask, request, Response
+from datetime import timedelta
+from math import ceil
+from urllib.parse import urlencode
+
+from time import monotonic, perf_counter
+
+from flask import Flask, g, request, Response
 from appli.model.model import (
     add_order,
-    get_products,
+    add_orders,
+    enqueue_payment,
+    get_products_body,
     get_order as _get_order,
+    catalog,
+    order_events,
+    order_version,
+    Order,
+    OrderNotFound,
+    payment_pending,
     put_order_credit_card,
+    set_order_credit_card,
     put_order_shipping_information,
-    get_product,
+    query_products,
+    OutOfInventory,
+    PaymentBeingReconciled,
+    PRODUCT_FIELDS,
+    Product,
 )
 from appli.model.flat import (
     FlatOrder,
+    FlatProduct,
     FlatProductOrderQuantity,
     FlatCreditCardDetails,
     FlatShippingInformation,
 )
 import appli.routes.json_schemas as json_schemas
-from appli.utils.json import Json, serialize_order
+from appli.config import DefaultConfig
+from appli.routes.cache import OrderResponseCache, order_etag
+from appli.routes.idempotency import idempotent
+from appli.extensions import db
+from appli.services.catalog import catalog_refresher
+from appli.services.external import chargingapi
+from appli.services.external.chargingapi import PaymentOutcomeUnknown, PaymentUnavailable
+from appli.services.order_writer import order_writer
+from appli.services.payments import payment_workers
+from appli.utils.json import serialize_order
+from appli.utils.json_provider import FastJSONProvider, dumps_bytes
+from appli.utils.metrics import (
+    Gauge,
+    http_request_duration,
+    http_requests,
+    registry,
+)
 
 
 def response_with_headers(body, status=200, **headers) -> Response:
@@ -39,25 +75,40 @@ class ErrorCode:
     OUT_OF_INVENTORY = "out-of-inventory"
     ALREADY_PAID = "already-paid"
     CARD_DECLINED = "card-declined"
+    PAYMENT_PENDING = "payment-pending"
+    INVALID_PARAMETERS = "invalid-parameters"
+    PAYMENT_UNAVAILABLE = "payment-unavailable"
+    PAYMENT_OUTCOME_UNKNOWN = "payment-outcome-unknown"
+    PAYMENT_BEING_RECONCILED = "payment-being-reconciled"
 
 
-def product_error(message: str, code: str) -> Response:
-    return {
-        "errors": {
-            "product": {
-                "code": code,
-                "name": message,
-            }
-        }
-    }, 422
+def product_error(message: str, code: str, field: str | None = None) -> Response:
+    error = {
+        "code": code,
+        "name": message,
+    }
+    if field is not None:
+        error["field"] = field
+    return {"errors": {"product": error}}, 422
+
 
+def order_error(message: str, code: str, field: str | None = None) -> Response:
+    error = {
+        "code": code,
+        "name": message,
+    }
+    if field is not None:
+        error["field"] = field
+    return {"errors": {"order": error}}, 422
 
-def order_error(message: str, code: str) -> Response:
+
+def parameter_error(message: str, code: str, field: str) -> Response:
     return {
         "errors": {
-            "order": {
+            "parameters": {
                 "code": code,
                 "name": message,
+                "field": field,
             }
         }
     }, 422
@@ -73,6 +124,134 @@ def credit_card_error(message: str, code: str) -> Response:
 
 
 api = Flask(__name__)
+api.json = FastJSONProvider(api)
+order_cache = OrderResponseCache(DefaultConfig.ORDER_CACHE_SIZE)
+
+
+@api.before_request
+def start_timer():
+    g.start = perf_counter()
+    db.reset_stats()
+
+
+@api.after_request
+def record_metrics(response: Response) -> Response:
+    route = request.endpoint or "unknown"
+    http_request_duration.observe(perf_counter() - g.start, route, request.method)
+    http_requests.inc(route, request.method, response.status_code)
+    if api.debug or api.config.get("QUERY_STATS_HEADERS"):
+        stats = db.stats
+        response.headers["X-Query-Count"] = str(stats.count)
+        response.headers["X-Query-Time-Ms"] = f"{stats.seconds * 1000:.3f}"
+    return response
+
+
+registry.register(
+    Gauge(
+        "catalog_products",
+        "Number of products in the in-process catalog.",
+        lambda: len(catalog.current.products),
+    )
+)
+registry.register(
+    Gauge(
+        "catalog_version", "Reloads of the in-process catalog.", lambda: catalog.current.version
+    )
+)
+registry.register(
+    Gauge(
+        "catalog_sync_age_seconds",
+        "Seconds since the last successful sync with the products API.",
+        lambda: catalog_refresher.status()["age_seconds"],
+    )
+)
+registry.register(
+    Gauge(
+        "charging_circuit_state",
+        "Circuit breaker of the payment gateway: 0 closed, 1 half-open, 2 open.",
+        lambda: {"closed": 0, "half-open": 1, "open": 2}[chargingapi.breaker.state],
+    )
+)
+registry.register(
+    Gauge(
+        "order_event_streams",
+        "Open GET /order/<id>/events streams.",
+        order_events.subscribers,
+    )
+)
+registry.register(
+    Gauge(
+        "catalog_sync_failing",
+        "1 if the last sync with the products API failed.",
+        lambda: int(catalog_refresher.last_error is not None),
+    )
+)
+
+
+@api.teardown_request
+def close_database(_exception):
+    """Each request gets its own connection, so that the threads serving requests don't
+    share one. It is opened by the first query, requests served from memory never open it."""
+    if not db.is_closed():
+        db.close()
+
+
+class InvalidParameter(Exception):
+    def __init__(self, field: str, message: str):
+        super().__init__(message)
+        self.field = field
+        self.message = message
+
+
+def parse_product_query(args: dict) -> dict:
+    """Read the pagination, filter and projection parameters of the product listing.
+
+    Args:
+        args (dict): Query string parameters.
+
+    Raises:
+        InvalidParameter: A parameter is unknown or has an invalid value.
+
+    Returns:
+        dict: Keyword arguments for query_products.
+    """
+    converters = {
+        "after": int,
+        "limit": int,
+        "in_stock": parse_bool,
+        "min_price": float,
+        "max_price": float,
+        "min_weight": int,
+        "max_weight": int,
+    }
+    parsed = {"limit": api.config.get("PRODUCTS_PAGE_SIZE", 50)}
+    for name, value in args.items():
+        if name == "fields":
+            fields = value.split(",")
+            if unknown := [f for f in fields if f not in PRODUCT_FIELDS]:
+                raise InvalidParameter(name, f"Champs inconnus : {', '.join(unknown)}")
+            # the ID is always fetched, it is the pagination cursor
+            parsed["fields"] = tuple(dict.fromkeys(["id", *fields]))
+        elif name in converters:
+            try:
+                parsed[name] = converters[name](value)
+            except ValueError:
+                raise InvalidParameter(name, f"Valeur invalide : {value}")
+        else:
+            raise InvalidParameter(name, f"Paramètre inconnu : {name}")
+    if not 0 < parsed["limit"] <= api.config.get("PRODUCTS_MAX_PAGE_SIZE", 500):
+        raise InvalidParameter("limit", f"Valeur invalide : {parsed['limit']}")
+    return parsed
+
+
+def parse_bool(value: str) -> bool:
+    match value.lower():
+        case "true" | "1":
+            return True
+        case "false" | "0":
+            return False
+        case _:
+            raise ValueError(value)
 
 
 @api.get("/")
@@ -81,45 +260,219 @@ def list_products() -> Response:
     Cette URL doit retourner la liste complète des produits en format JSON
     disponibles pour passer une commande, incluant ceux qui ne sont pas en
     inventaire.
+
+    Avec des paramètres (after, limit, in_stock, min_price, max_price,
+    min_weight, max_weight, fields), la liste est paginée et filtrée, et le
+    lien vers la page suivante est donné dans "next".
+    """
+    if not request.args:
+        return Response(get_products_body(), mimetype="application/json")
+
+    try:
+        args = parse_product_query(request.args)
+    except InvalidParameter as e:
+        return parameter_error(e.message, ErrorCode.INVALID_PARAMETERS, e.field)
+    products = query_products(**{**args, "limit": args["limit"] + 1})
+    next_page = None
+    if len(products) > args["limit"]:
+        products = products[: args["limit"]]
+        next_page = "/?" + urlencode({**request.args, "after": products[-1]["id"]})
+    if "id" not in request.args.get("fields", "id").split(","):
+        products = [{k: v for k, v in p.items() if k != "id"} for p in products]
+    return {"products": products, "next": next_page}
+
+
+@api.get("/health")
+def health() -> Response:
+    """
+    État de l'application : fraîcheur du catalogue, dernière erreur de
+    synchronisation avec l'API des produits et état du disjoncteur du service
+    de paiement.
+    """
+    return {
+        "catalog": catalog_refresher.status(),
+        "payment_gateway": chargingapi.breaker.status(),
+    }
+
+
+@api.get("/ready")
+def ready() -> Response:
+    """
+    Répond 200 dès qu'un catalogue peut être servi, 503 sinon.
+    """
+    status = catalog_refresher.status()
+    return {"ready": status["ready"]}, 200 if status["ready"] else 503
+
+
+@api.get("/metrics")
+def metrics() -> Response:
+    """
+    Métriques de l'application au format texte de Prometheus.
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+def reservation_ttl() -> timedelta:
+    "How long the stock of a new order is held until it is paid."
+    return timedelta(seconds=api.config.get("ORDER_RESERVATION_TTL", 30 * 60))
+
+
+class InvalidOrder(Exception):
+    def __init__(self, message: str, code: str, field: str | None = None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.field = field
+
+
+def parse_order_lines(json) -> dict[int, int]:
+    """Read the products of a new order, a single "product" or a list of "products".
+
+    Args:
+        json: Form data.
+
+    Raises:
+        InvalidOrder: A field is missing or has an invalid value.
+
+    Returns:
+        dict[int, int]: Quantity of each product, by product ID (summed if a product
+            is listed more than once).
     """
-    return {"products": get_products()}
+    if isinstance(json, dict) and "products" in json:
+        if (field := json_schemas.validate_new_multi_product_order(json)) is not None:
+            raise InvalidOrder(
+                "La création d'une commande nécessite un produit",
+                ErrorCode.MISSING_FIELDS,
+                field,
+            )
+        lines = json["products"]
+        if not lines:
+            raise InvalidOrder(
+                "La création d'une commande nécessite un produit",
+                ErrorCode.MISSING_FIELDS,
+                "products",
+            )
+        for i, line in enumerate(lines):
+            if (field := json_schemas.validate_order_line(line)) is not None:
+                raise InvalidOrder(
+                    "La création d'une commande nécessite un produit",
+                    ErrorCode.MISSING_FIELDS,
+                    f"products.{i}.{field}",
+                )
+    elif (field := json_schemas.validate_new_order(json)) is not None:
+        raise InvalidOrder(
+            "La création d'une commande nécessite un produit",
+            ErrorCode.MISSING_FIELDS,
+            field,
+        )
+    else:
+        lines = [json["product"]]
+    quantities: dict[int, int] = {}
+    for line in lines:
+        if line["quantity"] < 1:
+            raise InvalidOrder(
+                "La quantité du produit ne peut pas être inférieure à 1",
+                ErrorCode.MISSING_FIELDS,
+            )
+        quantities[line["id"]] = quantities.get(line["id"], 0) + line["quantity"]
+    return quantities
 
 
 @api.post("/order")
+@idempotent
 def new_order() -> Response:
     """
     La création d'une nouvelle commande se fait avec un appel POST à /order. Si la
     commande est créée, le code HTTP de retour doit être 302 et inclure le lien vers
     la commande nouvellement créée.
+
+    Une commande peut contenir un seul produit ("product") ou une liste de
+    produits ("products").
     """
-    json = request.get_json()
-    if not Json(json).is_like(json_schemas.new_order):
+    try:
+        quantities = parse_order_lines(request.get_json())
+        if api.config.get("ORDER_WRITE_BATCHING"):
+            order = order_writer.submit(quantities, reservation_ttl())
+        else:
+            order = add_order(quantities, reservation_ttl())
+    except InvalidOrder as e:
+        return product_error(e.message, e.code, e.field)
+    except Product.DoesNotExist:
         return product_error(
-            "La création d'une commande nécessite un produit", ErrorCode.MISSING_FIELDS
+            "Le produit demandé n'existe pas", ErrorCode.MISSING_FIELDS, "product.id"
         )
-    elif json["product"]["quantity"] < 1:
+    except OutOfInventory:
         return product_error(
-            "La quantité du produit ne peut pas être inférieure à 1",
-            ErrorCode.MISSING_FIELDS,
+            "Le produit demandé n'est pas en inventaire", ErrorCode.OUT_OF_INVENTORY
         )
-    else:
-        order = add_order(
-            FlatOrder(
-                products=FlatProductOrderQuantity(
-                    product=get_product(json["product"]["id"]),
-                    quantity=json["product"]["quantity"],
-                )
-            )
+    return response_with_headers(
+        None,
+        status=302,
+        Location=f"/order/{order.id}",
+    )
+
+
+def product_in_stock(product_id: int) -> FlatProduct:
+    """Product of a new order, from the in-memory catalog.
+
+    Raises:
+        InvalidOrder: The product does not exist or is not in stock.
+    """
+    product = catalog.get(product_id)
+    if product is None:
+        raise InvalidOrder(
+            "Le produit demandé n'existe pas", ErrorCode.MISSING_FIELDS, "product.id"
         )
-        if not order.products.product.in_stock:
-            return product_error(
-                "Le produit demandé n'est pas en inventaire", ErrorCode.OUT_OF_INVENTORY
-            )
-        return response_with_headers(
-            None,
-            status=302,
-            Location=f"/order/{order.id}",
+    if not product.in_stock:
+        raise InvalidOrder(
+            "Le produit demandé n'est pas en inventaire", ErrorCode.OUT_OF_INVENTORY
         )
+    return product
+
+
+@api.post("/orders")
+@idempotent
+def new_orders() -> Response:
+    """
+    Création de plusieurs commandes en un seul appel POST à /orders, avec une
+    liste de commandes de la même forme que pour /order. Chaque élément est
+    validé avec le catalogue en mémoire et les commandes valides sont créées
+    ensemble. La réponse donne, dans le même ordre, l'identifiant de chaque
+    commande créée ou les erreurs de l'élément.
+    """
+    json = request.get_json()
+    if not isinstance(json, list):
+        return order_error(
+            "Une liste de commandes est attendue", ErrorCode.MISSING_FIELDS
+        )
+    if len(json) > api.config.get("ORDERS_BATCH_MAX_SIZE", 10000):
+        return order_error(
+            "Trop de commandes dans la même requête", ErrorCode.INVALID_PARAMETERS
+        )
+    results: list[dict] = []
+    valid: list[tuple[int, FlatOrder]] = []
+    for item in json:
+        try:
+            lines = [
+                FlatProductOrderQuantity(
+                    product=product_in_stock(product_id), quantity=quantity
+                )
+                for product_id, quantity in parse_order_lines(item).items()
+            ]
+        except InvalidOrder as e:
+            results.append(product_error(e.message, e.code, e.field)[0])
+            continue
+        valid.append((len(results), FlatOrder(products=lines)))
+        results.append({})
+    created = add_orders([order for _, order in valid], reservation_ttl())
+    for (index, _), order in zip(valid, created):
+        if order is None:
+            results[index] = product_error(
+                "Le produit demandé n'est pas en inventaire", ErrorCode.OUT_OF_INVENTORY
+            )[0]
+        else:
+            results[index] = {"id": order.id, "location": f"/order/{order.id}"}
+    return {"orders": results}
 
 
 @api.get("/order/<int:order_id>")
@@ -128,7 +481,71 @@ def get_order(order_id: int) -> Response:
     Une fois le processus d'achat initialisé, on peut récupérer la commande complète
     à tout moment avec cette requête GET.
     """
-    return serialize_order(_get_order(order_id))
+    version = order_version(order_id)  # a primary key lookup, shared by all processes
+    if version is None:
+        raise OrderNotFound()
+    etag = order_etag(order_id, version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = order_cache.get(order_id, version)
+        if body is None:
+            body = api.json.dumps_bytes(serialize_order(_get_order(order_id)))
+            order_cache.put(order_id, version, body)
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+
+def order_event(order: FlatOrder, version: int) -> bytes:
+    "An order as a server-sent event, its version as the event ID."
+    return b"id: %d\nevent: order\ndata: %s\n\n" % (
+        version,
+        dumps_bytes(serialize_order(order)),
+    )
+
+
+@api.get("/order/<int:order_id>/events")
+def order_events_stream(order_id: int) -> Response:
+    """
+    Flux d'événements (server-sent events) d'une commande : la commande est
+    envoyée une première fois, puis à chaque changement (informations
+    d'expédition, carte de crédit, transaction). Le flux se ferme une fois la
+    commande payée, ce qui évite d'interroger GET /order/<id> en boucle.
+    """
+    subscription = order_events.subscribe(order_id)  # before reading, not to miss a change
+    try:
+        version = order_version(order_id)
+        order = _get_order(order_id)
+    except Exception:
+        subscription.close()
+        raise
+    heartbeat = api.config.get("ORDER_EVENTS_HEARTBEAT", 15)
+    deadline = monotonic() + api.config.get("ORDER_EVENTS_TIMEOUT", 300)
+
+    def stream():
+        nonlocal order, version
+        yield order_event(order, version)
+        while not order.paid and monotonic() < deadline:
+            changed = subscription.latest(
+                timeout=min(heartbeat, max(0, deadline - monotonic()))
+            )
+            if changed is None:
+                yield b": heartbeat\n\n"
+                continue
+            # streamed after the request is over, without its database connection
+            with db.connection_context():
+                order = _get_order(order_id)
+            version = changed
+            yield order_event(order, version)
+
+    response = Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(subscription.close)  # also when the client goes away
+    return response
 
 
 def add_credit_card(order_id: int, json: dict) -> Response:
@@ -141,10 +558,11 @@ def add_credit_card(order_id: int, json: dict) -> Response:
     Returns:
         Response: Flask HTTP Response with json data.
     """
-    if not Json(json).is_like(json_schemas.put_order_credit_card):
+    if (field := json_schemas.validate_put_order_credit_card(json)) is not None:
         return order_error(
             "Il manque un ou plusieurs champs qui sont obligatoires",
             ErrorCode.MISSING_FIELDS,
+            field,
         )
     else:
         order = _get_order(order_id)
@@ -156,16 +574,30 @@ def add_credit_card(order_id: int, json: dict) -> Response:
             )
         if order.transaction and order.paid:
             return order_error("La commande a déjà été payée.", ErrorCode.ALREADY_PAID)
-        result: FlatOrder = put_order_credit_card(
-            order_id,
-            FlatCreditCardDetails(
-                name=cc["name"],
-                number=int("".join([n for n in cc["number"] if n != " "])),
-                expiration_year=int(cc["expiration_year"]),
-                cvv=int(cc["cvv"]),
-                expiration_month=int(cc["expiration_month"]),
-            ),
+        if order.payment_status == Order.PAYMENT_UNKNOWN:
+            return payment_being_reconciled()
+        credit_card = FlatCreditCardDetails(
+            name=cc["name"],
+            number=int("".join([n for n in cc["number"] if n != " "])),
+            expiration_year=int(cc["expiration_year"]),
+            cvv=int(cc["cvv"]),
+            expiration_month=int(cc["expiration_month"]),
         )
+        if api.config.get("ASYNC_PAYMENTS"):
+            return queue_payment(order_id, credit_card)
+        try:
+            result: FlatOrder = put_order_credit_card(order_id, credit_card)
+        except OutOfInventory:
+            return order_error(
+                "Un produit de la commande n'est plus en inventaire",
+                ErrorCode.OUT_OF_INVENTORY,
+            )
+        except PaymentUnavailable as e:
+            return payment_unavailable(e)
+        except PaymentOutcomeUnknown:
+            return payment_outcome_unknown()
+        except PaymentBeingReconciled:
+            return payment_being_reconciled()
         if not result.transaction.success:
             return credit_card_error(
                 "La carte de crédit a été déclinée.", ErrorCode.CARD_DECLINED
@@ -173,6 +605,57 @@ def add_credit_card(order_id: int, json: dict) -> Response:
         return serialize_order(result)
 
 
+def payment_unavailable(error: PaymentUnavailable) -> Response:
+    "503 telling the client when to try the payment again."
+    body, _ = order_error(
+        "Le service de paiement est indisponible, réessayez plus tard.",
+        ErrorCode.PAYMENT_UNAVAILABLE,
+    )
+    return body, 503, {"Retry-After": str(max(1, ceil(error.retry_after)))}
+
+
+def payment_outcome_unknown() -> Response:
+    """502 telling the client the card may have been charged: not to be tried again,
+    the order is checked against the payment gateway."""
+    body, _ = order_error(
+        "Le paiement a été transmis mais son résultat est inconnu, ne le relancez pas : "
+        "la commande sera vérifiée auprès du service de paiement.",
+        ErrorCode.PAYMENT_OUTCOME_UNKNOWN,
+    )
+    return body, 502
+
+
+def payment_being_reconciled() -> Response:
+    """409 refusing to charge an order whose last charge has an unknown outcome, until
+    it is reconciled with the payment gateway."""
+    body, _ = order_error(
+        "Le résultat d'un paiement précédent est inconnu, la commande est en cours de "
+        "vérification auprès du service de paiement.",
+        ErrorCode.PAYMENT_BEING_RECONCILED,
+    )
+    return body, 409
+
+
+def queue_payment(order_id: int, credit_card: FlatCreditCardDetails) -> Response:
+    """Store the credit card and let the payment workers charge it.
+
+    Args:
+        order_id (int): Order ID.
+        credit_card (FlatCreditCardDetails): Card to charge.
+
+    Returns:
+        Response: 202 Accepted, with the link to the order to poll for the transaction.
+    """
+    if payment_pending(order_id):
+        return order_error(
+            "Le paiement de la commande est déjà en cours.", ErrorCode.PAYMENT_PENDING
+        )
+    set_order_credit_card(order_id, credit_card)
+    enqueue_payment(order_id)
+    payment_workers.wake()
+    return response_with_headers(None, status=202, Location=f"/order/{order_id}")
+
+
 def add_shipping_information(order_id: int, json: dict) -> Response:
     """Handles a PUT request on /order where the provided form data is supposed to be credit card details.
 
@@ -183,10 +666,11 @@ def add_shipping_information(order_id: int, json: dict) -> Response:
     Returns:
         Response: Flask HTTP Response with json data.
     """
-    if not Json(json).is_like(json_schemas.put_order_shipping_info):
+    if (field := json_schemas.validate_put_order_shipping_info(json)) is not None:
         return order_error(
             "Il manque un ou plusieurs champs qui sont obligatoires",
             ErrorCode.MISSING_FIELDS,
+            field,
         )
     else:
         o = json["order"]
@@ -207,6 +691,7 @@ def add_shipping_information(order_id: int, json: dict) -> Response:
 
 
 @api.put("/order/<int:order_id>")
+@idempotent
 def put_order(order_id: int) -> Response:
     """
     Par défaut, une commande ne contient aucune information sur le client. On doit
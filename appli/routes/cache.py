@@ -0,0 +1,36 @@
+"Cache of the serialized GET /order/<id> responses."
+from collections import OrderedDict
+from threading import Lock
+
+
+def order_etag(order_id: int, version: int) -> str:
+    "ETag of an order, from the version stored with it: the same in every process."
+    return f"{order_id}-{version}"
+
+
+class OrderResponseCache:
+    "Least recently used serialized orders, each tagged with the order version it was built from."
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._entries: OrderedDict[int, tuple[int, bytes]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, order_id: int, version: int) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(order_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(order_id)
+            return entry[1]
+
+    def put(self, order_id: int, version: int, body: bytes):
+        with self._lock:
+            self._entries[order_id] = (version, body)
+            self._entries.move_to_end(order_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,93 @@
+"Replay of the responses to requests retried with the same Idempotency-Key header."
+from datetime import timedelta
+from functools import wraps
+from hashlib import sha256
+from time import monotonic
+
+from flask import current_app, request, Response
+
+from appli.model.model import (
+    claim_idempotency_key,
+    purge_idempotency_keys,
+    release_idempotency_key,
+    store_idempotent_response,
+)
+
+_PURGE_INTERVAL = 60  # seconds
+_last_purge = 0.0
+
+
+def _error(message: str, code: str, status: int) -> Response:
+    return {"errors": {"idempotency_key": {"code": code, "name": message}}}, status
+
+
+def idempotent(view):
+    """Decorator making a view safe to retry with an Idempotency-Key header.
+
+    The first request with a key is processed and its response stored; later
+    requests with the same key get the stored response without running the view.
+    A 503 response or an exception isn't stored, so that the request can be retried;
+    other errors, such as a 502 for a payment with an unknown outcome, are replayed.
+    A key is only reserved for IDEMPOTENCY_KEY_LEASE seconds while its request is
+    processed, and can't be used again with another method, path or body.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        global _last_purge
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return view(*args, **kwargs)
+        if monotonic() - _last_purge > _PURGE_INTERVAL:
+            _last_purge = monotonic()
+            purge_idempotency_keys()
+
+        config = current_app.config
+        ttl = timedelta(seconds=config.get("IDEMPOTENCY_KEY_TTL", 86400))
+        lease = timedelta(seconds=config.get("IDEMPOTENCY_KEY_LEASE", 60))
+        body_hash = sha256(request.get_data()).hexdigest()
+        row, claimed = claim_idempotency_key(
+            key, request.method, request.path, body_hash, lease
+        )
+        if not claimed:
+            if (row.method, row.path) != (request.method, request.path) or (
+                row.body_hash not in (None, body_hash)
+            ):
+                return _error(
+                    "La clé d'idempotence a déjà servi pour une autre requête.",
+                    "idempotency-key-reused",
+                    422,
+                )
+            if row.status is None:
+                return _error(
+                    "Une requête avec cette clé d'idempotence est en cours.",
+                    "idempotency-key-in-use",
+                    409,
+                )
+            response = Response(
+                row.body, status=row.status, mimetype=row.mimetype
+            )
+            if row.location is not None:
+                response.headers["Location"] = row.location
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            release_idempotency_key(row)
+            raise
+        if response.status_code == 503:  # nothing was done, to be tried again
+            release_idempotency_key(row)
+        else:
+            store_idempotent_response(
+                row,
+                response.status_code,
+                response.get_data(),
+                response.headers.get("Location"),
+                response.mimetype,
+                ttl,
+            )
+        return response
+
+    return wrapper
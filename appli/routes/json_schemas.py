@@ -1,9 +1,15 @@
 """
 JSON schemas to validate sent form data.
 It's possible to say that some fields could have multiple types (like nullable types) by using Type1 | Type2.
+Each schema has a compiled validator (validate_*), returning the path of the first invalid field.
 """
+from appli.utils.json import compile_schema
 
-new_order = {"product": {"id": int, "quantity": int}}
+order_line = {"id": int, "quantity": int}
+
+new_order = {"product": order_line}
+
+new_multi_product_order = {"products": list}
 
 put_order_shipping_info = {
     "order": {
@@ -27,3 +33,9 @@ put_order_credit_card = {
         "expiration_month": int,
     }
 }
+
+validate_order_line = compile_schema(order_line)
+validate_new_order = compile_schema(new_order)
+validate_new_multi_product_order = compile_schema(new_multi_product_order)
+validate_put_order_shipping_info = compile_schema(put_order_shipping_info)
+validate_put_order_credit_card = compile_schema(put_order_credit_card)
@@ -0,0 +1,125 @@
+"Background refresh of the product catalog from the products API."
+from datetime import datetime
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+from appli.extensions import db
+from appli.model.flat import FlatProduct
+from appli.model.model import CatalogSyncReport, catalog, reload_catalog, sync_products
+from appli.services.external.productapi import fetch_products
+
+logger = getLogger(__name__)
+
+
+class CatalogRefresher:
+    "Syncs the products table with the products API without blocking the app startup."
+
+    def __init__(self):
+        self.last_sync: datetime | None = None
+        self.last_error: str | None = None
+        self.last_report: CatalogSyncReport | None = None
+        self._synced = Event()
+        self._attempted = Event()
+        self._lock = Lock()
+        self._thread: Thread | None = None
+        self._stopping = Event()
+
+    def refresh(self) -> CatalogSyncReport | None:
+        """Fetch the upstream catalog, sync the database with it and reload the catalog.
+
+        Returns:
+            CatalogSyncReport | None: What changed, or None if the sync failed.
+        """
+        with self._lock, db.connection_context():
+            try:
+                report = sync_products(
+                    [
+                        FlatProduct(
+                            id=p["id"],
+                            name=p["name"],
+                            price=p["price"],
+                            image=p["image"],
+                            in_stock=p["in_stock"],
+                            description=p["description"],
+                            weight=p["weight"],
+                        )
+                        for p in fetch_products()
+                    ]
+                )
+                reload_catalog()
+            except Exception as e:
+                logger.exception("catalog sync failed")
+                self.last_error = repr(e)
+                self._attempted.set()
+                return None
+            logger.info(
+                "catalog synced: %d inserted, %d updated, %d removed, %d restocked",
+                report.inserted,
+                report.updated,
+                report.removed,
+                report.restocked,
+            )
+            self.last_sync = datetime.now()
+            self.last_error = None
+            self.last_report = report
+            self._synced.set()
+            self._attempted.set()
+            return report
+
+    def start(self, interval: float = 0):
+        """Refresh the catalog in a background thread, once per process.
+
+        Args:
+            interval (float, optional): Seconds between two refreshes, 0 to refresh only once.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = Thread(
+            target=self._run, args=(interval,), name="catalog-refresher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, interval: float):
+        self.refresh()
+        while interval and not self._stopping.wait(interval):
+            self.refresh()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Wait for the end of the first sync, successful or not.
+
+        Returns:
+            bool: Whether the catalog is ready to be served.
+        """
+        self._attempted.wait(timeout)
+        return self.ready
+
+    @property
+    def syncing(self) -> bool:
+        return self._lock.locked()
+
+    @property
+    def ready(self) -> bool:
+        "Whether there is a catalog to serve, synced in this process or left in the database."
+        return self._synced.is_set() or bool(catalog.current.products)
+
+    def status(self) -> dict:
+        current = catalog.current
+        return {
+            "ready": self.ready,
+            "syncing": self.syncing,
+            "version": current.version,
+            "size": len(current.products),
+            "last_sync": self.last_sync and self.last_sync.isoformat(),
+            "age_seconds": self.last_sync
+            and (datetime.now() - self.last_sync).total_seconds(),
+            "last_error": self.last_error,
+        }
+
+
+catalog_refresher = CatalogRefresher()
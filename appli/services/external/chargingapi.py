@@ -1,7 +1,147 @@
-from urllib.request import HTTPError, Request, urlopen as open
-from json import loads as parse_json, dumps as serialize
+"Calls to the payment gateway, with timeouts, bounded retries and a circuit breaker."
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
 
+from appli.config import DefaultConfig
+from appli.utils.metrics import observe_outbound, outbound_rejected, outbound_retries
+from .httpclient import ConnectError, HttpError, client
 
+# statuses of a gateway that did not process the charge and may do it if asked again
+RETRYABLE_STATUSES = (502, 503)
+
+
+class PaymentUnavailable(Exception):
+    "The payment gateway can't be reached or is failing; the card was not charged."
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PaymentOutcomeUnknown(Exception):
+    """The charge reached the payment gateway, but its answer was lost or was a server
+    error: the card may have been charged, and must not be charged again blindly."""
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for a while, then lets a single call probe it.
+
+    Closed, calls go through and consecutive failures are counted. Past the threshold
+    it opens and calls fail fast until reset_timeout has elapsed. It is then half-open:
+    one call goes through, its outcome closes the breaker or opens it again.
+
+    Args:
+        failure_threshold (int, optional): Consecutive failures opening the breaker.
+        reset_timeout (float, optional): Seconds before probing an open breaker.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._remaining() <= 0:
+                return self.HALF_OPEN
+            return self._state
+
+    def _remaining(self) -> float:
+        return self._opened_at + self.reset_timeout - monotonic()
+
+    def retry_after(self) -> float:
+        "Seconds before an open breaker lets a call through, 0 if it is not open."
+        with self._lock:
+            return max(0.0, self._remaining()) if self._state == self.OPEN else 0.0
+
+    def allow(self) -> bool:
+        "Whether a call may go through now; its outcome must then be recorded."
+        with self._lock:
+            if self._state == self.OPEN:
+                if self._remaining() > 0:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._state == self.HALF_OPEN:
+                if self._probing:  # another call is already probing
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = monotonic()
+                self._probing = False
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_after": self.retry_after(),
+        }
+
+
+class RetryBudget:
+    """Retries allowed across all calls, so that a failing service isn't sent more load.
+
+    Each call earns a fraction of a retry, each retry spends a whole one.
+
+    Args:
+        ratio (float, optional): Retries allowed per call, on average.
+        burst (float, optional): Most retries that can be saved up.
+    """
+
+    def __init__(self, ratio: float = 0.2, burst: float = 10.0):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        "Take a retry from the budget, False if there is none left."
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+breaker = CircuitBreaker(
+    DefaultConfig.CHARGING_BREAKER_THRESHOLD, DefaultConfig.CHARGING_BREAKER_RESET_TIMEOUT
+)
+retry_budget = RetryBudget(DefaultConfig.CHARGING_RETRY_BUDGET)
+
+
+def backoff(attempt: int) -> float:
+    "Seconds to wait before another attempt, exponential with full jitter."
+    return uniform(0, DefaultConfig.CHARGING_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+
+@observe_outbound("charge")
 def charge(
     name: str,
     number: int,
@@ -10,8 +150,19 @@ def charge(
     expiration_month: int,
     amount_charged: float,
 ) -> dict:
-    req = Request("https://dimensweb.uqac.ca/~jgnault/shops/pay/")
-    req.add_header("Content-Type", "application/json")
+    """Charge a credit card through the payment gateway.
+
+    A charge is attempted again only if the gateway surely did not process it: it could
+    not be reached or it answered 502/503. Timeouts while waiting for the answer and
+    other server errors are not retried, the card may have been charged.
+
+    Raises:
+        PaymentUnavailable: The breaker is open, or the charge was surely not processed.
+        PaymentOutcomeUnknown: The charge was sent, whether it went through is unknown.
+
+    Returns:
+        dict: The transaction, or the error of a declined card.
+    """
     json = {
         "credit_card": {
             "name": name,
@@ -24,7 +175,41 @@ def charge(
         },
         "amount_charged": amount_charged,
     }
-    try:
-        return parse_json(open(req, str.encode(serialize(json))).read().decode())
-    except HTTPError as e:
-        return parse_json(e.fp.read().decode())
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            outbound_rejected.inc("charge")
+            raise PaymentUnavailable(
+                "the payment gateway is failing", breaker.retry_after()
+            )
+        attempt += 1
+        try:
+            response = client.post_json(
+                DefaultConfig.CHARGING_API_URL,
+                json,
+                connect_timeout=DefaultConfig.CHARGING_CONNECT_TIMEOUT,
+                read_timeout=DefaultConfig.CHARGING_READ_TIMEOUT,
+            )
+        except ConnectError as e:
+            error, retryable = e, True
+        except HttpError as e:
+            breaker.record_failure()
+            raise PaymentOutcomeUnknown(str(e)) from e
+        else:
+            if response.status < 500:
+                breaker.record_success()
+                # the body holds either the transaction or the error, whatever the status
+                return response.json()
+            error = HttpError(f"the payment gateway answered {response.status}")
+            retryable = response.status in RETRYABLE_STATUSES
+        breaker.record_failure()
+        if not retryable:
+            raise PaymentOutcomeUnknown(str(error)) from error
+        if (
+            attempt >= DefaultConfig.CHARGING_MAX_ATTEMPTS
+            or not retry_budget.withdraw()
+        ):
+            raise PaymentUnavailable(str(error), breaker.retry_after()) from error
+        outbound_retries.inc("charge")
+        sleep(backoff(attempt))
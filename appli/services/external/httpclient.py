@@ -0,0 +1,230 @@
+"Outbound HTTP client shared by the external services, keeping connections alive between calls."
+from dataclasses import dataclass, field
+from gzip import decompress
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from json import loads as parse_json, dumps as serialize
+from queue import Empty, LifoQueue
+from select import select
+from threading import BoundedSemaphore, Lock
+from urllib.parse import urlsplit
+
+from appli.config import DefaultConfig
+
+
+class HttpError(Exception):
+    "The request could not be completed (connection refused, timeout, no free connection...)."
+    pass
+
+
+class ConnectError(HttpError):
+    "The request was not sent: no free connection, or the host could not be reached."
+    pass
+
+
+# Methods that can be sent again when the connection fails after the request went out
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+@dataclass
+class HttpResponse:
+    status: int
+    body: bytes
+    headers: dict[str, str] = field(default_factory=dict)
+
+    def json(self):
+        return parse_json(self.body.decode("utf8"))
+
+
+class HostPool:
+    "Idle keep-alive connections to one host, with a cap on how many can be open at once."
+
+    def __init__(self, scheme: str, host: str, port: int | None, max_connections: int):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self._idle: LifoQueue[HTTPConnection] = LifoQueue()
+        self._slots = BoundedSemaphore(max_connections)
+
+    def acquire(self, connect_timeout: float, read_timeout: float) -> tuple[HTTPConnection, bool]:
+        """Take an idle connection, or open a new one if there is a free slot.
+
+        Args:
+            connect_timeout (float): Seconds to wait for a slot and for the connection.
+            read_timeout (float): Seconds to wait for each read once connected.
+
+        Raises:
+            ConnectError: No slot was freed in time, or the host could not be reached.
+
+        Returns:
+            tuple[HTTPConnection, bool]: The connection and whether it was reused.
+        """
+        if not self._slots.acquire(timeout=connect_timeout):
+            raise ConnectError(f"no free connection to {self.host} after {connect_timeout}s")
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                break
+            if _dropped(connection):
+                connection.close()
+                continue
+            connection.sock.settimeout(read_timeout)
+            return connection, True
+        cls = HTTPSConnection if self.scheme == "https" else HTTPConnection
+        connection = cls(self.host, self.port, timeout=connect_timeout)
+        try:
+            connection.connect()
+        except OSError as e:
+            self._slots.release()
+            raise ConnectError(f"could not connect to {self.host}: {e}") from e
+        connection.sock.settimeout(read_timeout)
+        return connection, False
+
+    def release(self, connection: HTTPConnection, reusable: bool):
+        "Give a connection back, closing it if it can't carry another request."
+        if reusable:
+            self._idle.put(connection)
+        else:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+def _dropped(connection: HTTPConnection) -> bool:
+    "Whether the server closed an idle connection: it is readable while no reply is due."
+    if connection.sock is None:
+        return True
+    readable, _, _ = select([connection.sock], [], [], 0)
+    return bool(readable)
+
+
+class HttpClient:
+    "HTTP/1.1 client with a pool of persistent connections per host."
+
+    def __init__(
+        self,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        max_connections_per_host: int = 10,
+        gzip: bool = True,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.gzip = gzip
+        self._pools: dict[tuple[str, str, int | None], HostPool] = {}
+        self._lock = Lock()
+
+    def _pool(self, scheme: str, host: str, port: int | None) -> HostPool:
+        key = (scheme, host, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.setdefault(
+                    key, HostPool(scheme, host, port, self.max_connections_per_host)
+                )
+        return pool
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        body: bytes | None = None,
+        headers: dict | None = None,
+        connect_timeout: float | None = None,
+        read_timeout: float | None = None,
+    ) -> HttpResponse:
+        """Send a request, whatever the status of the response.
+
+        Args:
+            method (str): HTTP method.
+            url (str): Absolute URL.
+            body (bytes | None, optional): Request body.
+            headers (dict | None, optional): Extra request headers.
+            connect_timeout (float | None, optional): Overrides the client's one.
+            read_timeout (float | None, optional): Overrides the client's one.
+
+        A reused connection that fails is replaced by a fresh one when the request was
+        not sent yet, or when it is idempotent. Once a POST went out, its failure is
+        raised: the server may have acted on it.
+
+        Raises:
+            ConnectError: The request could not be sent.
+            HttpError: The request was sent, but the response could not be read.
+
+        Returns:
+            HttpResponse: Response, with its body already decompressed.
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = dict(headers or {})
+        if self.gzip:
+            headers.setdefault("Accept-Encoding", "gzip")
+        pool = self._pool(parts.scheme, parts.hostname, parts.port)
+        connect_timeout = connect_timeout or self.connect_timeout
+        read_timeout = read_timeout or self.read_timeout
+
+        while True:
+            connection, reused = pool.acquire(connect_timeout, read_timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+            except (OSError, HTTPException) as e:
+                pool.release(connection, reusable=False)
+                if reused:  # the server closed the idle connection, try a fresh one
+                    continue
+                raise ConnectError(f"{method} {url} could not be sent: {e!r}") from e
+            try:
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionError, HTTPException) as e:
+                pool.release(connection, reusable=False)
+                if reused and method in IDEMPOTENT_METHODS:
+                    continue
+                raise HttpError(f"{method} {url} failed: {e!r}") from e
+            except OSError as e:
+                pool.release(connection, reusable=False)
+                raise HttpError(f"{method} {url} failed: {e!r}") from e
+            pool.release(connection, reusable=not response.will_close)
+            break
+
+        if response.getheader("Content-Encoding") == "gzip":
+            data = decompress(data)
+        return HttpResponse(
+            status=response.status, body=data, headers=dict(response.getheaders())
+        )
+
+    def get(self, url: str, headers: dict | None = None) -> HttpResponse:
+        return self.request("GET", url, headers=headers)
+
+    def post_json(
+        self, url: str, json, headers: dict | None = None, **timeouts: float
+    ) -> HttpResponse:
+        return self.request(
+            "POST",
+            url,
+            body=str.encode(serialize(json)),
+            headers={"Content-Type": "application/json", **(headers or {})},
+            **timeouts,
+        )
+
+    def close(self):
+        "Close every idle connection."
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+
+client = HttpClient(
+    connect_timeout=DefaultConfig.HTTP_CONNECT_TIMEOUT,
+    read_timeout=DefaultConfig.HTTP_READ_TIMEOUT,
+    max_connections_per_host=DefaultConfig.HTTP_MAX_CONNECTIONS_PER_HOST,
+    gzip=DefaultConfig.HTTP_GZIP,
+)
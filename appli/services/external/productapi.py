@@ -1,8 +1,8 @@
-from urllib.request import urlopen as open
-from json import loads as parse_json
+from appli.config import DefaultConfig
+from appli.utils.metrics import observe_outbound
+from .httpclient import client
 
 
+@observe_outbound("fetch_products")
 def fetch_products() -> list[dict]:
-    return parse_json(
-        open("https://dimensweb.uqac.ca/~jgnault/shops/products/").read().decode("utf8")
-    )["products"]
+    return client.get(DefaultConfig.PRODUCTS_API_URL).json()["products"]
@@ -0,0 +1,122 @@
+"Group commit of the new orders: a single thread writes the orders of many requests per transaction."
+from concurrent.futures import Future
+from datetime import timedelta
+from logging import getLogger
+from queue import Empty, SimpleQueue
+from threading import Thread
+from time import monotonic
+
+from appli.extensions import db
+from appli.model.flat import FlatOrder
+from appli.model.model import RESERVATION_TTL, add_order
+from appli.utils.metrics import Histogram, registry
+
+logger = getLogger(__name__)
+
+order_write_batch_size = registry.register(
+    Histogram(
+        "order_write_batch_size",
+        "Orders created per transaction by the order writer.",
+        buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+    )
+)
+
+_STOP = object()
+
+
+class OrderWriter:
+    """Creates the orders submitted by the requests, committing those that arrive
+    within a short window together, so that they share one transaction and one fsync.
+
+    Each order gets its own savepoint: one that can't be created (product out of
+    stock...) doesn't fail the others.
+
+    Args:
+        window (float, optional): Seconds to wait for more orders after the first one.
+        max_batch (int, optional): Most orders per transaction.
+    """
+
+    def __init__(self, window: float = 0.002, max_batch: int = 100):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue: SimpleQueue = SimpleQueue()
+        self._thread: Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = Thread(target=self._run, name="order-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(
+        self, quantities: dict[int, int], reserved_for: timedelta = RESERVATION_TTL
+    ) -> FlatOrder:
+        """Create an order, same as add_order, once its batch is committed.
+
+        Raises:
+            UnknownProduct: A product does not exist.
+            OutOfInventory: A product is not in stock, or not in this quantity.
+
+        Returns:
+            FlatOrder: The new order.
+        """
+        if not self.running:
+            return add_order(quantities, reserved_for)
+        future: Future = Future()
+        self._queue.put((quantities, reserved_for, future))
+        return future.result()
+
+    def _next_batch(self) -> list | None:
+        first = self._queue.get()
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - monotonic()))
+            except Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)  # write this batch, then stop
+                break
+            batch.append(item)
+        return batch
+
+    def _write(self, batch: list):
+        results: list[tuple[Future, FlatOrder | None, Exception | None]] = []
+        try:
+            with db.connection_context(), db.atomic("IMMEDIATE"):
+                for quantities, reserved_for, future in batch:
+                    try:  # add_order runs in a savepoint of this transaction
+                        results.append((future, add_order(quantities, reserved_for), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:  # the commit failed, none of the orders exist
+            logger.exception("could not write a batch of %d orders", len(batch))
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        order_write_batch_size.observe(len(batch))
+        for future, order, error in results:
+            if error is None:
+                future.set_result(order)
+            else:
+                future.set_exception(error)
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            self._write(batch)
+
+
+order_writer = OrderWriter()
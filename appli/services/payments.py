@@ -0,0 +1,129 @@
+"Background workers charging the orders queued in the payment queue."
+from datetime import timedelta
+from logging import getLogger
+from threading import Event, Thread
+
+from appli.config import DefaultConfig
+from appli.extensions import db
+from appli.model.model import (
+    Order,
+    charge_order,
+    claim_payment_job,
+    finish_payment_job,
+    requeue_stale_payment_jobs,
+    retry_payment_job,
+    set_payment_status,
+)
+from appli.services.external.chargingapi import PaymentOutcomeUnknown, PaymentUnavailable
+
+logger = getLogger(__name__)
+
+
+def process_next_payment(
+    max_attempts: int = DefaultConfig.PAYMENT_JOB_MAX_ATTEMPTS,
+    retry_backoff: float = DefaultConfig.PAYMENT_JOB_RETRY_BACKOFF,
+) -> bool:
+    """Charge the order of the oldest pending payment job.
+
+    A charge refused by an unavailable gateway is put back in the queue, to be tried
+    again later. Any other failure ends the job. Either way, the order shows the
+    status of its payment and the error.
+
+    Args:
+        max_attempts (int, optional): Most attempts of a job.
+        retry_backoff (float, optional): Seconds before the second attempt, doubled
+            for each next one (or the wait asked by the gateway, if longer).
+
+    Returns:
+        bool: Whether a job was processed (False if the queue is empty).
+    """
+    job = claim_payment_job()
+    if job is None:
+        return False
+    try:
+        charge_order(job.order_id)
+    except PaymentUnavailable as e:
+        if job.attempts + 1 < max_attempts:
+            delay = max(e.retry_after, retry_backoff * 2 ** job.attempts)
+            logger.warning("payment job %s retried in %.1fs: %s", job.id, delay, e)
+            retry_payment_job(job.id, timedelta(seconds=delay), error=repr(e))
+            set_payment_status(job.order_id, Order.PAYMENT_RETRYING, str(e))
+        else:
+            finish_payment_job(job.id, error=repr(e))
+            set_payment_status(job.order_id, Order.PAYMENT_FAILED, str(e))
+    except PaymentOutcomeUnknown as e:  # the order is marked for reconciliation
+        logger.error("payment job %s has an unknown outcome: %s", job.id, e)
+        finish_payment_job(job.id, error=repr(e))
+    except Exception as e:
+        logger.exception("payment job %s failed", job.id)
+        finish_payment_job(job.id, error=repr(e))
+        set_payment_status(job.order_id, Order.PAYMENT_FAILED, str(e) or repr(e))
+    else:
+        finish_payment_job(job.id)
+    return True
+
+
+class PaymentWorkers:
+    "Pool of threads emptying the payment queue."
+
+    def __init__(
+        self,
+        workers: int = 4,
+        poll_interval: float = 1.0,
+        max_attempts: int = DefaultConfig.PAYMENT_JOB_MAX_ATTEMPTS,
+        retry_backoff: float = DefaultConfig.PAYMENT_JOB_RETRY_BACKOFF,
+    ):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._threads: list[Thread] = []
+
+    def start(self, stale_after: timedelta | None = None):
+        """Start the worker threads.
+
+        Args:
+            stale_after (timedelta | None, optional): Put back in the queue the jobs
+                claimed longer ago than this, left behind by a previous process.
+        """
+        if stale_after is not None:
+            with db.connection_context():
+                requeue_stale_payment_jobs(stale_after)
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = Thread(target=self._run, name=f"payment-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def wake(self):
+        "Tell the workers a job was just queued instead of waiting for the next poll."
+        self._wakeup.set()
+
+    def stop(self, timeout: float | None = None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads.clear()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                with db.connection_context():
+                    while not self._stopping.is_set() and process_next_payment(
+                        self.max_attempts, self.retry_backoff
+                    ):
+                        pass
+            except Exception:
+                logger.exception("payment worker crashed, restarting")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+payment_workers = PaymentWorkers()
@@ -0,0 +1,57 @@
+"Background release of the stock reserved by orders left unpaid."
+from logging import getLogger
+from threading import Event, Thread
+
+from appli.extensions import db
+from appli.model.model import release_expired_reservations
+
+logger = getLogger(__name__)
+
+
+class ReservationReleaser:
+    "Periodically gives back to the stock the products of the expired reservations."
+
+    def __init__(self):
+        self._thread: Thread | None = None
+        self._stopping = Event()
+
+    def release(self) -> int:
+        """Release the expired reservations now.
+
+        Returns:
+            int: Number of orders released.
+        """
+        with db.connection_context():
+            released = release_expired_reservations()
+        if released:
+            logger.info("released the stock of %d unpaid orders", released)
+        return released
+
+    def start(self, interval: float):
+        """Release the expired reservations in a background thread, once per process.
+
+        Args:
+            interval (float): Seconds between two releases, 0 to never release them.
+        """
+        if not interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = Thread(
+            target=self._run, args=(interval,), name="reservation-releaser", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float | None = None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self, interval: float):
+        while not self._stopping.wait(interval):
+            try:
+                self.release()
+            except Exception:
+                logger.exception("could not release the expired reservations")
+
+
+reservation_releaser = ReservationReleaser()
@@ -0,0 +1,206 @@
+"""
+Prices of many orders at once, from columns of order lines, with NumPy when it is
+installed and plain Python otherwise.
+
+Both backends use the tables of appli.utils.pricing and give, for every order, exactly
+the cents of price_order().
+"""
+from dataclasses import dataclass
+from itertools import groupby
+from typing import Callable, Sequence
+
+from appli.utils.pricing import (
+    SHIPPING_BOUNDS,
+    SHIPPING_PRICES,
+    TAX_BASIS_POINTS,
+    PriceBreakdown,
+    shipping_cents,
+    tax_cents,
+    to_cents,
+)
+from appli.utils.taxes import UnknownProvince
+
+try:
+    import numpy
+except ImportError:  # optional dependency
+    numpy = None
+
+# Cents of the parts of a price that can't be known yet, None in PriceBreakdown
+UNKNOWN = -1
+
+
+@dataclass(slots=True, frozen=True)
+class BulkPrices:
+    "Prices of many orders in cents, one column per part of PriceBreakdown."
+    order_ids: Sequence[int]
+    subtotal: Sequence[int]
+    tax: Sequence[int]
+    shipping: Sequence[int]
+    weight: Sequence[int]
+    total: Sequence[int]
+
+    def __len__(self) -> int:
+        return len(self.order_ids)
+
+    def breakdown(self, i: int) -> PriceBreakdown:
+        "Price of the i-th order, same as price_order() gives."
+
+        def known(cents) -> int | None:
+            return None if cents == UNKNOWN else int(cents)
+
+        return PriceBreakdown(
+            subtotal=int(self.subtotal[i]),
+            tax=known(self.tax[i]),
+            shipping=known(self.shipping[i]),
+            weight=known(self.weight[i]),
+        )
+
+    def summary(self) -> dict[str, int]:
+        "Number of orders and sum of each part of their prices, over the known ones."
+        tax, without_tax = _known_sum(self.tax)
+        shipping, without_shipping = _known_sum(self.shipping)
+        return {
+            "orders": len(self),
+            "subtotal": _known_sum(self.subtotal)[0],
+            "tax": tax,
+            "shipping": shipping,
+            "total": _known_sum(self.total)[0],
+            "without_tax": without_tax,
+            "without_shipping": without_shipping,
+        }
+
+
+def _known_sum(column: Sequence[int]) -> tuple[int, int]:
+    "Sum of the known cents of a column, and how many are unknown."
+    if numpy is not None and isinstance(column, numpy.ndarray):
+        unknown = column == UNKNOWN
+        return int(column[~unknown].sum()), int(unknown.sum())
+    return sum(c for c in column if c != UNKNOWN), column.count(UNKNOWN)
+
+
+def _python_prices(
+    order_ids: Sequence[int],
+    prices: Sequence[float],
+    quantities: Sequence[int],
+    weights: Sequence[int | None],
+    provinces: Sequence[str | None],
+) -> BulkPrices:
+    columns: tuple[list[int], ...] = ([], [], [], [], [], [])
+    ids, subtotals, taxes, shippings, order_weights, totals = columns
+    lines = zip(order_ids, prices, quantities, weights, provinces)
+    for order_id, order_lines in groupby(lines, key=lambda line: line[0]):
+        subtotal = 0
+        weight: int | None = 0
+        for _, price, quantity, line_weight, province in order_lines:
+            subtotal += to_cents(price) * quantity
+            if weight is not None and line_weight is not None:
+                weight += line_weight * quantity
+            else:
+                weight = None
+        tax = UNKNOWN if province is None else tax_cents(subtotal, province)
+        shipping = UNKNOWN if weight is None else shipping_cents(weight)
+        ids.append(order_id)
+        subtotals.append(subtotal)
+        taxes.append(tax)
+        shippings.append(shipping)
+        order_weights.append(UNKNOWN if weight is None else weight)
+        totals.append(
+            UNKNOWN if UNKNOWN in (tax, shipping) else subtotal + tax + shipping
+        )
+    return BulkPrices(*columns)
+
+
+def _numpy_prices(
+    order_ids: Sequence[int],
+    prices: Sequence[float],
+    quantities: Sequence[int],
+    weights: Sequence[int | None],
+    provinces: Sequence[str | None],
+) -> BulkPrices:
+    np = numpy
+    ids = np.asarray(order_ids, dtype=np.int64)
+    if not len(ids):
+        return BulkPrices(*(np.empty(0, dtype=np.int64) for _ in range(6)))
+    # first line of each order, the lines of an order being adjacent
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    # rint rounds half to even on the same doubles as round() in to_cents
+    cents = np.rint(np.asarray(prices, dtype=np.float64) * 100).astype(np.int64)
+    line_quantities = np.asarray(quantities, dtype=np.int64)
+    subtotal = np.add.reduceat(cents * line_quantities, starts)
+
+    line_weights = np.asarray(weights, dtype=np.float64)  # None becomes NaN
+    weight_known = np.logical_and.reduceat(~np.isnan(line_weights), starts)
+    line_weights = np.nan_to_num(line_weights).astype(np.int64)
+    weight = np.add.reduceat(line_weights * line_quantities, starts)
+    shipping_prices = np.asarray(SHIPPING_PRICES, dtype=np.int64)
+    shipping = np.where(
+        weight_known,
+        shipping_prices[np.searchsorted(SHIPPING_BOUNDS, weight, side="right")],
+        UNKNOWN,
+    )
+
+    # one lookup per province shipped to, not per order
+    order_provinces = np.asarray(provinces, dtype=object)[starts]
+    not_shipped = order_provinces == None  # noqa: E711
+    codes, inverse = np.unique(
+        np.where(not_shipped, "", order_provinces).astype(str), return_inverse=True
+    )
+    unknown = [c for c in codes if c and c not in TAX_BASIS_POINTS]
+    if unknown:
+        raise UnknownProvince()
+    basis_points = np.asarray(
+        [TAX_BASIS_POINTS.get(c, UNKNOWN) for c in codes], dtype=np.int64
+    )[inverse]
+    tax = np.where(
+        basis_points != UNKNOWN, (subtotal * basis_points + 5_000) // 10_000, UNKNOWN
+    )
+    total = np.where(
+        (tax != UNKNOWN) & (shipping != UNKNOWN), subtotal + tax + shipping, UNKNOWN
+    )
+    return BulkPrices(
+        order_ids=ids[starts],
+        subtotal=subtotal,
+        tax=tax,
+        shipping=shipping,
+        weight=np.where(weight_known, weight, UNKNOWN),
+        total=total,
+    )
+
+
+BACKENDS: dict[str, Callable[..., BulkPrices]] = {"python": _python_prices}
+if numpy is not None:
+    BACKENDS["numpy"] = _numpy_prices
+
+
+def price_orders(
+    order_ids: Sequence[int],
+    prices: Sequence[float],
+    quantities: Sequence[int],
+    weights: Sequence[int | None],
+    provinces: Sequence[str | None],
+    backend: str = "auto",
+) -> BulkPrices:
+    """Price many orders from the columns of their lines, those of an order adjacent.
+
+    An order without lines is given as a single line of price, quantity and weight 0.
+
+    Args:
+        order_ids (Sequence[int]): Order of each line.
+        prices (Sequence[float]): Unit price of the product of each line.
+        quantities (Sequence[int]): Quantity of each line.
+        weights (Sequence[int | None]): Unit weight of the product of each line.
+        provinces (Sequence[str | None]): Province the order of each line is shipped to.
+        backend (str, optional): "auto", "python" or "numpy".
+
+    Raises:
+        ValueError: The backend is unknown or not installed.
+        UnknownProvince: An order is shipped to a province with no tax rate.
+
+    Returns:
+        BulkPrices: Prices of the orders, in the order of their lines.
+    """
+    if backend == "auto":
+        backend = "numpy" if "numpy" in BACKENDS else "python"
+    if backend not in BACKENDS:
+        raise ValueError(f"pricing backend {backend!r} is not available")
+    return BACKENDS[backend](order_ids, prices, quantities, weights, provinces)
@@ -1,5 +1,7 @@
+from typing import Callable
+
 from appli.model.flat import FlatProduct, FlatOrder
-from appli.utils.taxes import calculate_tax, calculate_shipping_price
+from appli.utils.pricing import price_order, to_amount
 
 
 class Json:
@@ -29,6 +31,53 @@ class Json:
         return True
 
 
+Validator = Callable[[object], str | None]
+
+
+def compile_schema(schema: dict, prefix: str = "") -> Validator:
+    """Compile a JSON schema (same format as Json.is_like) into a validator function.
+
+    The schema is walked once here; the validator only runs the precomputed checks
+    and allocates nothing.
+
+    Args:
+        schema (dict): JSON validation schema (key: type or key: {key: type} etc).
+        prefix (str, optional): Path of the schema in its parent schema.
+
+    Returns:
+        Validator: Function returning None if the JSON is valid, else the dotted
+            path of the first missing or mistyped field.
+    """
+    checks = tuple(
+        (
+            k,
+            prefix + k,
+            None if isinstance(v, dict) else v,
+            compile_schema(v, f"{prefix}{k}.") if isinstance(v, dict) else None,
+        )
+        for k, v in schema.items()
+    )
+    root = checks[0][1] if checks else None
+
+    def validate(json) -> str | None:
+        if not isinstance(json, dict):
+            return root
+        for key, path, kind, nested in checks:
+            if key not in json:
+                return path
+            value = json[key]
+            if nested is None:
+                if not isinstance(value, kind):
+                    return path
+            elif not isinstance(value, dict):
+                return path
+            elif (failed := nested(value)) is not None:
+                return failed
+        return None
+
+    return validate
+
+
 def serialize_product(product: FlatProduct) -> dict:
     return {
         "name": product.name,
@@ -42,16 +91,17 @@ def serialize_product(product: FlatProduct) -> dict:
 
 
 def serialize_order(order: FlatOrder) -> dict:
-    total_price = order.products.product.price * order.products.quantity
-    return {
+    price = price_order(order)
+    subtotal_with_tax = price.subtotal_with_tax
+    lines = [
+        {"id": line.product.id, "quantity": line.quantity} for line in order.products
+    ]
+    serialized = {
         "order": {
             "id": order.id,
-            "total_price": total_price,
+            "total_price": to_amount(price.subtotal),
             "total_price_tax": (
-                None
-                if order.shipping_information is None
-                else calculate_tax(order.shipping_information.province) * total_price
-                + total_price
+                None if subtotal_with_tax is None else to_amount(subtotal_with_tax)
             ),
             "email": order.email,
             "credit_card": (
@@ -86,16 +136,17 @@ def serialize_order(order: FlatOrder) -> dict:
                 }
             ),
             "paid": order.paid,
-            "product": {
-                "id": order.products.product.id,
-                "quantity": order.products.quantity,
-            },
+            "payment": (
+                {}
+                if order.payment_status is None
+                else {"status": order.payment_status, "error": order.payment_error}
+            ),
+            "products": lines,
             "shipping_price": (
-                None
-                if order.products.product.weight is None
-                else calculate_shipping_price(
-                    order.products.product.weight * order.products.quantity
-                )
+                None if price.shipping is None else to_amount(price.shipping)
             ),
         }
     }
+    if len(lines) == 1:  # orders with a single product, as before multi-product orders
+        serialized["order"]["product"] = lines[0]
+    return serialized
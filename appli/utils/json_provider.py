@@ -0,0 +1,103 @@
+"""
+JSON encoding and decoding of the API, with orjson when it is installed and the standard library otherwise.
+"""
+import json
+from typing import Any, Callable
+
+from flask import Response
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def _stdlib_dumps(obj: Any, sort_keys: bool, indent: bool) -> bytes:
+    return json.dumps(
+        obj,
+        default=_default,
+        sort_keys=sort_keys,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":"),
+    ).encode()
+
+
+def _orjson_dumps(obj: Any, sort_keys: bool, indent: bool) -> bytes:
+    option = orjson.OPT_NON_STR_KEYS
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=_default, option=option)
+
+
+BACKENDS: dict[str, Callable[[Any, bool, bool], bytes]] = {"json": _stdlib_dumps}
+if orjson is not None:
+    BACKENDS["orjson"] = _orjson_dumps
+
+_backend = "orjson" if orjson is not None else "json"
+
+
+def backend() -> str:
+    "Name of the encoder in use."
+    return _backend
+
+
+def set_backend(name: str):
+    """Choose the encoder, "auto" picking the fastest one installed.
+
+    Args:
+        name (str): "auto", "json" or "orjson".
+
+    Raises:
+        ValueError: The backend is unknown or not installed.
+    """
+    global _backend
+    if name == "auto":
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"JSON backend {name!r} is not available")
+    _backend = name
+
+
+def dumps_bytes(obj: Any, sort_keys: bool = False, indent: bool = False) -> bytes:
+    """Serialize to UTF-8 JSON with the current backend, for bodies encoded once and sent many times.
+
+    Args:
+        obj (Any): Data to serialize.
+        sort_keys (bool, optional): Sort the keys of dicts. Defaults to False.
+        indent (bool, optional): Pretty print. Defaults to False.
+
+    Returns:
+        bytes: Encoded JSON.
+    """
+    return BACKENDS[_backend](obj, sort_keys, indent)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    "Flask JSON provider encoding responses and decoding requests with the current backend."
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if kwargs:  # options only the standard library knows about
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        if _backend == "orjson" and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    @property
+    def indent(self) -> bool:
+        return (self.compact is None and self._app.debug) or self.compact is False
+
+    def dumps_bytes(self, obj: Any) -> bytes:
+        "Encode a response body, same as response() would."
+        return dumps_bytes(obj, sort_keys=self.sort_keys, indent=self.indent)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            self.dumps_bytes(obj) + b"\n", mimetype=self.mimetype
+        )
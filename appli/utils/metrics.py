@@ -0,0 +1,176 @@
+"Minimal in-process metrics (counters, gauges, histograms) exposed in the Prometheus text format."
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    "Gauge read from a callback when the metrics are scraped, so setting it costs nothing."
+
+    def __init__(self, name: str, help: str, read: Callable[[], float | None]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> list[str]:
+        value = self.read()
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        if value is not None:
+            lines.append(f"{self.name} {float(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label values: count of each bucket (not cumulative, last one is +Inf), sum
+        self._series: dict[tuple, tuple[list[int], list[float]]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1][0] += value
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return 0 if series is None else sum(series[0])
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total) in self._series.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    le = _labels(self.labelnames, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                label_str = _labels(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{label_str} {total[0]}")
+                lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter(
+        "http_requests_total", "HTTP requests served.", ("route", "method", "status")
+    )
+)
+http_request_duration = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time spent serving HTTP requests.",
+        ("route", "method"),
+    )
+)
+outbound_calls = registry.register(
+    Counter("outbound_calls_total", "Calls to the external APIs.", ("call", "outcome"))
+)
+outbound_call_duration = registry.register(
+    Histogram(
+        "outbound_call_duration_seconds", "Duration of the calls to the external APIs.", ("call",)
+    )
+)
+
+outbound_retries = registry.register(
+    Counter("outbound_call_retries_total", "Retried calls to the external APIs.", ("call",))
+)
+outbound_rejected = registry.register(
+    Counter(
+        "outbound_calls_rejected_total",
+        "Calls to the external APIs failed fast by an open circuit breaker.",
+        ("call",),
+    )
+)
+
+
+def observe_outbound(call: str):
+    """Decorator recording the duration and outcome (ok or error) of a call to an external API.
+
+    Args:
+        call (str): Name of the call in the metrics.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            outcome = "error"
+            try:
+                result = fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                outbound_call_duration.observe(perf_counter() - start, call)
+                outbound_calls.inc(call, outcome)
+
+        return wrapper
+
+    return decorator
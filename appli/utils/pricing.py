@@ -0,0 +1,110 @@
+"""
+Prices of the orders, computed in integer cents so that totals never drift.
+
+The tax rates and shipping prices are those of appli.utils.taxes, converted once into
+tables: basis points (1/100 of a percent) by province and shipping prices in cents by
+weight bracket. Amounts only become floats again for the JSON and the payment gateway.
+"""
+from bisect import bisect_right
+from dataclasses import dataclass
+
+from appli.model.flat import FlatOrder
+from appli.utils.taxes import (
+    PROVINCES,
+    UnknownProvince,
+    calculate_shipping_price,
+    calculate_tax,
+)
+
+
+def to_cents(amount: float) -> int:
+    "Cents of an amount in dollars, such as a price read from the database."
+    return round(amount * 100)
+
+
+def to_amount(cents: int) -> float:
+    "Amount in dollars of some cents, for the JSON and the payment gateway."
+    return cents / 100
+
+
+# Tax rate of each province, in basis points
+TAX_BASIS_POINTS: dict[str, int] = {
+    province: round(calculate_tax(province) * 10_000) for province in PROVINCES
+}
+
+# Shipping price of the weights from each bound (in grams) up to the next one: below the
+# first bound, SHIPPING_PRICES[0], from SHIPPING_BOUNDS[i], SHIPPING_PRICES[i + 1]
+SHIPPING_BOUNDS = (0, 500, 2000)
+SHIPPING_PRICES = tuple(
+    to_cents(calculate_shipping_price(grams)) for grams in (-1, *SHIPPING_BOUNDS)
+)
+
+
+def tax_cents(subtotal: int, province: str) -> int:
+    """Tax on an amount, rounded half up to the cent.
+
+    Raises:
+        UnknownProvince: The province has no tax rate.
+    """
+    basis_points = TAX_BASIS_POINTS.get(province)
+    if basis_points is None:
+        raise UnknownProvince()
+    return (subtotal * basis_points + 5_000) // 10_000
+
+
+def shipping_cents(grams: int) -> int:
+    "Price to ship an order of this weight."
+    return SHIPPING_PRICES[bisect_right(SHIPPING_BOUNDS, grams)]
+
+
+@dataclass(slots=True, frozen=True)
+class PriceBreakdown:
+    "Price of an order, in cents."
+    subtotal: int
+    # None until the order has a shipping address
+    tax: int | None = None
+    # None while the weight of one of the products is unknown
+    shipping: int | None = None
+    weight: int | None = None
+
+    @property
+    def subtotal_with_tax(self) -> int | None:
+        return None if self.tax is None else self.subtotal + self.tax
+
+    @property
+    def total(self) -> int | None:
+        "Amount to charge, None until it can be known."
+        if self.tax is None or self.shipping is None:
+            return None
+        return self.subtotal + self.tax + self.shipping
+
+
+def price_order(order: FlatOrder) -> PriceBreakdown:
+    """Price of the products of an order, its tax and its shipping.
+
+    Args:
+        order (FlatOrder): The order.
+
+    Raises:
+        UnknownProvince: The order is shipped to a province with no tax rate.
+
+    Returns:
+        PriceBreakdown: Every part of the price, in cents.
+    """
+    subtotal = 0
+    weight: int | None = 0
+    for line in order.products:
+        subtotal += to_cents(line.product.price) * line.quantity
+        if weight is not None and line.product.weight is not None:
+            weight += line.product.weight * line.quantity
+        else:
+            weight = None
+    shipping_information = order.shipping_information
+    return PriceBreakdown(
+        subtotal=subtotal,
+        tax=None
+        if shipping_information is None
+        else tax_cents(subtotal, shipping_information.province),
+        shipping=None if weight is None else shipping_cents(weight),
+        weight=weight,
+    )
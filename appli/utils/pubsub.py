@@ -0,0 +1,93 @@
+"In-process publish/subscribe, waking up the requests waiting for something to change."
+from queue import Empty, SimpleQueue
+from threading import Lock
+from typing import Any, Hashable
+
+
+class Subscription:
+    "Messages published on one key of a channel, from the moment of subscribing."
+
+    def __init__(self, channel: "Channel", key: Hashable):
+        self.channel = channel
+        self.key = key
+        self._queue: SimpleQueue = SimpleQueue()
+
+    def put(self, message: Any):
+        self._queue.put(message)
+
+    def get(self, timeout: float | None = None) -> Any | None:
+        """Wait for the next message.
+
+        Args:
+            timeout (float | None, optional): Seconds to wait, None to wait forever.
+
+        Returns:
+            Any | None: The message, or None if none was published in time.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def latest(self, timeout: float | None = None) -> Any | None:
+        "Wait for a message, then skip to the last one published."
+        message = self.get(timeout)
+        while not self._queue.empty():
+            message = self._queue.get_nowait()
+        return message
+
+    def close(self):
+        self.channel.unsubscribe(self)
+
+    def __enter__(self) -> "Subscription":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Channel:
+    """Messages published by key to the subscriptions of that key.
+
+    Only the subscribers of this process are reached: with several worker processes,
+    a message published by one of them isn't seen by the others.
+    """
+
+    def __init__(self):
+        self._subscriptions: dict[Hashable, set[Subscription]] = {}
+        self._lock = Lock()
+
+    def subscribe(self, key: Hashable) -> Subscription:
+        subscription = Subscription(self, key)
+        with self._lock:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.key)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.key]
+
+    def publish(self, key: Hashable, message: Any) -> int:
+        """Send a message to every subscription of a key.
+
+        Args:
+            key (Hashable): Key of the subscriptions.
+            message (Any): Message, shared by all the subscribers.
+
+        Returns:
+            int: Number of subscriptions reached.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+        return len(subscriptions)
+
+    def subscribers(self) -> int:
+        "Number of open subscriptions, all keys together."
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
@@ -2,6 +2,10 @@ class UnknownProvince(Exception):
     pass
 
 
+# Provinces connues de calculate_tax
+PROVINCES = ("QC", "ON", "AB", "BC", "NS")
+
+
 def calculate_tax(province: str) -> float:
     """Calcule les taxes en fonction de la province.
 
@@ -0,0 +1,198 @@
+"""
+Time and memory to load orders as flat dataclasses, on a temporary database.
+
+Compares three ways of hydrating the same orders:
+
+- models: peewee Model objects (prefetched lines and products), then flatten(),
+- tuples: .tuples() rows, converted by the peewee fields, then the flat dataclasses,
+- raw: sqlite3 rows straight into the flat dataclasses (what load_order does),
+
+and the memory held per order by the slotted flat dataclasses against the same
+dataclasses without slots (each instance with its own __dict__).
+
+    python -m benchmarks.bench_hydration [orders]
+"""
+import gc
+import sys
+import tracemalloc
+from dataclasses import dataclass, fields, is_dataclass
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+
+from peewee import prefetch
+
+from appli.extensions import db
+from appli.model import flat
+from appli.model.flat import FlatProduct
+from appli.model.model import (
+    CreditCardDetails,
+    Order,
+    Product,
+    ProductOrderQuantity,
+    ShippingInformation,
+    Transaction,
+    _orders_from_rows,
+    load_orders,
+    order_query,
+    sync_products,
+)
+from benchmarks.common import create_database
+
+PRODUCTS = 100
+
+
+def setup_database(path: str, orders: int):
+    "Fill a new database with orders of 1 to 3 lines, half of them shipped."
+    create_database(path)
+    sync_products(
+        [
+            FlatProduct(
+                id=i,
+                name=f"Product {i}",
+                price=10 + i % 90,
+                image=f"{i}.jpg",
+                description="Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+                weight=100 + i % 900,
+            )
+            for i in range(1, PRODUCTS + 1)
+        ]
+    )
+    with db.atomic():
+        for start in range(0, orders, 10000):
+            ids = range(start + 1, min(start + 10000, orders) + 1)
+            ShippingInformation.insert_many(
+                {
+                    "id": i,
+                    "country": "Canada",
+                    "address": f"{i} boulevard de l'Université",
+                    "postal_code": "G7H 2B1",
+                    "city": "Chicoutimi",
+                    "province": "QC",
+                }
+                for i in ids
+                if i % 2
+            ).execute()
+            Order.insert_many(
+                {
+                    "id": i,
+                    "email": f"client{i}@uqac.ca",
+                    "shipping_information": i if i % 2 else None,
+                    "paid": False,
+                }
+                for i in ids
+            ).execute()
+            ProductOrderQuantity.insert_many(
+                {"oid": i, "pid": (i + line) % PRODUCTS + 1, "quantity": line + 1}
+                for i in ids
+                for line in range(i % 3 + 1)
+            ).execute()
+
+
+def with_models() -> list:
+    orders = prefetch(
+        Order.select().order_by(Order.id),
+        CreditCardDetails.select(),
+        ShippingInformation.select(),
+        Transaction.select(),
+        ProductOrderQuantity.select().order_by(ProductOrderQuantity.id),
+        Product.select(),
+    )
+    return [order.flatten() for order in orders]
+
+
+def with_tuples() -> list:
+    return list(_orders_from_rows(order_query().tuples()))
+
+
+def with_raw_rows() -> list:
+    return list(load_orders())
+
+
+def timed(hydrate: Callable[[], list]) -> tuple[list, float]:
+    "Run a hydration, returns its result and its duration."
+    gc.collect()
+    start = perf_counter()
+    result = hydrate()
+    return result, perf_counter() - start
+
+
+def held_bytes(hydrate: Callable[[], list]) -> int:
+    "Run a hydration again under tracemalloc, returns the bytes its result holds."
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = hydrate()  # noqa: F841, held until measured
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return held
+
+
+def without_slots(cls: type) -> type:
+    "Same dataclass as cls, without slots: each instance has its own __dict__."
+    namespace = {
+        "__annotations__": {f.name: f.type for f in fields(cls)},
+        **{f.name: f.default for f in fields(cls)},
+    }
+    return dataclass(frozen=True)(type(cls.__name__, (), namespace))
+
+
+def rebuild(value, classes: dict[str, type]):
+    "Copy of flat objects built with other classes, sharing their leaf values."
+    if is_dataclass(value):
+        cls = classes[type(value).__name__]
+        return cls(
+            **{f.name: rebuild(getattr(value, f.name), classes) for f in fields(value)}
+        )
+    if isinstance(value, list):
+        return [rebuild(v, classes) for v in value]
+    return value
+
+
+def flat_classes(transform: Callable[[type], type]) -> dict[str, type]:
+    return {
+        name: transform(cls)
+        for name, cls in vars(flat).items()
+        if isinstance(cls, type) and is_dataclass(cls)
+    }
+
+
+def main(orders: int = 100_000):
+    with TemporaryDirectory() as tmp:
+        setup_database(f"{tmp}/bench.db", orders)
+        print(f"{orders} orders")
+        print(f"{'hydration':<10}{'time (s)':>10}{'orders/s':>12}{'bytes/order':>14}")
+        results = {}
+        for name, hydrate in (
+            ("models", with_models),
+            ("tuples", with_tuples),
+            ("raw", with_raw_rows),
+        ):
+            with db.connection_context():
+                result, elapsed = timed(hydrate)
+                assert len(result) == orders
+                results[name] = result
+                del result
+                held = held_bytes(hydrate)
+            print(
+                f"{name:<10}{elapsed:>10.2f}{orders / elapsed:>12.0f}"
+                f"{held / orders:>14.0f}"
+            )
+        assert results["models"] == results["tuples"] == results["raw"]
+        loaded = results["raw"]
+        del results
+
+        # the copies share the strings and numbers: only the instances are counted
+        print(f"\n{'instances':<10}{'bytes/order':>14}")
+        for name, classes in (
+            ("dict", flat_classes(without_slots)),
+            ("slots", flat_classes(lambda cls: cls)),
+        ):
+            held = held_bytes(lambda: [rebuild(o, classes) for o in loaded])
+            print(f"{name:<10}{held / orders:>14.0f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""
+Throughput of GET / and GET /order/<id> with each JSON backend, on a temporary database.
+
+    python -m benchmarks.bench_json [products] [requests]
+"""
+import sys
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from appli.extensions import db
+from appli.model.flat import FlatProduct
+from appli.model.model import add_order, reload_catalog, sync_products
+from appli.routes.api import api, order_cache
+from appli.utils import json_provider
+from benchmarks.common import create_database
+
+
+def setup_database(path: str, products: int) -> int:
+    "Fill a new database with products and one order, returns the order ID."
+    create_database(path)
+    sync_products(
+        [
+            FlatProduct(
+                id=i,
+                name=f"Product {i}",
+                price=10 + i % 90,
+                image=f"{i}.jpg",
+                description="Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+                weight=100 + i % 900,
+            )
+            for i in range(1, products + 1)
+        ]
+    )
+    reload_catalog()
+    return add_order({1: 2}).id
+
+
+def requests_per_second(client, url: str, requests: int, before=None) -> float:
+    start = perf_counter()
+    for _ in range(requests):
+        if before is not None:
+            before()
+        assert client.get(url).status_code == 200
+    return requests / (perf_counter() - start)
+
+
+def main(products: int = 1000, requests: int = 2000):
+    with TemporaryDirectory() as tmp:
+        order_id = setup_database(f"{tmp}/bench.db", products)
+        client = api.test_client()
+        print(f"{products} products, {requests} requests per run")
+        print(f"{'backend':<10}{'GET / (req/s)':>16}{'GET /order (req/s)':>22}")
+        for backend in sorted(json_provider.BACKENDS):
+            json_provider.set_backend(backend)
+            reload_catalog()  # the product list is encoded once per reload
+            products_rps = requests_per_second(client, "/", requests)
+            # clearing the cache measures the encoding of the order, not a cache hit
+            order_rps = requests_per_second(
+                client, f"/order/{order_id}", requests, before=order_cache.clear
+            )
+            print(f"{backend:<10}{products_rps:>16.0f}{order_rps:>22.0f}")
+        db.close()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
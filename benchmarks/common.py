@@ -0,0 +1,12 @@
+"Helpers shared by the benchmarks."
+from appli.config import DefaultConfig
+from appli.extensions import db
+from appli.model.model import MODELS
+
+
+def create_database(path: str):
+    "Point the app at a new database file and create its tables."
+    db.close()
+    db.init(path, pragmas=DefaultConfig.DATABASE_PRAGMAS)
+    with db.connection_context():
+        db.create_tables(MODELS)
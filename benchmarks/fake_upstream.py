@@ -0,0 +1,154 @@
+"Local stand-ins for the products API and the payment gateway."
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as serialize, loads as parse_json
+from random import Random
+from secrets import token_hex
+from threading import Lock, Thread
+from time import sleep
+
+# Always declined, like on the real payment gateway
+DECLINED_CARD = "4000 0000 0000 0002"
+
+
+def fake_products(count: int) -> list[dict]:
+    return [
+        {
+            "id": i,
+            "name": f"Product {i}",
+            "in_stock": i % 10 != 0,
+            "description": "Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+            "price": float(10 + i % 90),
+            "weight": 100 + (i * 37) % 2500,
+            "image": f"{i}.jpg",
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, json):
+        body = serialize(json).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeServer:
+    "HTTP server running in a daemon thread on a free local port."
+
+    handler: type[_Handler]
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.server.fake = self
+        self.server.daemon_threads = True
+        self._thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def start(self) -> "FakeServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _ProductsHandler(_Handler):
+    def do_GET(self):
+        self.reply(200, {"products": self.server.fake.products})
+
+
+class FakeProductsAPI(FakeServer):
+    handler = _ProductsHandler
+
+    def __init__(self, products: int = 50):
+        super().__init__()
+        self.products = fake_products(products)
+
+
+class _PaymentHandler(_Handler):
+    def do_POST(self):
+        gateway: FakePaymentGateway = self.server.fake
+        json = parse_json(self.rfile.read(int(self.headers["Content-Length"])))
+        gateway.count()  # before answering, so that callers see it once answered
+        if gateway.latency:
+            sleep(gateway.delay())
+        if gateway.failure_status is not None:
+            self.reply(gateway.failure_status, {"error": "gateway failure"})
+        elif json["credit_card"]["number"] == DECLINED_CARD or gateway.declines():
+            self.reply(
+                422,
+                {
+                    "errors": {
+                        "credit_card": {
+                            "code": "card-declined",
+                            "name": "The credit card was declined",
+                        }
+                    }
+                },
+            )
+        else:
+            self.reply(
+                200,
+                {
+                    "credit_card": json["credit_card"],
+                    "transaction": {
+                        "id": token_hex(16),
+                        "success": True,
+                        "amount_charged": json["amount_charged"],
+                    },
+                },
+            )
+
+
+class FakePaymentGateway(FakeServer):
+    """Payment gateway answering like the real one, after a configurable latency.
+
+    Args:
+        latency (float, optional): Mean seconds before answering.
+        jitter (float, optional): Latency varies uniformly by up to this many seconds.
+        decline_rate (float, optional): Share of the valid cards declined at random.
+        seed (int, optional): Seed of the random generator, for reproducible runs.
+    """
+
+    handler = _PaymentHandler
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        decline_rate: float = 0.0,
+        seed: int = 349,
+    ):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.decline_rate = decline_rate
+        # set to an HTTP status to make every charge fail with it
+        self.failure_status: int | None = None
+        self.charges = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+
+    def delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-1, 1) * self.jitter)
+
+    def declines(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.decline_rate
+
+    def count(self):
+        with self._lock:
+            self.charges += 1
@@ -0,0 +1,269 @@
+"""
+Load test of the full order flow against local stand-ins of the products API and payment gateway.
+
+Each simulated client creates an order, sets its shipping information, pays it
+and reads it back. Latency percentiles and throughput are printed per endpoint
+and written as JSON, so that runs can be compared. "payment" is the time from the
+credit card PUT until the order has its transaction: with --async-payments, the order
+is polled until the workers charged it, so that both modes time the same thing.
+
+    python -m benchmarks.load --concurrency 8 --orders 400 --payment-latency 0.2
+"""
+import os
+from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from json import dump, dumps
+from pathlib import Path
+from random import Random
+from statistics import fmean
+from subprocess import run
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+from benchmarks.fake_upstream import FakePaymentGateway, FakeProductsAPI
+
+SHIPPING_INFORMATION = {
+    "order": {
+        "email": "jgnault@uqac.ca",
+        "shipping_information": {
+            "country": "Canada",
+            "address": "201, rue Président-Kennedy",
+            "postal_code": "G7X 3Y7",
+            "city": "Chicoutimi",
+            "province": "QC",
+        },
+    }
+}
+
+CREDIT_CARD = {
+    "credit_card": {
+        "name": "John Doe",
+        "number": "4242 4242 4242 4242",
+        "expiration_year": 2030,
+        "cvv": "123",
+        "expiration_month": 9,
+    }
+}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    "Nearest-rank percentile of already sorted values."
+    rank = max(1, round(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Recorder:
+    "Latency and status of every request, per endpoint."
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self._lock = Lock()
+
+    def record(self, endpoint: str, seconds: float, ok: bool):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, duration: float) -> dict:
+        result = {}
+        for endpoint, values in self.latencies.items():
+            values = sorted(values)
+            result[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors[endpoint],
+                "throughput": len(values) / duration,
+                "mean_ms": fmean(values) * 1000,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+        return result
+
+
+# seconds between two reads of an order whose payment is queued, and longest wait
+PAYMENT_POLL_INTERVAL = 0.01
+PAYMENT_TIMEOUT = 60
+
+
+def payment_done(order: dict) -> bool:
+    "Whether the payment of an order is over: charged, declined or given up."
+    return bool(order["transaction"]) or order["payment"].get("status") in (
+        "failed",
+        "unknown",
+    )
+
+
+def order_flow(client, base: str, recorder: Recorder, product_ids: list[int], random: Random):
+    "One checkout: POST /order, PUT shipping, PUT credit card, GET /order."
+
+    def timed(endpoint: str, method: str, url: str, json=None, ok=(200,)):
+        start = perf_counter()
+        if json is None:
+            response = client.request(method, url)
+        else:
+            response = client.request(
+                method,
+                url,
+                body=dumps(json).encode(),
+                headers={"Content-Type": "application/json"},
+            )
+        recorder.record(endpoint, perf_counter() - start, response.status in ok)
+        return response
+
+    response = timed(
+        "POST /order",
+        "POST",
+        base + "order",
+        {"product": {"id": random.choice(product_ids), "quantity": random.randint(1, 3)}},
+        ok=(302,),
+    )
+    if response.status != 302:
+        return
+    url = base + response.headers["Location"].lstrip("/")
+    timed("PUT /order (shipping)", "PUT", url, SHIPPING_INFORMATION)
+    # declined cards answer 422, the request itself went fine
+    start = perf_counter()
+    response = timed(
+        "PUT /order (credit card)", "PUT", url, CREDIT_CARD, ok=(200, 202, 422)
+    )
+    ok = response.status in (200, 422)
+    if response.status == 202:  # charged by the payment workers: wait for them
+        while perf_counter() - start < PAYMENT_TIMEOUT:
+            polled = client.request("GET", url)
+            order = polled.json()["order"] if polled.status == 200 else None
+            if order is not None and payment_done(order):
+                ok = bool(order["transaction"])
+                break
+            sleep(PAYMENT_POLL_INTERVAL)
+    recorder.record("payment", perf_counter() - start, ok)
+    timed("GET /order", "GET", url)
+
+
+def git_revision() -> str | None:
+    result = run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--payment-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--payment-jitter", type=float, default=0.0, help="seconds")
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--async-payments", action="store_true")
+    parser.add_argument("--order-write-batching", action="store_true")
+    parser.add_argument("--seed", type=int, default=349)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("benchmarks/results")
+        / f"load-{datetime.now():%Y%m%d-%H%M%S}.json",
+    )
+    args = parser.parse_args()
+
+    products_api = FakeProductsAPI(args.products).start()
+    gateway = FakePaymentGateway(
+        args.payment_latency, args.payment_jitter, args.decline_rate, args.seed
+    ).start()
+    # read by DefaultConfig, so set before the app is imported (keep appli imports below)
+    os.environ["PRODUCTS_API_URL"] = products_api.url
+    os.environ["CHARGING_API_URL"] = gateway.url
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    from appli import create_app, start_services, stop_services
+    from appli.config import DefaultConfig
+    from appli.extensions import db
+    from appli.services.catalog import catalog_refresher
+    from appli.services.external.httpclient import HttpClient
+    from benchmarks.common import create_database
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    with TemporaryDirectory() as tmp:
+        config = type(
+            "LoadConfig",
+            (DefaultConfig,),
+            {
+                "DEBUG": False,
+                "DATABASE_URI": f"{tmp}/load.db",
+                "ASYNC_PAYMENTS": args.async_payments,
+                "ORDER_WRITE_BATCHING": args.order_write_batching,
+                "PAYMENT_POLL_INTERVAL": 0.05,
+            },
+        )
+        create_database(config.DATABASE_URI)
+        app = create_app(config)
+        start_services()
+        if not catalog_refresher.wait(30):
+            raise SystemExit("the catalog could not be loaded from the fake products API")
+        server = make_server(
+            "127.0.0.1", 0, app, threaded=True, request_handler=KeepAliveHandler
+        )
+        Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}/"
+
+        product_ids = [p["id"] for p in products_api.products if p["in_stock"]]
+        client = HttpClient(max_connections_per_host=args.concurrency, read_timeout=60)
+        recorder = Recorder()
+        random = Random(args.seed)
+        start = perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for future in [
+                pool.submit(
+                    order_flow,
+                    client,
+                    base,
+                    recorder,
+                    product_ids,
+                    Random(random.random()),
+                )
+                for _ in range(args.orders)
+            ]:
+                future.result()
+        duration = perf_counter() - start
+        server.shutdown()
+        client.close()
+        # the workers use the database, removed with the temporary directory
+        stop_services(timeout=10)
+        db.close()
+
+    results = {
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(),
+        "parameters": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+        "duration_s": duration,
+        "orders_per_s": args.orders / duration,
+        "payment_gateway_charges": gateway.charges,
+        "endpoints": recorder.summary(duration),
+    }
+    products_api.stop()
+    gateway.stop()
+
+    print(f"{args.orders} orders, concurrency {args.concurrency}, {duration:.2f}s")
+    print(f"{'endpoint':<26}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    for endpoint, r in results["endpoints"].items():
+        print(
+            f"{endpoint:<26}{r['throughput']:>9.1f}{r['p50_ms']:>9.1f}"
+            f"{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['errors']:>8}"
+        )
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,14 @@
 
 from os import remove as rm
 
+import click
+
 from appli import create_app
 from appli.extensions import db
 from appli.config import DefaultConfig
-from appli.model.model import Product, ShippingInformation, ProductOrderQuantity, CreditCardDetails, Transaction, Order
+from appli.model.migrations import LATEST_VERSION, check_query_plans, migrate, stamp
+from appli.model.model import MODELS, order_price_columns
+from appli.utils.bulk_pricing import BACKENDS as PRICING_BACKENDS, price_orders
 
 application = create_app()
 
@@ -14,11 +18,49 @@ application = create_app()
 def initdb(config=DefaultConfig()):
     """Init/reset database."""
     db.close()
-    try:
-        rm(config.DATABASE_URI)
-    except FileNotFoundError:
-        pass
+    for suffix in ("", "-wal", "-shm"):  # WAL mode leaves two files beside the database
+        try:
+            rm(config.DATABASE_URI + suffix)
+        except FileNotFoundError:
+            pass
     db.connect()
-    db.create_tables([Product, ShippingInformation, ProductOrderQuantity, CreditCardDetails, Transaction, Order])
+    db.create_tables(MODELS)
+    stamp(LATEST_VERSION)
 
     # préparation de la base
+
+
+@application.cli.command("migrate")
+def migratedb():
+    """Upgrade the database schema in place, then check the query plans."""
+    with db.connection_context():
+        applied = migrate()
+        for version, description, _ in applied:
+            click.echo(f"applied migration {version}: {description}")
+        if not applied:
+            click.echo(f"database already at version {LATEST_VERSION}")
+        problems = check_query_plans()
+    for name, scans in problems.items():
+        click.echo(f"{name} scans a whole table: {'; '.join(scans)}", err=True)
+    if problems:
+        raise SystemExit(1)
+
+
+@application.cli.command("price-report")
+@click.option(
+    "--backend",
+    type=click.Choice(["auto", *PRICING_BACKENDS]),
+    default="auto",
+    help="Pricing backend, numpy when it is installed by default.",
+)
+def price_report(backend):
+    """Price every order in bulk and print the totals."""
+    with db.connection_context():
+        columns = order_price_columns()
+    summary = price_orders(*columns, backend=backend).summary()
+    click.echo(f"orders: {summary['orders']}")
+    for part in ("subtotal", "tax", "shipping", "total"):
+        cents = summary[part]
+        click.echo(f"{part}: {cents // 100}.{cents % 100:02d}")
+    click.echo(f"orders without shipping address: {summary['without_tax']}")
+    click.echo(f"orders without known weight: {summary['without_shipping']}")
@@ -3,13 +3,16 @@ from types import NoneType
 import pytest
 from json import dumps as serialize_json
 
-from appli import create_app
+from appli import create_app, start_services
+from appli.services.catalog import catalog_refresher
 from appli.utils.json import Json
 
 
 @pytest.fixture
 def client():
     app = create_app()
+    start_services()
+    catalog_refresher.wait(timeout=30)
 
     app.config["TESTING"] = True
     app.testing = True
@@ -205,6 +208,7 @@ def test_Commande_Sans_Produit(client):
             "product": {
                 "code": "missing-fields",
                 "name": "La création d'une commande nécessite un produit",
+                "field": "product",
             }
         }
     }, "Le message d'erreur retourné est incorrect"
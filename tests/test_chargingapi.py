@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import pytest
+from time import perf_counter, sleep
+
+from appli.config import DefaultConfig
+from appli.services.external import chargingapi
+from appli.services.external.chargingapi import (
+    CircuitBreaker,
+    PaymentOutcomeUnknown,
+    PaymentUnavailable,
+    RetryBudget,
+    charge,
+)
+from benchmarks.fake_upstream import FakePaymentGateway
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    gateway = FakePaymentGateway().start()
+    monkeypatch.setattr(DefaultConfig, "CHARGING_API_URL", gateway.url)
+    monkeypatch.setattr(DefaultConfig, "CHARGING_READ_TIMEOUT", 0.3)
+    monkeypatch.setattr(DefaultConfig, "CHARGING_RETRY_BACKOFF", 0.01)
+    monkeypatch.setattr(chargingapi, "breaker", CircuitBreaker(3, reset_timeout=0.2))
+    monkeypatch.setattr(chargingapi, "retry_budget", RetryBudget(ratio=0.2, burst=10))
+    yield gateway
+    gateway.stop()
+
+
+def pay() -> dict:
+    return charge("John Doe", 4242424242424242, 2030, "123", 9, 10.0)
+
+
+def test_charge(gateway):
+    assert pay()["transaction"]["success"] is True
+    assert chargingapi.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_unavailable_gateway_is_retried(gateway):
+    gateway.failure_status = 503
+    with pytest.raises(PaymentUnavailable):
+        pay()
+    assert gateway.charges == DefaultConfig.CHARGING_MAX_ATTEMPTS
+
+
+def test_server_errors_are_not_retried(gateway):
+    gateway.failure_status = 500
+    with pytest.raises(PaymentOutcomeUnknown):  # the gateway may have charged
+        pay()
+    assert gateway.charges == 1
+
+
+def test_slow_gateway_times_out_without_retry(gateway):
+    gateway.latency = 1.0
+    start = perf_counter()
+    with pytest.raises(PaymentOutcomeUnknown):
+        pay()
+    assert perf_counter() - start < 0.9
+    assert chargingapi.breaker.failures == 1  # a single attempt
+
+
+def test_unreachable_gateway(gateway, monkeypatch):
+    gateway.stop()
+    monkeypatch.setattr(DefaultConfig, "CHARGING_API_URL", "http://127.0.0.1:9/")
+    with pytest.raises(PaymentUnavailable):
+        pay()
+    assert chargingapi.breaker.failures == DefaultConfig.CHARGING_MAX_ATTEMPTS
+
+
+def test_breaker_opens_then_probes(gateway):
+    gateway.failure_status = 500
+    for _ in range(3):
+        with pytest.raises(PaymentOutcomeUnknown):
+            pay()
+    assert chargingapi.breaker.state == CircuitBreaker.OPEN
+
+    # open: fails fast, without calling the gateway
+    with pytest.raises(PaymentUnavailable) as error:
+        pay()
+    assert gateway.charges == 3
+    assert 0 < error.value.retry_after <= 0.2
+
+    sleep(0.25)
+    assert chargingapi.breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(PaymentOutcomeUnknown):
+        pay()  # the probe fails, open again
+    assert chargingapi.breaker.state == CircuitBreaker.OPEN
+
+    sleep(0.25)
+    gateway.failure_status = None
+    assert pay()["transaction"]["success"] is True
+    assert chargingapi.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_breaker_lets_a_single_call_through():
+    breaker = CircuitBreaker(1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.5, burst=1)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
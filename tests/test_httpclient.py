@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import pytest
+from gzip import compress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps as serialize_json, loads as parse_json
+from threading import Thread
+from time import sleep
+
+from appli.services.external.httpclient import ConnectError, HttpClient, HttpError
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    "Local stand-in for the external APIs, counting the connections it accepts."
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, **headers):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k.replace("_", "-"), v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        body = serialize_json({"products": [{"id": 1}]}).encode()
+        if self.path == "/slow":
+            sleep(1)
+        if self.path == "/gzip" and "gzip" in self.headers.get("Accept-Encoding", ""):
+            self._reply(200, compress(body), Content_Encoding="gzip")
+        else:
+            self._reply(200, body)
+
+    def do_POST(self):
+        json = parse_json(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/drop":  # acts on the request, then dies without answering
+            self.server.received.append(json)
+            self.close_connection = True
+            return
+        self._reply(422, serialize_json({"echo": json}).encode())
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.connections = 0
+    server.received = []
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path: str) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_connections_are_reused(server):
+    client = HttpClient()
+    for _ in range(5):
+        assert client.get(url(server, "/")).json() == {"products": [{"id": 1}]}
+    assert server.connections == 1
+    client.close()
+
+
+def test_error_status_keeps_body(server):
+    client = HttpClient()
+    response = client.post_json(url(server, "/pay"), {"amount_charged": 10.0})
+    assert response.status == 422
+    assert response.json() == {"echo": {"amount_charged": 10.0}}
+    client.close()
+
+
+def test_gzip(server):
+    assert HttpClient(gzip=True).get(url(server, "/gzip")).json() == {
+        "products": [{"id": 1}]
+    }
+    assert HttpClient(gzip=False).get(url(server, "/gzip")).json() == {
+        "products": [{"id": 1}]
+    }
+
+
+def test_read_timeout(server):
+    with pytest.raises(HttpError):
+        HttpClient(read_timeout=0.1).get(url(server, "/slow"))
+
+
+def test_connection_refused():
+    with pytest.raises(HttpError):
+        HttpClient(connect_timeout=0.5).get("http://127.0.0.1:9/")
+
+
+def test_connections_per_host_limit(server):
+    client = HttpClient(max_connections_per_host=1, connect_timeout=0.1)
+    pool = client._pool("http", "127.0.0.1", server.server_address[1])
+    connection, _ = pool.acquire(client.connect_timeout, client.read_timeout)
+    with pytest.raises(HttpError):
+        client.get(url(server, "/"))
+    pool.release(connection, reusable=True)
+    assert client.get(url(server, "/")).status == 200
+    client.close()
+
+
+def test_post_is_not_resent_on_a_reused_connection(server):
+    client = HttpClient()
+    assert client.get(url(server, "/")).status == 200  # keeps the connection alive
+    with pytest.raises(HttpError) as error:
+        client.post_json(url(server, "/drop"), {"charge": 2})
+    assert not isinstance(error.value, ConnectError)
+    assert server.received == [{"charge": 2}]
+    client.close()
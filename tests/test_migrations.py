@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from appli.config import DefaultConfig
+from appli.extensions import db
+from appli.model.migrations import (
+    LATEST_VERSION,
+    check_query_plans,
+    migrate,
+    schema_version,
+    stamp,
+)
+from appli.model.model import MODELS, Order, Product, ProductOrderQuantity, load_order
+
+# Schema of the first version of the application: one product per order
+LEGACY_SCHEMA = [
+    'CREATE TABLE "product" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, '
+    '"in_stock" INTEGER NOT NULL, "description" TEXT, "price" DECIMAL(5, 2) NOT NULL '
+    'CHECK (price > 0), "weight" INTEGER CHECK (weight > 0), "image" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "shippinginformation" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"country" VARCHAR(255) NOT NULL, "address" VARCHAR(255) NOT NULL, '
+    '"postal_code" VARCHAR(255) NOT NULL, "city" VARCHAR(255) NOT NULL, '
+    '"province" VARCHAR(2) NOT NULL)',
+    'CREATE TABLE "productorderquantity" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"pid_id" INTEGER NOT NULL, "quantity" INTEGER NOT NULL CHECK (quantity > 0), '
+    'FOREIGN KEY ("pid_id") REFERENCES "product" ("id"))',
+    'CREATE INDEX "productorderquantity_pid_id" ON "productorderquantity" ("pid_id")',
+    'CREATE TABLE "creditcarddetails" ("id" INTEGER NOT NULL PRIMARY KEY, '
+    '"name" VARCHAR(255) NOT NULL, "number" DECIMAL(16, 0) NOT NULL, '
+    '"expiration_year" DECIMAL(4, 0) NOT NULL, "cvv" DECIMAL(3, 0) NOT NULL, '
+    '"expiration_month" DECIMAL(2, 0) NOT NULL)',
+    'CREATE TABLE "transaction" ("id" VARCHAR(32) NOT NULL PRIMARY KEY, '
+    '"success" INTEGER NOT NULL, "amount_charged" DECIMAL(10, 2) NOT NULL)',
+    'CREATE TABLE "order" ("id" INTEGER NOT NULL PRIMARY KEY, "product_id" INTEGER NOT NULL, '
+    '"email" VARCHAR(255), "credit_card_id" INTEGER, "shipping_information_id" INTEGER, '
+    '"transaction_id" VARCHAR(32), "paid" INTEGER NOT NULL, '
+    'FOREIGN KEY ("product_id") REFERENCES "productorderquantity" ("id"), '
+    'FOREIGN KEY ("credit_card_id") REFERENCES "creditcarddetails" ("id"), '
+    'FOREIGN KEY ("shipping_information_id") REFERENCES "shippinginformation" ("id"), '
+    'FOREIGN KEY ("transaction_id") REFERENCES "transaction" ("id"))',
+    'CREATE INDEX "order_product_id" ON "order" ("product_id")',
+    "INSERT INTO product VALUES (1, 'Brown eggs', 1, NULL, 28.1, 400, '0.jpg')",
+    "INSERT INTO product VALUES (2, 'Green smoothie', 0, NULL, 12.5, NULL, '2.jpg')",
+    "INSERT INTO productorderquantity VALUES (7, 1, 2), (8, 2, 1)",
+    "INSERT INTO shippinginformation VALUES (1, 'Canada', '201, rue Président-Kennedy', "
+    "'G7X 3Y7', 'Chicoutimi', 'QC')",
+    'INSERT INTO "order" VALUES (3, 8, NULL, NULL, NULL, NULL, 0), '
+    "(4, 7, 'jgnault@uqac.ca', NULL, 1, NULL, 0)",
+]
+
+
+@pytest.fixture
+def database(tmp_path):
+    db.close()
+    db.init(str(tmp_path / "test.db"), pragmas=DefaultConfig.DATABASE_PRAGMAS)
+    db.connect()
+    yield db
+    db.close()
+    db.init(DefaultConfig.DATABASE_URI)
+
+
+def test_legacy_database_is_migrated_in_place(database):
+    for statement in LEGACY_SCHEMA:
+        database.execute_sql(statement)
+
+    assert [m[0] for m in migrate()] == list(range(1, LATEST_VERSION + 1))
+    assert schema_version() == LATEST_VERSION
+    assert migrate() == []
+
+    order = load_order(4)
+    assert order.email == "jgnault@uqac.ca"
+    assert order.shipping_information.city == "Chicoutimi"
+    assert [(line.id, line.product.id, line.quantity) for line in order.products] == [
+        (7, 1, 2)
+    ]
+    assert [line.product.name for line in load_order(3).products] == ["Green smoothie"]
+    assert Product.get_by_id(1).stock == DefaultConfig.PRODUCT_INITIAL_STOCK
+    assert Order.get_by_id(3).reserved_until is None
+    assert "product_id" not in {c.name for c in database.get_columns("order")}
+    assert not [c for c in database.get_columns("productorderquantity") if c.null]
+    assert check_query_plans() == {}
+
+    # the migrated schema works with the current models
+    order_id = Order.insert(paid=False).execute()
+    ProductOrderQuantity.insert(oid=order_id, pid=1, quantity=1).execute()
+    assert len(load_order(order_id).products) == 1
+
+
+def test_new_database(database):
+    database.create_tables(MODELS)
+    stamp()
+    assert migrate() == []
+    assert check_query_plans() == {}
+
+
+def test_query_plan_check_finds_scans(database):
+    database.create_tables(MODELS)
+    database.execute_sql('DROP INDEX "order_reserved_until"')
+    assert list(check_query_plans()) == ["expired reservations"]
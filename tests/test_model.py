@@ -0,0 +1,894 @@
+# -*- coding: utf-8 -*-
+import pytest
+from dataclasses import replace
+from datetime import datetime, timedelta
+from hashlib import sha256
+from json import loads as parse_json
+from threading import Event, Thread
+
+from appli.config import DefaultConfig
+from appli.extensions import db
+from appli.routes.api import api, order_cache
+from appli.services.catalog import CatalogRefresher
+from appli.services.external.chargingapi import PaymentOutcomeUnknown, PaymentUnavailable
+from appli.services.order_writer import OrderWriter, order_write_batch_size
+from appli.services.payments import process_next_payment
+from appli.utils.bulk_pricing import BACKENDS as PRICING_BACKENDS, price_orders
+from appli.utils.pricing import price_order
+from appli.model.flat import FlatProduct, FlatShippingInformation
+from appli.model.model import (
+    MODELS,
+    IdempotencyKey,
+    Order,
+    Product,
+    ProductOrderQuantity,
+    PaymentJob,
+    OrderNotFound,
+    OutOfInventory,
+    add_order,
+    add_product,
+    catalog,
+    claim_idempotency_key,
+    get_product,
+    order_events,
+    get_products_body,
+    load_order,
+    load_orders,
+    order_price_columns,
+    put_order_shipping_information,
+    release_expired_reservations,
+    release_idempotency_key,
+    reload_catalog,
+    sync_products,
+)
+
+
+@pytest.fixture
+def database(tmp_path):
+    db.close()
+    db.init(str(tmp_path / "test.db"), pragmas=DefaultConfig.DATABASE_PRAGMAS)
+    db.connect()
+    db.create_tables(MODELS)
+    add_product(
+        FlatProduct(name="Brown eggs", price=28.1, image="0.jpg", weight=400)
+    )
+    add_product(
+        FlatProduct(name="Sweet fresh stawberry", price=29.45, image="1.jpg", weight=299)
+    )
+    add_product(
+        FlatProduct(name="Green smoothie", price=12.5, image="2.jpg", in_stock=False)
+    )
+    reload_catalog()
+    order_cache.clear()
+    yield db
+    db.close()
+    db.init(DefaultConfig.DATABASE_URI)
+
+
+def test_catalog_serves_products_without_queries(database, monkeypatch):
+    def no_query(*args, **kwargs):
+        raise AssertionError("the catalog should not query the database")
+
+    monkeypatch.setattr(database, "execute_sql", no_query)
+    hits = catalog.hits
+    assert get_product(2).name == "Sweet fresh stawberry"
+    assert catalog.hits == hits + 1
+    body = parse_json(get_products_body())
+    assert [p["id"] for p in body["products"]] == [1, 2, 3]
+
+
+def test_catalog_miss(database):
+    misses = catalog.misses
+    with pytest.raises(Product.DoesNotExist):
+        get_product(42)
+    assert catalog.misses == misses + 1
+
+
+def test_catalog_reload_swaps_version(database):
+    before = catalog.current
+    add_product(FlatProduct(name="Tomatoes", price=3.0, image="3.jpg"))
+    assert 4 not in catalog.current.products, "catalog changed before reload"
+    after = reload_catalog()
+    assert after.version == before.version + 1
+    assert get_product(4).name == "Tomatoes"
+    assert 4 not in before.products, "old snapshot was mutated"
+
+
+def test_sync_products_writes_only_the_diff(database, queries):
+    upstream = [
+        FlatProduct(id=1, name="Brown eggs", price=30.0, image="0.jpg", weight=400),
+        FlatProduct(
+            id=2, name="Sweet fresh stawberry", price=29.45, image="1.jpg", weight=299
+        ),
+        FlatProduct(id=10, name="Tomatoes", price=3.0, image="3.jpg"),
+    ]
+
+    report = sync_products(upstream)
+    assert (report.inserted, report.updated, report.removed) == (1, 1, 1)
+    products = {p.id: p for p in map(lambda p: p.flatten(), Product.select())}
+    assert sorted(products) == [1, 2, 10]
+    assert products[1].price == 30.0
+
+    queries.clear()
+    report = sync_products(upstream)
+    assert (report.inserted, report.updated, report.removed) == (0, 0, 0)
+    assert not any(q.startswith(("INSERT", "UPDATE", "DELETE")) for q in queries)
+
+
+def test_sync_invalidates_the_orders_of_repriced_products(client):
+    order_id = new_order_id(client)  # 2 brown eggs
+    first = client.get(f"/order/{order_id}")
+    upstream = [p.flatten() for p in Product.select()]
+    sync_products([p if p.id != 1 else replace(p, price=50.0) for p in upstream])
+    response = client.get(
+        f"/order/{order_id}", headers={"If-None-Match": first.headers["ETag"]}
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != first.headers["ETag"]
+    assert response.json["order"]["total_price"] == 100.0
+
+
+def test_sync_keeps_products_that_have_orders(client):
+    order_id = new_order_id(client)  # 2 brown eggs
+    report = sync_products(
+        [FlatProduct(id=2, name="Sweet fresh stawberry", price=29.45, image="1.jpg")]
+    )
+    assert (report.removed, report.retired) == (1, 1)  # green smoothie, brown eggs
+    assert not Product.get_by_id(1).in_stock
+    reload_catalog()
+    response = client.get(f"/order/{order_id}")
+    assert response.status_code == 200
+    assert response.json["order"]["product"] == {"id": 1, "quantity": 2}
+    assert [o.id for o in load_orders()] == [order_id]
+
+    report = sync_products(
+        [FlatProduct(id=2, name="Sweet fresh stawberry", price=29.45, image="1.jpg")]
+    )
+    assert (report.removed, report.retired) == (0, 0)
+
+
+def test_readers_are_not_blocked_by_writer(database):
+    assert database.execute_sql("PRAGMA journal_mode").fetchone()[0] == "wal"
+    writing, done = Event(), Event()
+
+    def writer():
+        with database.connection_context(), database.atomic():
+            Order.create()
+            writing.set()
+            done.wait(5)
+
+    thread = Thread(target=writer)
+    thread.start()
+    assert writing.wait(5)
+    try:
+        assert Order.select().count() == 0, "uncommitted row visible"
+        assert Product.select().count() == 3
+    finally:
+        done.set()
+        thread.join()
+    assert Order.select().count() == 1
+
+
+@pytest.fixture
+def client(database):
+    api.config["TESTING"] = True
+    yield api.test_client()
+
+
+@pytest.fixture
+def queries(database, monkeypatch):
+    "Records the SQL of every statement run against the database."
+    executed = []
+    execute_sql = database.execute_sql
+
+    def recording_execute_sql(sql, params=None, *args, **kwargs):
+        executed.append(sql)
+        return execute_sql(sql, params, *args, **kwargs)
+
+    monkeypatch.setattr(database, "execute_sql", recording_execute_sql)
+    return executed
+
+
+def fake_charge(name, number, expiration_year, cvv, expiration_month, amount_charged):
+    return {
+        "transaction": {
+            "id": "wgEQ4zAUdYqpr21rt8A10dDrKbfcLmqi",
+            "success": True,
+            "amount_charged": amount_charged,
+        }
+    }
+
+
+SHIPPING_INFORMATION = {
+    "order": {
+        "email": "jgnault@uqac.ca",
+        "shipping_information": {
+            "country": "Canada",
+            "address": "201, rue Président-Kennedy",
+            "postal_code": "G7X 3Y7",
+            "city": "Chicoutimi",
+            "province": "QC",
+        },
+    }
+}
+
+CREDIT_CARD = {
+    "credit_card": {
+        "name": "John Doe",
+        "number": "4242 4242 4242 4242",
+        "expiration_year": 2025,
+        "cvv": "123",
+        "expiration_month": 9,
+    }
+}
+
+
+def new_order_id(client) -> int:
+    response = client.post("/order", json={"product": {"id": 1, "quantity": 2}})
+    return int(response.headers["Location"].split("/")[-1])
+
+
+def test_get_order_single_query(client, queries):
+    order_id = new_order_id(client)
+    queries.clear()
+    response = client.get(f"/order/{order_id}")
+    assert response.status_code == 200
+    # the version of the order, then the order with everything it links to
+    assert len(queries) == 2, queries
+
+
+def test_put_order_query_counts(client, queries, monkeypatch):
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    order_id = new_order_id(client)
+
+    queries.clear()
+    response = client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    assert response.status_code == 200
+    # the address and the order (with its version) are written in one transaction
+    assert len(queries) == 5, queries
+
+    queries.clear()
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 200
+    assert response.get_json()["order"]["paid"] is True
+    # one more to extend the reservation of the stock while charging
+    assert len(queries) == 11, queries
+
+
+def test_async_payment(client, monkeypatch):
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    monkeypatch.setitem(api.config, "ASYNC_PAYMENTS", True)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 202
+    assert response.headers["Location"] == f"/order/{order_id}"
+    assert client.get(f"/order/{order_id}").get_json()["order"]["paid"] is False
+
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 422
+    assert response.get_json()["errors"]["order"]["code"] == "payment-pending"
+
+    assert process_next_payment()
+    assert not process_next_payment(), "the job was processed twice"
+    data = client.get(f"/order/{order_id}").get_json()["order"]
+    assert data["paid"] is True
+    assert data["transaction"]["success"] is True
+    assert PaymentJob.get().status == PaymentJob.DONE
+
+
+def test_async_payment_retried_then_failed(client, monkeypatch):
+    def unavailable(*args):
+        raise PaymentUnavailable("the payment gateway is failing", retry_after=0)
+
+    monkeypatch.setattr("appli.model.model.charge", unavailable)
+    monkeypatch.setitem(api.config, "ASYNC_PAYMENTS", True)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    assert client.put(f"/order/{order_id}", json=CREDIT_CARD).status_code == 202
+    assert client.get(f"/order/{order_id}").json["order"]["payment"] == {
+        "status": "pending",
+        "error": None,
+    }
+
+    assert process_next_payment(max_attempts=2, retry_backoff=60)
+    job = PaymentJob.get()
+    assert job.status == PaymentJob.PENDING and job.run_after > datetime.now()
+    assert not process_next_payment(max_attempts=2), "claimed before its delay"
+    payment = client.get(f"/order/{order_id}").json["order"]["payment"]
+    assert payment["status"] == "retrying"
+
+    PaymentJob.update(run_after=datetime.now()).execute()
+    assert process_next_payment(max_attempts=2)
+    assert PaymentJob.get().status == PaymentJob.FAILED
+    assert client.get(f"/order/{order_id}").json["order"]["payment"] == {
+        "status": "failed",
+        "error": "the payment gateway is failing",
+    }
+
+    # paying again queues a new job, its transaction ends the payment
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    assert client.put(f"/order/{order_id}", json=CREDIT_CARD).status_code == 202
+    assert process_next_payment()
+    order = client.get(f"/order/{order_id}").json["order"]
+    assert order["paid"] is True and order["payment"] == {}
+
+
+def test_catalog_refresh_failure_keeps_serving(client, monkeypatch):
+    def unreachable():
+        raise OSError("products API unreachable")
+
+    monkeypatch.setattr("appli.services.catalog.fetch_products", unreachable)
+    refresher = CatalogRefresher()
+    monkeypatch.setattr("appli.routes.api.catalog_refresher", refresher)
+    assert refresher.refresh() is None
+
+    assert client.get("/ready").status_code == 200
+    status = client.get("/health").get_json()["catalog"]
+    assert status["size"] == 3
+    assert status["last_sync"] is None
+    assert "unreachable" in status["last_error"]
+
+
+def test_catalog_refresh(client, monkeypatch):
+    monkeypatch.setattr(
+        "appli.services.catalog.fetch_products",
+        lambda: [
+            {
+                "id": 7,
+                "name": "Tomatoes",
+                "price": 3.0,
+                "image": "3.jpg",
+                "in_stock": True,
+                "description": None,
+                "weight": 100,
+            }
+        ],
+    )
+    refresher = CatalogRefresher()
+    monkeypatch.setattr("appli.routes.api.catalog_refresher", refresher)
+    report = refresher.refresh()
+    assert (report.inserted, report.updated, report.removed) == (1, 0, 3)
+    assert refresher.wait(0)
+
+    status = client.get("/health").get_json()["catalog"]
+    assert status["size"] == 1
+    assert status["last_error"] is None
+    assert [p["id"] for p in client.get("/").get_json()["products"]] == [7]
+
+
+def test_get_order_etag(client, queries):
+    order_id = new_order_id(client)
+    first = client.get(f"/order/{order_id}")
+    etag = first.headers["ETag"]
+
+    queries.clear()
+    cached = client.get(f"/order/{order_id}")
+    assert cached.data == first.data
+    not_modified = client.get(f"/order/{order_id}", headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert len(queries) == 2, "cached order was read beyond its version"
+    assert all('SELECT "t1"."version"' in q for q in queries), queries
+
+    # a write by another process is seen: the version is stored with the order
+    Order.update(version=Order.version + 1, email="x@uqac.ca").execute()
+    assert client.get(f"/order/{order_id}").get_json()["order"]["email"] == "x@uqac.ca"
+    with pytest.raises(OrderNotFound):  # not a 304 for an order that does not exist
+        client.get("/order/9999", headers={"If-None-Match": "9999-0"})
+
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    changed = client.get(f"/order/{order_id}", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.get_json()["order"]["email"] == "jgnault@uqac.ca"
+
+
+def test_list_products_pages(client):
+    data = client.get("/?limit=2").get_json()
+    assert [p["id"] for p in data["products"]] == [1, 2]
+    data = client.get(data["next"]).get_json()
+    assert [p["id"] for p in data["products"]] == [3]
+    assert data["next"] is None
+
+
+def test_list_products_filters_and_fields(client):
+    data = client.get("/?in_stock=true&min_price=20&fields=name,price").get_json()
+    assert data["products"] == [
+        {"name": "Brown eggs", "price": 28.1},
+        {"name": "Sweet fresh stawberry", "price": 29.45},
+    ]
+    data = client.get("/?max_weight=300").get_json()
+    assert [p["id"] for p in data["products"]] == [2]
+
+
+def test_listings_agree_on_null_description(client):
+    Product.update(description=None).where(Product.id == 1).execute()
+    reload_catalog()
+    cached = client.get("/").get_json()["products"][0]
+    paged = client.get("/?limit=5").get_json()["products"][0]
+    assert cached["description"] is paged["description"] is None
+    assert cached == paged
+    assert Product.get_by_id(1).flatten().description is None
+
+
+def test_list_products_invalid_parameters(client):
+    response = client.get("/?fields=name,colour")
+    assert response.status_code == 422
+    assert response.get_json()["errors"]["parameters"]["field"] == "fields"
+    assert client.get("/?limit=0").status_code == 422
+    assert client.get("/?in_stock=maybe").status_code == 422
+    assert client.get("/?sort=price").status_code == 422
+
+
+def test_metrics(client):
+    client.get("/")
+    order_id = new_order_id(client)
+    client.get(f"/order/{order_id}")
+
+    text = client.get("/metrics").get_data(as_text=True)
+    assert 'http_requests_total{route="list_products",method="GET",status="200"}' in text
+    assert 'http_requests_total{route="new_order",method="POST",status="302"}' in text
+    assert 'http_requests_total{route="get_order",method="GET",status="200"}' in text
+    assert 'http_request_duration_seconds_bucket{route="get_order",method="GET",le="+Inf"}' in text
+    assert "catalog_products 3.0" in text
+
+
+def test_query_stats_headers(client, monkeypatch):
+    monkeypatch.setitem(api.config, "QUERY_STATS_HEADERS", True)
+    order_id = new_order_id(client)
+    response = client.get(f"/order/{order_id}")
+    assert response.headers["X-Query-Count"] == "2"
+    assert float(response.headers["X-Query-Time-Ms"]) > 0
+    response = client.get(f"/order/{order_id}")
+    assert response.headers["X-Query-Count"] == "1", "cached order was queried"
+
+
+def test_slow_query_log(client, monkeypatch, caplog):
+    monkeypatch.setattr(db, "slow_query_threshold", 0)
+    order_id = new_order_id(client)
+    caplog.clear()
+    client.get(f"/order/{order_id}")
+    version, record = caplog.records
+    assert "get_order" in record.getMessage()
+    assert 'FROM "order"' in record.getMessage()
+
+
+def test_idempotent_order_creation(client, queries):
+    headers = {"Idempotency-Key": "8d4c8e4e-order"}
+    first = client.post(
+        "/order", json={"product": {"id": 1, "quantity": 2}}, headers=headers
+    )
+    assert first.status_code == 302
+    retry = client.post(
+        "/order", json={"product": {"id": 1, "quantity": 2}}, headers=headers
+    )
+    assert retry.status_code == 302
+    assert retry.headers["Location"] == first.headers["Location"]
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert Order.select().count() == 1
+
+    reused = client.put(first.headers["Location"], json=CREDIT_CARD, headers=headers)
+    assert reused.status_code == 422
+    assert reused.get_json()["errors"]["idempotency_key"]["code"] == (
+        "idempotency-key-reused"
+    )
+    other_body = client.post(
+        "/order", json={"product": {"id": 1, "quantity": 3}}, headers=headers
+    )
+    assert other_body.status_code == 422
+    assert Order.select().count() == 1
+
+
+def test_idempotent_payment(client, monkeypatch):
+    charges = []
+
+    def counting_charge(*args):
+        charges.append(args)
+        return fake_charge(*args)
+
+    monkeypatch.setattr("appli.model.model.charge", counting_charge)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    headers = {"Idempotency-Key": "8d4c8e4e-payment"}
+    first = client.put(f"/order/{order_id}", json=CREDIT_CARD, headers=headers)
+    retry = client.put(f"/order/{order_id}", json=CREDIT_CARD, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.get_json() == first.get_json()
+    assert len(charges) == 1
+
+
+def test_idempotency_key_expires(client):
+    headers = {"Idempotency-Key": "8d4c8e4e-expired"}
+    client.post("/order", json={"product": {"id": 1, "quantity": 2}}, headers=headers)
+    IdempotencyKey.update(expires_at=datetime.now() - timedelta(seconds=1)).execute()
+    client.post("/order", json={"product": {"id": 1, "quantity": 2}}, headers=headers)
+    assert Order.select().count() == 2
+
+
+def test_idempotency_key_lease(client):
+    key = "8d4c8e4e-crashed"
+    body = b'{"product": {"id": 1, "quantity": 2}}'
+    headers = {"Idempotency-Key": key, "Content-Type": "application/json"}
+    # a request still processed, or whose process died before answering
+    claim_idempotency_key(
+        key, "POST", "/order", sha256(body).hexdigest(), timedelta(seconds=60)
+    )
+    in_use = client.post("/order", data=body, headers=headers)
+    assert in_use.status_code == 409
+    assert Order.select().count() == 0
+
+    IdempotencyKey.update(expires_at=datetime.now() - timedelta(seconds=1)).execute()
+    retry = client.post("/order", data=body, headers=headers)
+    assert retry.status_code == 302
+    stored = IdempotencyKey.get_by_id(key)
+    assert stored.status == 302
+    assert stored.expires_at > datetime.now() + timedelta(hours=23)
+
+
+def test_idempotent_payment_outcome_unknown(client, monkeypatch):
+    charges = []
+
+    def lost_charge(*args):
+        charges.append(args)
+        raise PaymentOutcomeUnknown("the payment gateway answered 504")
+
+    monkeypatch.setattr("appli.model.model.charge", lost_charge)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    headers = {"Idempotency-Key": "8d4c8e4e-unknown"}
+    first = client.put(f"/order/{order_id}", json=CREDIT_CARD, headers=headers)
+    retry = client.put(f"/order/{order_id}", json=CREDIT_CARD, headers=headers)
+    assert first.status_code == retry.status_code == 502
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert len(charges) == 1
+
+
+def test_idempotency_key_released_by_its_claim_only(database):
+    lease = timedelta(seconds=60)
+    expired, _ = claim_idempotency_key("8d4c8e4e-late", "POST", "/order", "", lease)
+    IdempotencyKey.update(expires_at=datetime.now() - timedelta(seconds=1)).execute()
+    claim, claimed = claim_idempotency_key(
+        "8d4c8e4e-late", "POST", "/order", "", lease
+    )
+    assert claimed
+    # the request whose lease expired fails after another one claimed the key
+    release_idempotency_key(expired)
+    assert IdempotencyKey.get_by_id("8d4c8e4e-late").claimed_at == claim.claimed_at
+    release_idempotency_key(claim)
+    assert not IdempotencyKey.select().exists()
+
+
+def test_batch_order_creation(client, queries):
+    queries.clear()
+    response = client.post(
+        "/orders",
+        json=[
+            {"product": {"id": 1, "quantity": 2}},
+            {"product": {"id": 3, "quantity": 1}},
+            {"product": {"id": 42, "quantity": 1}},
+            {"product": {"quantity": 1}},
+            "not an order",
+            {"product": {"id": 2, "quantity": 5}},
+        ],
+    )
+    assert response.status_code == 200
+    results = response.json["orders"]
+    assert [list(r) for r in results] == [
+        ["id", "location"],
+        ["errors"],
+        ["errors"],
+        ["errors"],
+        ["errors"],
+        ["id", "location"],
+    ]
+    assert results[1]["errors"]["product"]["code"] == "out-of-inventory"
+    assert results[2]["errors"]["product"]["field"] == "product.id"
+    # two multi-row inserts in one transaction, whatever the number of orders
+    assert len([q for q in queries if q.startswith("INSERT")]) == 2
+
+    first = client.get(results[0]["location"]).json["order"]
+    last = client.get(results[5]["location"]).json["order"]
+    assert (first["product"], last["product"]) == (
+        {"id": 1, "quantity": 2},
+        {"id": 2, "quantity": 5},
+    )
+
+
+def test_batch_order_creation_expects_a_list(client):
+    response = client.post("/orders", json={"product": {"id": 1, "quantity": 1}})
+    assert response.status_code == 422
+    assert response.json["errors"]["order"]["code"] == "missing-fields"
+
+
+def test_multi_product_order(client, queries):
+    queries.clear()
+    response = client.post(
+        "/order",
+        json={
+            "products": [
+                {"id": 1, "quantity": 2},
+                {"id": 2, "quantity": 1},
+                {"id": 1, "quantity": 1},
+            ]
+        },
+    )
+    assert response.status_code == 302
+    # stock reservation, order, all lines: the same round-trips whatever the basket size
+    assert [q.split()[0] for q in queries] == [
+        "BEGIN",
+        "UPDATE",
+        "INSERT",
+        "INSERT",
+    ], queries
+
+    order = client.get(response.headers["Location"]).json["order"]
+    assert order["products"] == [{"id": 1, "quantity": 3}, {"id": 2, "quantity": 1}]
+    assert "product" not in order
+    assert order["total_price"] == pytest.approx(28.1 * 3 + 29.45)
+    assert order["shipping_price"] == 10  # 1499 g in total
+
+
+def test_multi_product_order_out_of_stock_writes_nothing(client):
+    response = client.post(
+        "/order",
+        json={"products": [{"id": 1, "quantity": 1}, {"id": 3, "quantity": 1}]},
+    )
+    assert response.status_code == 422
+    assert response.json["errors"]["product"]["code"] == "out-of-inventory"
+    response = client.post("/order", json={"products": [{"id": 42, "quantity": 1}]})
+    assert response.json["errors"]["product"]["field"] == "product.id"
+    response = client.post("/order", json={"products": [{"id": 1}]})
+    assert response.json["errors"]["product"]["field"] == "products.0.quantity"
+    assert Order.select().count() == ProductOrderQuantity.select().count() == 0
+
+
+def test_orders_hydrate_from_rows(database):
+    first = add_order({1: 2, 2: 1})
+    second = add_order({1: 1})
+    assert load_order(first.id) == first == Order.get_by_id(first.id).flatten()
+    assert list(load_orders()) == [first, second]
+
+    # frozen products are shared by the lines of the same product
+    orders = list(load_orders())
+    assert orders[0].products[0].product is orders[1].products[0].product
+    with pytest.raises(AttributeError):
+        orders[0].paid = True
+
+
+@pytest.mark.parametrize("backend", sorted(PRICING_BACKENDS))
+def test_bulk_pricing_matches_price_order(database, backend):
+    orders = [add_order({1: 3, 2: 1}), add_order({2: 7}), add_order({1: 1})]
+    for order, province in zip(orders, ("QC", "ON")):
+        put_order_shipping_information(
+            order.id,
+            "jgnault@uqac.ca",
+            FlatShippingInformation("Canada", "1 rue", "G7H 2B1", "Saguenay", province),
+        )
+    unweighed = Order.create(paid=False)  # the green smoothie has no weight
+    ProductOrderQuantity.create(oid=unweighed, pid=3, quantity=2)
+    ProductOrderQuantity.create(oid=unweighed, pid=1, quantity=1)
+    empty = Order.create(paid=False)
+
+    prices = price_orders(*order_price_columns(), backend=backend)
+    ids = [o.id for o in orders] + [unweighed.id, empty.id]
+    assert [int(i) for i in prices.order_ids] == ids
+    expected = [price_order(load_order(i)) for i in ids]
+    assert [prices.breakdown(i) for i in range(len(ids))] == expected
+    assert prices.summary() == {
+        "orders": 5,
+        "subtotal": sum(p.subtotal for p in expected),
+        "tax": sum(p.tax for p in expected if p.tax is not None),
+        "shipping": sum(p.shipping for p in expected if p.shipping is not None),
+        "total": sum(p.total for p in expected if p.total is not None),
+        "without_tax": 3,
+        "without_shipping": 1,
+    }
+
+
+def test_concurrent_orders_never_oversell(database):
+    Product.update(stock=25).where(Product.id == 1).execute()
+    database.close()
+    created, refused = [], []
+
+    def customer():
+        with database.connection_context():
+            for _ in range(5):
+                try:
+                    created.append(add_order({1: 1, 2: 1}).id)
+                except OutOfInventory:
+                    refused.append(1)
+
+    threads = [Thread(target=customer) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with database.connection_context():
+        assert len(created) == 25 and len(refused) == 16 * 5 - 25
+        assert Product.get_by_id(1).stock == 0
+        assert Product.get_by_id(2).stock == 100 - 25
+        assert ProductOrderQuantity.select().count() == 2 * 25
+
+
+def test_expired_reservations_are_released(client, monkeypatch):
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    Product.update(stock=2).where(Product.id == 1).execute()
+    order_id = new_order_id(client)  # takes the last 2 units
+    response = client.post("/order", json={"product": {"id": 1, "quantity": 1}})
+    assert response.json["errors"]["product"]["code"] == "out-of-inventory"
+
+    assert release_expired_reservations() == 0
+    assert release_expired_reservations(datetime.now() + timedelta(hours=1)) == 1
+    assert Product.get_by_id(1).stock == 2
+
+    # paying an order whose reservation was released reserves its stock again
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.json["order"]["paid"] is True
+    assert Product.get_by_id(1).stock == 0
+    assert release_expired_reservations(datetime.now() + timedelta(days=1)) == 0
+
+
+def test_sold_out_products_are_restocked_by_the_sync(client):
+    def listed_in_stock(query=""):
+        products = client.get(f"/{query}").json["products"]
+        return {p["id"]: p["in_stock"] for p in products}[1]
+
+    Product.update(stock=2).where(Product.id == 1).execute()
+    upstream = [p.flatten() for p in Product.select()]
+    new_order_id(client)  # takes the last 2 units
+    assert not listed_in_stock() and not listed_in_stock("?limit=5")
+    response = client.get("/?in_stock=false")
+    assert [p["id"] for p in response.json["products"]] == [1, 3]
+    response = client.post("/order", json={"product": {"id": 1, "quantity": 1}})
+    assert response.status_code == 422
+
+    report = sync_products(upstream)
+    assert (report.updated, report.restocked) == (0, 1)
+    assert Product.get_by_id(1).stock == DefaultConfig.PRODUCT_INITIAL_STOCK
+    reload_catalog()
+    assert listed_in_stock() and listed_in_stock("?limit=5")
+    response = client.post("/order", json={"product": {"id": 1, "quantity": 1}})
+    assert response.status_code == 302
+
+
+def test_released_order_cannot_be_paid_without_stock(client, monkeypatch):
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    order_id = new_order_id(client)
+    release_expired_reservations(datetime.now() + timedelta(hours=1))
+    Product.update(stock=1).where(Product.id == 1).execute()
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 422
+    assert response.json["errors"]["order"]["code"] == "out-of-inventory"
+    assert Product.get_by_id(1).stock == 1
+
+
+def test_batch_order_creation_shares_the_stock(client):
+    Product.update(stock=3).where(Product.id == 1).execute()
+    response = client.post(
+        "/orders",
+        json=[
+            {"product": {"id": 1, "quantity": 2}},
+            {"product": {"id": 1, "quantity": 2}},
+            {"product": {"id": 1, "quantity": 1}},
+        ],
+    )
+    results = response.json["orders"]
+    assert "id" in results[0] and "id" in results[2]
+    assert results[1]["errors"]["product"]["code"] == "out-of-inventory"
+    assert Product.get_by_id(1).stock == 0
+
+
+def test_payment_unavailable(client, monkeypatch):
+    def failing_charge(*args):
+        raise PaymentUnavailable("the payment gateway is failing", retry_after=12.5)
+
+    monkeypatch.setattr("appli.model.model.charge", failing_charge)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "13"
+    assert response.json["errors"]["order"]["code"] == "payment-unavailable"
+    assert client.get("/health").json["payment_gateway"]["state"] == "closed"
+    assert "charging_circuit_state 0.0" in client.get("/metrics").text
+
+
+def test_payment_outcome_unknown(client, monkeypatch):
+    charges = []
+
+    def lost_charge(*args):
+        charges.append(args)
+        raise PaymentOutcomeUnknown("the payment gateway answered 504")
+
+    monkeypatch.setattr("appli.model.model.charge", lost_charge)
+    order_id = new_order_id(client)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    response = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert response.status_code == 502
+    assert "Retry-After" not in response.headers
+    assert response.json["errors"]["order"]["code"] == "payment-outcome-unknown"
+
+    # kept on the order, to reconcile with the gateway
+    assert Order.get_by_id(order_id).payment_status == Order.PAYMENT_UNKNOWN
+    order = client.get(f"/order/{order_id}").json["order"]
+    assert order["paid"] is False
+    assert order["payment"] == {
+        "status": "unknown",
+        "error": "the payment gateway answered 504",
+    }
+
+    # not charged again until reconciled, whether synchronously or in the queue
+    retry = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert retry.status_code == 409
+    assert retry.json["errors"]["order"]["code"] == "payment-being-reconciled"
+    monkeypatch.setitem(api.config, "ASYNC_PAYMENTS", True)
+    queued = client.put(f"/order/{order_id}", json=CREDIT_CARD)
+    assert queued.status_code == 409
+    assert not PaymentJob.select().exists()
+    assert len(charges) == 1
+
+
+def read_event(stream) -> tuple[str, dict | None]:
+    chunk = next(stream).decode()
+    if chunk.startswith(":"):
+        return chunk, None
+    fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+    return fields["id"], parse_json(fields["data"])["order"]
+
+
+def test_order_events(client, monkeypatch):
+    monkeypatch.setattr("appli.model.model.charge", fake_charge)
+    monkeypatch.setitem(api.config, "ORDER_EVENTS_HEARTBEAT", 0.05)
+    order_id = new_order_id(client)
+    response = client.get(f"/order/{order_id}/events", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    stream = iter(response.response)
+    version, order = read_event(stream)
+    assert version == "0" and order["shipping_information"] == {}
+    assert order_events.subscribers() == 1
+
+    assert read_event(stream) == (": heartbeat\n\n", None)
+    client.put(f"/order/{order_id}", json=SHIPPING_INFORMATION)
+    version, order = read_event(stream)
+    assert version == "1" and order["email"] == "jgnault@uqac.ca"
+
+    client.put(f"/order/{order_id}", json=CREDIT_CARD)  # card, then transaction
+    version, order = read_event(stream)
+    assert version == "3" and order["paid"] is True
+    with pytest.raises(StopIteration):  # closed once paid
+        next(stream)
+    response.close()
+    assert order_events.subscribers() == 0
+
+
+def test_order_write_batching(client, monkeypatch):
+    Product.update(stock=12).where(Product.id == 2).execute()
+    writer = OrderWriter(window=0.2, max_batch=50)
+    monkeypatch.setattr("appli.routes.api.order_writer", writer)
+    monkeypatch.setitem(api.config, "ORDER_WRITE_BATCHING", True)
+    writer.start()
+    statuses = []
+
+    def customer():
+        response = api.test_client().post(
+            "/order", json={"product": {"id": 2, "quantity": 3}}
+        )
+        statuses.append(response.status_code)
+
+    batches = order_write_batch_size.count()
+    threads = [Thread(target=customer) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.stop()
+
+    # one transaction for all, the orders that couldn't be served failed alone
+    assert order_write_batch_size.count() == batches + 1
+    assert sorted(statuses) == [302] * 4 + [422] * 2
+    assert Order.select().count() == 4
+    assert Product.get_by_id(2).stock == 0
@@ -1,4 +1,26 @@
-from appli.utils.json import Json
+import pytest
+from decimal import Decimal
+from json import loads as parse_json
+from math import isnan
+
+from flask import Flask
+
+from appli.utils.json import Json, compile_schema
+from appli.utils import json_provider
+from appli.model.flat import (
+    FlatOrder,
+    FlatProduct,
+    FlatProductOrderQuantity,
+    FlatShippingInformation,
+)
+from appli.utils.metrics import Histogram, observe_outbound, outbound_calls
+from appli.utils.pricing import price_order, shipping_cents, tax_cents
+from appli.utils.taxes import (
+    PROVINCES,
+    UnknownProvince,
+    calculate_shipping_price,
+    calculate_tax,
+)
 from appli.routes import json_schemas
 
 
@@ -110,3 +132,142 @@ def test_put_order_credit_card_missing_field():
             }
         }
     ).is_like(json_schemas.put_order_credit_card)
+
+
+def test_compiled_schema_valid():
+    assert (
+        json_schemas.validate_new_order({"product": {"id": 123, "quantity": 2}}) is None
+    )
+
+
+def test_compiled_schema_reports_failing_field():
+    validate = json_schemas.validate_put_order_shipping_info
+    assert validate({}) == "order"
+    assert validate({"order": "hello"}) == "order"
+    assert validate({"order": {"email": "jgnault@uqac.ca"}}) == (
+        "order.shipping_information"
+    )
+    assert (
+        validate(
+            {
+                "order": {
+                    "email": "jgnault@uqac.ca",
+                    "shipping_information": {
+                        "country": "Canada",
+                        "address": "201, rue Président-Kennedy",
+                        "postal_code": "G7X 3Y7",
+                        "city": None,
+                        "province": "QC",
+                    },
+                }
+            }
+        )
+        == "order.shipping_information.city"
+    )
+    assert json_schemas.validate_new_order(None) == "product"
+
+
+def test_compiled_schema_agrees_with_is_like():
+    schema = {"a": int | None, "b": {"c": str}}
+    validate = compile_schema(schema)
+    for json in (
+        {"a": 1, "b": {"c": "d"}},
+        {"a": None, "b": {"c": "d"}},
+        {"a": "1", "b": {"c": "d"}},
+        {"a": 1, "b": {"c": 2}},
+        {"a": 1},
+    ):
+        assert (validate(json) is None) == Json(json).is_like(schema)
+
+
+@pytest.mark.parametrize("backend", sorted(json_provider.BACKENDS))
+def test_json_backends_agree(backend):
+    data = {"order": {"total_price": 56.2, "price": Decimal("28.10"), "name": "Président"}}
+    previous = json_provider.backend()
+    json_provider.set_backend(backend)
+    try:
+        body = json_provider.dumps_bytes(data, sort_keys=True)
+    finally:
+        json_provider.set_backend(previous)
+    assert parse_json(body) == {
+        "order": {"total_price": 56.2, "price": "28.10", "name": "Président"}
+    }
+
+
+def test_json_loads_follows_the_backend():
+    provider = json_provider.FastJSONProvider(Flask(__name__))
+    previous = json_provider.backend()
+    try:
+        json_provider.set_backend("json")
+        assert isnan(provider.loads("[NaN]")[0])  # only the standard library takes NaN
+        if "orjson" in json_provider.BACKENDS:
+            json_provider.set_backend("orjson")
+            with pytest.raises(ValueError):
+                provider.loads("[NaN]")
+    finally:
+        json_provider.set_backend(previous)
+
+
+def test_json_unknown_backend():
+    with pytest.raises(ValueError):
+        json_provider.set_backend("simdjson")
+
+
+def test_histogram_buckets():
+    histogram = Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, "get_order")
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{route="get_order",le="0.1"} 2',
+        'latency_seconds_bucket{route="get_order",le="1.0"} 3',
+        'latency_seconds_bucket{route="get_order",le="+Inf"} 4',
+        'latency_seconds_sum{route="get_order"} 2.65',
+        'latency_seconds_count{route="get_order"} 4',
+    ]
+
+
+def test_observe_outbound():
+    @observe_outbound("test_call")
+    def call(fail: bool):
+        if fail:
+            raise OSError("unreachable")
+        return "done"
+
+    assert call(False) == "done"
+    with pytest.raises(OSError):
+        call(True)
+    assert outbound_calls.value("test_call", "ok") == 1
+    assert outbound_calls.value("test_call", "error") == 1
+
+
+def test_pricing_tables_match_taxes():
+    for province in PROVINCES:
+        assert tax_cents(10_000, province) == round(calculate_tax(province) * 10_000)
+    for grams in (-1, 0, 1, 499, 500, 1999, 2000, 10_000):
+        assert shipping_cents(grams) == calculate_shipping_price(grams) * 100
+    with pytest.raises(UnknownProvince):
+        tax_cents(100, "XX")
+
+
+def test_price_order_in_cents():
+    def order(*lines, province: str | None = "QC") -> FlatOrder:
+        return FlatOrder(
+            products=[
+                FlatProductOrderQuantity(
+                    product=FlatProduct("p", price, "p.jpg", weight=weight),
+                    quantity=quantity,
+                )
+                for price, quantity, weight in lines
+            ],
+            shipping_information=province
+            and FlatShippingInformation("Canada", "1 rue", "G7H", "Saguenay", province),
+        )
+
+    price = price_order(order((0.1, 3, 100), (28.1, 2, 400)))
+    assert (price.subtotal, price.tax, price.shipping) == (5650, 848, 1000)  # 847.5
+    assert price.subtotal_with_tax == 6498 and price.total == 7498
+    assert price.weight == 1100
+
+    price = price_order(order((12.5, 1, None), province=None))
+    assert (price.subtotal, price.tax, price.shipping) == (1250, None, None)
+    assert price.total is None